@@ -1,15 +1,26 @@
+import functools
+import logging
 import os
 import sqlite3
-from typing import Any, List
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain.agents import Tool, AgentExecutor, create_openai_functions_agent
-from langchain.tools import StructuredTool
-from langchain_community.utilities import GoogleSerperAPIWrapper
+from typing import Any, Iterable, List
 from langchain_core.pydantic_v1 import BaseModel, Field
-from langchain_openai import ChatOpenAI
 import concurrent.futures
 
+from clients import registry
+from condense import condense_results, condensed_search, terms_for
+from guards import GuardError, call_agent, call_search, guard_report
+from hedging import row_deadline, run_stage, stage_report, stages
+from logsetup import agent_verbose, configure_logging, detail, row_context
+from fingerprints import SELECTED_ROWS, classifier_version, ensure_hash_columns, reclassify, select_rows, stamp
+from fast_path import build_supplier_query, format_batch, invoke_structured, match_batch, NO_SEARCH_RESULTS
+from priority import prepare_priority, priority_join
+from routing import CONFIDENCE_INSTRUCTIONS, TieredRouter, threshold_for
+from singleflight import coalesce, flight_report
+from staged_pipeline import StagedPipeline
+from spend_keys import ensure_spend_keys
+from unspsc import ensure_level_columns, write_levels
+from transcripts import agent_transcript, prompt_version, reparse, store
+
 
 # Your GetSupplierData class
 class GetSupplierData(BaseModel):
@@ -23,6 +34,7 @@ class GetSupplierData(BaseModel):
         classification_name (str): The UNSPSC classification name of the supplier.
         website (str): The website of the supplier.
         comments (str): Any additional comments about the supplier.
+        confidence (float | None): Calibrated probability that the classification is correct.
     """
 
     supplier_name: str = Field(description="The name of the supplier organization")
@@ -35,92 +47,326 @@ class GetSupplierData(BaseModel):
     )
     website: str = Field(description="The website of the supplier")
     comments: str = Field(description="Any additional comments about the supplier")
+    confidence: float | None = Field(
+        description="Calibrated probability (0-1) that the classification code is correct", default=None
+    )
 
 
-# Initialize the ChatOpenAI client
-llm = ChatOpenAI(model="gpt-4o-mini", api_key=os.environ.get("OPENAI_API_KEY"))
+class GetSupplierDataBatch(BaseModel):
+    """Structured output of a batched classification: one GetSupplierData per supplier."""
 
-# Initialize the GoogleSerperAPIWrapper tool
-google_search = GoogleSerperAPIWrapper(api_key=os.environ.get("SERPER_API_KEY"))
+    results: List[GetSupplierData] = Field(
+        description="One entry per company, in the order the companies were given"
+    )
 
-# Create the parser
-parser = PydanticOutputParser(pydantic_object=GetSupplierData)
 
-# Define the prompt template
-prompt = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            "You are an AI assistant tasked with gathering information about supplier companies.",
-        ),
-        ("human", "I need information about the company: {company_name}"),
-        (
-            "system",
-            "Certainly! I'll use the available tools to search for information about {company_name}. "
-            "I'll provide the following details:\n"
-            "1. Validation of whether it's a valid supplier\n"
-            "2. The UNSPSC classification code\n"
-            "3. The UNSPSC classification name\n"
-            "4. The website\n"
-            "5. Any additional relevant comments\n\n"
-            "I'll format the information as follows:\n"
-            "{format_instructions}",
-        ),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ]
-)
+# Models; clients are created on first use so importing this module stays cheap
+MODEL = "gpt-4o-mini"
+ESCALATION_MODEL = "gpt-4o"  # for suppliers the cheap tiers are not confident about
+
+# Work database and row-level concurrency; run profiles (see cli.py) override both
+DB_PATH = os.environ.get("SPEND_DB", "spend_intake2.db")
+MAX_WORKERS = 16
+
+# Prompt messages for the agent; the agent_scratchpad placeholder is appended when the prompt is built
+AGENT_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with gathering information about supplier companies.",
+    ),
+    ("human", "I need information about the company: {company_name}"),
+    (
+        "system",
+        "Certainly! I'll use the available tools to search for information about {company_name}. "
+        "I'll provide the following details:\n"
+        "1. Validation of whether it's a valid supplier\n"
+        "2. The UNSPSC classification code\n"
+        "3. The UNSPSC classification name\n"
+        "4. The website\n"
+        "5. Any additional relevant comments\n\n"
+        "I'll format the information as follows:\n"
+        "{format_instructions}",
+    ),
+]
+
+# Prompt for the single-shot pipeline mode: search results are inlined and the
+# answer is constrained to the GetSupplierData JSON schema
+FAST_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with gathering information about supplier companies. "
+        "Using only the search results provided, give:\n"
+        "1. Validation of whether it's a valid supplier\n"
+        "2. The UNSPSC classification code\n"
+        "3. The UNSPSC classification name\n"
+        "4. The website\n"
+        "5. Any additional relevant comments\n" + CONFIDENCE_INSTRUCTIONS,
+    ),
+    ("human", "Company: {company_name}\n\nSearch results:\n{search_results}"),
+]
+
+# Prompt for classifying a micro-batch of suppliers in one completion (see server.py)
+BATCH_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with gathering information about supplier companies. "
+        "Several numbered companies follow, each with its own search results. For every company, "
+        "using only its own search results, give:\n"
+        "1. Validation of whether it's a valid supplier\n"
+        "2. The UNSPSC classification code\n"
+        "3. The UNSPSC classification name\n"
+        "4. The website\n"
+        "5. Any additional relevant comments\n"
+        "Return one result per company in the same order, copying each company name exactly.\n"
+        + CONFIDENCE_INSTRUCTIONS,
+    ),
+    ("human", "{companies}"),
+]
+
+# Transcripts are stored per prompt version so a prompt change never mixes with older runs
+PROMPT_VERSION = prompt_version(AGENT_MESSAGES, FAST_MESSAGES)
+# Stamped on each classified row so prompt or model upgrades can re-queue only what they affect
+CLASSIFIER_VERSION = classifier_version(PROMPT_VERSION, MODEL, ESCALATION_MODEL)
+
+
+@functools.cache
+def get_llm():
+    """The ChatOpenAI client on the shared connection pool."""
+    return registry.chat_openai(MODEL)
+
+
+@functools.cache
+def get_escalation_llm():
+    """The larger ChatOpenAI client used by the last routing tier."""
+    return registry.chat_openai(ESCALATION_MODEL)
+
+
+@functools.cache
+def get_google_search():
+    """The GoogleSerperAPIWrapper tool."""
+    return registry.serper()
+
+
+@functools.cache
+def get_parser():
+    from langchain_core.output_parsers import PydanticOutputParser
+
+    return PydanticOutputParser(pydantic_object=GetSupplierData)
+
+
+@functools.cache
+def get_prompt():
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    return ChatPromptTemplate.from_messages([*AGENT_MESSAGES, MessagesPlaceholder(variable_name="agent_scratchpad")])
+
+
+@functools.cache
+def get_fast_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(FAST_MESSAGES)
+
+
+@functools.cache
+def get_batch_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(BATCH_MESSAGES)
+
+
+_LAZY_ATTRIBUTES = {
+    "llm": get_llm,
+    "escalation_llm": get_escalation_llm,
+    "google_search": get_google_search,
+    "parser": get_parser,
+    "prompt": get_prompt,
+    "fast_prompt": get_fast_prompt,
+}
+
+
+def __getattr__(name: str):
+    # Keep agent_company.llm, agent_company.parser etc. working for callers of the old module globals
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Define the function to process the company name
+@coalesce("suppliers")
 def process_company_name(company_name: str) -> GetSupplierData:
     """
     Process the company name and return the supplier data.
 
+    Concurrent calls for the same company name share one agent run.
+
     Args:
         company_name (str): The name of the company.
 
     Returns:
         GetSupplierData: The supplier data.
     """
+    from langchain.agents import AgentExecutor, create_openai_functions_agent
+    from langchain_core.tools import StructuredTool
 
     tools = [
         StructuredTool.from_function(
             name="investigate_supplier_company",
-            func=google_search.run,
+            func=condensed_search(get_google_search(), company_name),
             description="Use Google search to find information about the company.",
         )
     ]
 
-    agent = create_openai_functions_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+    agent = create_openai_functions_agent(get_llm(), tools, get_prompt())
+    agent_executor = AgentExecutor(
+        agent=agent, tools=tools, verbose=agent_verbose(), max_execution_time=stages["agent"].timeout,
+        return_intermediate_steps=True,
+    )
 
-    result = agent_executor.invoke(
+    result = run_stage(
+        "agent",
+        call_agent,
+        agent_executor.invoke,
         {
             "company_name": company_name,
-            "format_instructions": parser.get_format_instructions(),
-        }
+            "format_instructions": get_parser().get_format_instructions(),
+        },
     )
-    parsed_data = parser.parse(result["output"])
+    store.record(company_name, "agent", agent_transcript(result))
+    parsed_data = get_parser().parse(result["output"])
     return parsed_data
 
 
+def search_supplier(company_name: str) -> str:
+    """
+    Run the single Serper query for a company name.
+
+    Args:
+        company_name (str): The name of the company.
+
+    Returns:
+        str: The condensed search context for the prompt.
+    """
+    query = build_supplier_query(company_name)
+    results = run_stage("search", call_search, get_google_search().results, query)
+    store.record(company_name, "search", {"query": query, "results": results})
+    return condense_results(results, terms_for(company_name), key=company_name)
+
+
+def classify_supplier(company_name: str, search_results: str, model=None) -> GetSupplierData:
+    """
+    Classify a supplier with exactly one structured-output completion.
+
+    Args:
+        company_name (str): The name of the company.
+        search_results (str): The context returned by search_supplier.
+        model: The ChatOpenAI client to use. Defaults to the mini model.
+
+    Returns:
+        GetSupplierData: The supplier data.
+    """
+    return invoke_structured(
+        model or get_llm(),
+        get_fast_prompt(),
+        GetSupplierData,
+        {"company_name": company_name, "search_results": search_results},
+        key=company_name,
+    )
+
+
+def process_company_name_fast(company_name: str) -> GetSupplierData:
+    """
+    Process the company name without the agent loop: one search, one completion.
+
+    Args:
+        company_name (str): The name of the company.
+
+    Returns:
+        GetSupplierData: The supplier data.
+    """
+    return classify_supplier(company_name, search_supplier(company_name))
+
+
+def classify_suppliers_batch(company_names: List[str], search_results: List[str],
+                             model=None) -> List[GetSupplierData | None]:
+    """
+    Classify several suppliers with one structured-output completion.
+
+    Args:
+        company_names (list): The names of the companies.
+        search_results (list): The context returned by search_supplier for each name.
+        model: The ChatOpenAI client to use. Defaults to the mini model.
+
+    Returns:
+        list: One GetSupplierData per name, or None where the model gave no answer for it.
+    """
+    batch = invoke_structured(
+        model or get_llm(), get_batch_prompt(), GetSupplierDataBatch,
+        {"companies": format_batch("Company", company_names, search_results)},
+    )
+    results = match_batch(company_names, batch.results, "supplier_name")
+    for company_name, supplier_data in zip(company_names, results):
+        if supplier_data is not None:
+            store.record(company_name, "llm", {"content": supplier_data.json()})
+    logging.info("Processed %d suppliers in one batch, %d unanswered", len(company_names), results.count(None))
+    return results
+
+
+def build_supplier_router() -> TieredRouter:
+    """
+    Build the tiered router for suppliers: mini model without search, mini model
+    with search, then the larger model with search.
+
+    Returns:
+        TieredRouter: The router, with the ARS_Supplier_Classification_List threshold.
+    """
+    return TieredRouter(
+        [
+            ("mini_no_search", lambda name: classify_supplier(name, NO_SEARCH_RESULTS)),
+            ("mini_search", process_company_name_fast),
+            ("large_search", lambda name: classify_supplier(name, search_supplier(name), get_escalation_llm())),
+        ],
+        threshold_for("ARS_Supplier_Classification_List"),
+    )
+
+
 # Function to get suppliers without classification_code
-def get_suppliers_without_classification(cursor, limit: int = 100) -> List[tuple]:
+def get_suppliers_without_classification(cursor, limit: int = 100, by_spend: bool = False,
+                                         selected: bool = False) -> List[tuple]:
     """
     Retrieve suppliers from the database who do not have a classification code.
 
     Args:
         cursor: The database cursor.
         limit (int): The number of suppliers to retrieve. Default is 100.
+        by_spend (bool): Order by spend-weighted priority, highest first, else by id. Requires
+            priority.refresh_priority(conn, "suppliers") to have been run.
+        selected (bool): Only suppliers staged by fingerprints.select_rows on this connection.
 
     Returns:
         List[tuple]: A list of tuples containing supplier IDs and names.
     """
+    only = f"AND {SELECTED_ROWS.format(alias='s')}" if selected else ""
+    if by_spend:
+        cursor.execute(
+            f"""
+            SELECT s.id, s.supplier_name
+            FROM main.ARS_Supplier_Classification_List s
+            {priority_join("suppliers", "s")}
+            WHERE (s.classification_code IS NULL OR s.classification_code = '') {only}
+            ORDER BY COALESCE(p.weighted_spend, 0) DESC, s.id
+            LIMIT ?
+        """,
+            (limit,),
+        )
+        return cursor.fetchall()
+
     cursor.execute(
-        """
-        SELECT id, supplier_name 
-        FROM main.ARS_Supplier_Classification_List 
-        WHERE classification_code IS NULL OR classification_code = ''
+        f"""
+        SELECT s.id, s.supplier_name
+        FROM main.ARS_Supplier_Classification_List s
+        WHERE (s.classification_code IS NULL OR s.classification_code = '') {only}
+        ORDER BY s.id
         LIMIT ?
     """,
         (limit,),
@@ -156,71 +402,309 @@ def update_supplier_info(conn, supplier_id, supplier_data):
         ),
     )
     conn.commit()
+    write_levels(conn, "suppliers", supplier_id,
+                 supplier_data.classification_code, supplier_data.classification_name)
 
 
 # Function to process a single supplier
-def process_single_supplier(supplier_id, supplier_name, conn):
+def process_single_supplier(supplier_id, supplier_name, conn, mode: str = "agent",
+                            router: TieredRouter | None = None):
     """
     Process a single supplier by retrieving and updating its information.
 
+    Every stage call for the supplier shares one row deadline, and the raw
+    responses are saved to the supplier's transcript whether or not it parsed.
+
     Args:
         supplier_id: The ID of the supplier.
         supplier_name: The name of the supplier.
         conn: The database connection.
+        mode (str): "pipeline" tries the single-shot path first and falls back to
+            the agent; "routed" escalates through the router's tiers and falls back
+            to the agent; "agent" uses the agent only.
+        router (TieredRouter | None): The router used in "routed" mode.
 
     Returns:
         bool: True if processing was successful, False otherwise.
+
+    Raises:
+        GuardError: If a circuit breaker or the run budget stops the run.
+    """
+    with row_deadline(), store.row("suppliers", supplier_id), row_context("suppliers", supplier_id, supplier_name):
+        try:
+            logging.info("Processing supplier: %s", supplier_name)
+            supplier_data = None
+            if mode == "pipeline":
+                try:
+                    supplier_data = process_company_name_fast(supplier_name)
+                except GuardError:
+                    raise
+                except Exception as e:
+                    logging.warning("Pipeline mode failed for %s, falling back to agent: %s", supplier_name, e)
+            if mode == "routed":
+                try:
+                    supplier_data = router.classify(supplier_name)
+                except GuardError:
+                    raise
+                except Exception as e:
+                    logging.warning("Routed mode failed for %s, falling back to agent: %s", supplier_name, e)
+            if supplier_data is None:
+                supplier_data = process_company_name(supplier_name)
+            update_supplier_info(conn, supplier_id, supplier_data)
+            stamp(conn, "suppliers", supplier_id, CLASSIFIER_VERSION)
+            store.save("suppliers", supplier_id, supplier_name, PROMPT_VERSION)
+            logging.info("Updated information for supplier %s", supplier_name)
+            detail("Supplier %s: %s", supplier_name, supplier_data)
+            return True
+        except GuardError:
+            store.discard("suppliers", supplier_id)
+            raise
+        except Exception as e:
+            store.save("suppliers", supplier_id, supplier_name, PROMPT_VERSION, "failed")
+            logging.error("Error processing supplier %s: %s", supplier_name, e)
+            return False
+
+
+def process_suppliers_staged(batch_size: int = 100, search_workers: int = 8, llm_workers: int = 8,
+                             buffer_size: int = 64, search_rate: float | None = None,
+                             by_spend: bool = True, half_life_days: float | None = None,
+                             infer_first: bool = True, db_path: str = DB_PATH, progress=None,
+                             ids: Iterable[Any] | None = None):
     """
+    Process suppliers through the staged search -> LLM -> writer pipeline.
+
+    Args:
+        batch_size (int): The number of suppliers to process.
+        search_workers (int): Concurrency of the search stage.
+        llm_workers (int): Concurrency of the LLM stage.
+        buffer_size (int): Capacity of the prefetched search buffer.
+        search_rate (float | None): Maximum Serper calls per second.
+        by_spend (bool): Process the highest-spend suppliers first and track spend coverage.
+        half_life_days (float | None): Recency half-life for the spend weighting.
+        infer_first (bool): Classify suppliers with a dominant item category first, without LLM calls.
+        db_path (str): The work database.
+        progress: Optional tracker whose ``update(success)`` is called for every written or failed supplier.
+        ids: Only process these supplier ids (e.g. the ones re-queued by reclassify).
+
+    Returns:
+        dict: Stage counters, queue-depth metrics and rows/sec.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     try:
-        print(f"Processing supplier: {supplier_name}")
-        supplier_data = process_company_name(supplier_name)
-        update_supplier_info(conn, supplier_id, supplier_data)
-        print(f"Updated information for supplier {supplier_name}:")
-        print(supplier_data)
-        return True
-    except Exception as e:
-        print(f"Error processing supplier {supplier_name}: {e}")
-        return False
+        ensure_hash_columns(conn, "suppliers")
+        ensure_level_columns(conn, "suppliers")
+        ensure_spend_keys(conn)
+        if infer_first:
+            from supplier_inference import infer_supplier_classifications  # pulls in pandas
+
+            infer_supplier_classifications(conn)
+        coverage = None
+        if by_spend:
+            coverage = prepare_priority(conn, "suppliers", half_life_days)
+            by_spend = coverage is not None
+        if ids is not None:
+            select_rows(conn, ids)
+        suppliers = get_suppliers_without_classification(conn.cursor(), batch_size, by_spend, ids is not None)
+        supplier_names = dict(suppliers)
+
+        def write(supplier_id, supplier_data):
+            update_supplier_info(conn, supplier_id, supplier_data)
+            stamp(conn, "suppliers", supplier_id, CLASSIFIER_VERSION)
+            store.save("suppliers", supplier_id, supplier_names[supplier_id], PROMPT_VERSION)
+            if coverage:
+                coverage.record(supplier_names[supplier_id])
+            if progress:
+                progress.update(True)
+
+        def fail(supplier_id, key):
+            store.discard("suppliers", supplier_id)
+            if progress:
+                progress.update(False)
+
+        pipeline = StagedPipeline(
+            search_fn=search_supplier,
+            classify_fn=classify_supplier,
+            write_fn=write,
+            fallback_fn=process_company_name,
+            search_workers=search_workers,
+            llm_workers=llm_workers,
+            buffer_size=buffer_size,
+            search_rate=search_rate,
+            fatal_errors=(GuardError,),
+            kind="suppliers",
+            on_failure=fail,
+        )
+        stats = pipeline.run(suppliers)
+        stats["guards"] = guard_report()
+        stats["stages"] = stage_report()
+        stats["single_flight"] = flight_report()
+        stats["http"] = registry.stats()
+        logging.info(f"Successfully processed {stats['counts']['written']} out of {len(suppliers)} suppliers")
+        if stats["stopped"]:
+            logging.warning(f"Run stopped at {stats['stopped']}: {stats['guards']}")
+        if coverage:
+            stats["coverage"] = coverage.report()
+            logging.info(f"Spend coverage: {stats['coverage']}")
+        return stats
+    finally:
+        conn.close()
 
 
 # Main function to process suppliers
-def process_suppliers(batch_size: int = 100):
+def process_suppliers(batch_size: int = 100, mode: str = "agent", by_spend: bool = True,
+                      half_life_days: float | None = None, infer_first: bool = True,
+                      max_workers: int = MAX_WORKERS, db_path: str = DB_PATH, progress=None,
+                      ids: Iterable[Any] | None = None):
     """
     Main function to process suppliers in batches.
 
     Args:
         batch_size (int): The number of suppliers to process in one batch. Default is 100.
+        mode (str): "pipeline" for the single-shot path with agent fallback, "staged"
+            for the prefetching search/LLM/writer pipeline, "routed" for confidence-based
+            tiered routing, or "agent".
+        by_spend (bool): Process the highest-spend suppliers first and track spend coverage.
+        half_life_days (float | None): Recency half-life for the spend weighting.
+        infer_first (bool): Classify suppliers with a dominant item category first, so
+            only ambiguous suppliers go to the agent.
+        max_workers (int): Suppliers processed concurrently (search and LLM workers in staged mode).
+        db_path (str): The work database.
+        progress: Optional tracker whose ``update(success)`` is called for every finished supplier.
+        ids: Only process these supplier ids (e.g. the ones re-queued by reclassify).
     """
-    conn = sqlite3.connect("spend_intake2.db", check_same_thread=False)
+    if mode == "staged":
+        process_suppliers_staged(batch_size, search_workers=max_workers, llm_workers=max_workers,
+                                 by_spend=by_spend, half_life_days=half_life_days,
+                                 infer_first=infer_first, db_path=db_path, progress=progress, ids=ids)
+        return
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     cursor = conn.cursor()
+    router = build_supplier_router() if mode == "routed" else None
 
     try:
+        ensure_hash_columns(conn, "suppliers")
+        ensure_level_columns(conn, "suppliers")
+        ensure_spend_keys(conn)
+        if infer_first:
+            from supplier_inference import infer_supplier_classifications  # pulls in pandas
+
+            infer_supplier_classifications(conn)
+
+        coverage = None
+        if by_spend:
+            coverage = prepare_priority(conn, "suppliers", half_life_days)
+            by_spend = coverage is not None
+
         # Retrieve suppliers without classification codes
-        suppliers = get_suppliers_without_classification(cursor, batch_size)
+        if ids is not None:
+            select_rows(conn, ids)
+        suppliers = get_suppliers_without_classification(cursor, batch_size, by_spend, ids is not None)
 
         # Use a thread pool to process suppliers concurrently
-        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-            futures = [
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
                 executor.submit(
-                    process_single_supplier, supplier_id, supplier_name, conn
-                )
+                    process_single_supplier, supplier_id, supplier_name, conn, mode, router
+                ): supplier_name
                 for supplier_id, supplier_name in suppliers
-            ]
+            }
 
             # Count the number of successfully processed suppliers
-            successful = sum(
-                future.result() for future in concurrent.futures.as_completed(futures)
-            )
-
-        print(f"Successfully processed {successful} out of {len(suppliers)} suppliers")
+            successful = 0
+            stopped = None
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    success = future.result()
+                    if progress:
+                        progress.update(success)
+                    if not success:
+                        continue
+                except concurrent.futures.CancelledError:
+                    continue
+                except GuardError as e:
+                    # Stop dispatching; suppliers already in flight still finish and are written
+                    if stopped is None:
+                        stopped = e
+                        logging.warning(f"Stopping run at supplier {futures[future]}: {e}")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                    continue
+                successful += 1
+                if coverage:
+                    coverage.record(futures[future])
+
+        logging.info(f"Successfully processed {successful} out of {len(suppliers)} suppliers")
+        if stopped is not None:
+            logging.warning(f"Run stopped: {stopped}. {guard_report()}")
+        if router:
+            logging.info(f"Routing report: {router.report()}")
+        if coverage:
+            logging.info(f"Spend coverage: {coverage.report()}")
+        stage_report()
+        flight_report()
+        registry.stats()
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logging.exception(f"An error occurred: {e}")
+
+    finally:
+        conn.close()
+
+
+def reparse_suppliers(version: str | None = None, dry_run: bool = False, db_path: str = DB_PATH):
+    """
+    Rebuild the supplier result columns from stored transcripts without calling any API.
 
+    Args:
+        version (str | None): Only reparse transcripts from this prompt version.
+        dry_run (bool): Parse without writing.
+        db_path (str): The work database.
+
+    Returns:
+        dict: Counts of transcripts read, parsed, written and failed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_level_columns(conn, "suppliers")
+        return reparse(
+            store, "suppliers", GetSupplierData, get_parser(),
+            lambda supplier_id, supplier_data: update_supplier_info(conn, supplier_id, supplier_data),
+            version, dry_run,
+        )
+    finally:
+        conn.close()
+
+
+def reclassify_suppliers(include_unhashed: bool = False, dry_run: bool = False, mode: str = "routed",
+                         db_path: str = DB_PATH, **options):
+    """
+    Re-queue and reprocess only the suppliers whose name or classifier version changed.
+
+    Only the re-queued suppliers are processed, in spend order; supplier
+    inference is skipped so nothing else in the backlog is touched.
+
+    Args:
+        include_unhashed (bool): Also redo suppliers classified before input hashes were
+            recorded, including those classified by item inference.
+        dry_run (bool): Only count the changed suppliers.
+        mode (str): The processing mode, see process_suppliers.
+        db_path (str): The work database.
+        **options: Passed to process_suppliers, e.g. ``max_workers`` or ``progress``.
+
+    Returns:
+        dict: Changed-supplier counts per reason and the number re-queued.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        counts, ids = reclassify(conn, "suppliers", CLASSIFIER_VERSION, include_unhashed, dry_run)
     finally:
         conn.close()
+    if ids:
+        process_suppliers(len(ids), mode=mode, infer_first=False, db_path=db_path, ids=ids, **options)
+    return counts
 
 
 # Example usage
 if __name__ == "__main__":
-    process_suppliers(200)  # Process 200 suppliers at a time
+    configure_logging()
+    process_suppliers(200, mode="routed")  # Process 200 suppliers at a time
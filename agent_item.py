@@ -1,20 +1,30 @@
+import functools
 import os
 import sqlite3
-from typing import Any, List
+from typing import Any, Iterable, List
 
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.tools import Tool, StructuredTool
 from langchain_core.pydantic_v1 import BaseModel, Field
 
-from langchain_openai import ChatOpenAI
-
-from langchain_community.utilities import GoogleSerperAPIWrapper
-from langchain.agents import AgentExecutor, create_openai_functions_agent
 import concurrent.futures
 from dotenv import load_dotenv
 import logging
 
+from clients import registry
+from condense import condense_results, condensed_search, terms_for
+from guards import GuardError, call_agent, call_search, guard_report
+from hedging import row_deadline, run_stage, stage_report, stages
+from logsetup import agent_verbose, configure_logging, detail, row_context
+from fingerprints import SELECTED_ROWS, classifier_version, ensure_hash_columns, reclassify, select_rows, stamp
+from fast_path import (build_item_query, format_batch, invoke_structured, match_batch, needs_search,
+                       NO_SEARCH_RESULTS)
+from priority import TARGETS as PRIORITY_TARGETS, prepare_priority, priority_join
+from routing import CONFIDENCE_INSTRUCTIONS, TieredRouter, threshold_for
+from singleflight import coalesce, flight_report
+from staged_pipeline import StagedPipeline
+from spend_keys import ensure_spend_keys
+from unspsc import ensure_level_columns, write_levels
+from transcripts import agent_transcript, prompt_version, reparse, store
+
 # Your GetItemData class
 class GetItemData(BaseModel):
     """
@@ -27,6 +37,7 @@ class GetItemData(BaseModel):
         classification_name (str | None): The UNSPSC classification name of the item.
         website (str | None): The website related to the item.
         comments (str | None): Any additional comments about the item.
+        confidence (float | None): Calibrated probability that the classification is correct.
     """
 
     item_code: str = Field(description="The unique code of the item")
@@ -39,121 +50,324 @@ class GetItemData(BaseModel):
     )
     website: str | None = Field(description="The website related to the item", default=None)
     comments: str | None = Field(description="Any additional comments about the item", default=None)
+    confidence: float | None = Field(
+        description="Calibrated probability (0-1) that the classification code is correct", default=None
+    )
+
+
+class GetItemDataBatch(BaseModel):
+    """Structured output of a batched classification: one GetItemData per item."""
+
+    results: List[GetItemData] = Field(description="One entry per item, in the order the items were given")
 
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize the ChatOpenAI client
-llm = ChatOpenAI(model="gpt-4o-mini", api_key=os.getenv("OPENAI_API_KEY"))
-
-# Initialize the GoogleSerperAPIWrapper tool with additional parameters
-google_search = GoogleSerperAPIWrapper(
-    api_key=os.getenv("SERPER_API_KEY"),
-    gl="us",  # Set the country code
-    hl="en",  # Set the language
-    type="search",  # Specify the search type
-)
-
-# Create the parser
-parser = PydanticOutputParser(pydantic_object=GetItemData)
-
-# Define the prompt template
-prompt = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            "You are an AI assistant tasked with gathering information about items.",
-        ),
-        ("human", "I need information on an item with the code: {item_code}"),
-        (
-            "system",
-            "Certainly! I'll use the available tools to search for information about the item with code {item_code}. "
-            "Please provide only factual information that you can verify. If you cannot find specific information, "
-            "leave the field empty or set it to None. Do not generate or guess any information. "
-            "Provide the following details:\n"
-            "1. Validation of whether it's a valid item (true only if you can confirm it exists)\n"
-            "2. The UNSPSC classification code (if available)\n"
-            "3. The UNSPSC classification name (if available)\n"
-            "4. The website (if a reliable source is found)\n"
-            "5. Any additional relevant comments (factual information only)\n\n"
-            "Format the information as follows:\n"
-            "{format_instructions}",
-        ),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ]
-)
+# Models; clients are created on first use so importing this module stays cheap
+MODEL = "gpt-4o-mini"
+ESCALATION_MODEL = "gpt-4o"  # for rows the cheap tiers are not confident about
+
+# Work database and row-level concurrency; run profiles (see cli.py) override both
+DB_PATH = os.environ.get("SPEND_DB", "spend_intake2.db")
+MAX_WORKERS = 16
+
+# Prompt messages for the agent; the agent_scratchpad placeholder is appended when the prompt is built
+AGENT_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with gathering information about items.",
+    ),
+    ("human", "I need information on an item with the code: {item_code}"),
+    (
+        "system",
+        "Certainly! I'll use the available tools to search for information about the item with code {item_code}. "
+        "Please provide only factual information that you can verify. If you cannot find specific information, "
+        "leave the field empty or set it to None. Do not generate or guess any information. "
+        "Provide the following details:\n"
+        "1. Validation of whether it's a valid item (true only if you can confirm it exists)\n"
+        "2. The UNSPSC classification code (if available)\n"
+        "3. The UNSPSC classification name (if available)\n"
+        "4. The website (if a reliable source is found)\n"
+        "5. Any additional relevant comments (factual information only)\n\n"
+        "Format the information as follows:\n"
+        "{format_instructions}",
+    ),
+]
+
+# Prompt for the single-shot pipeline mode: search results are inlined and the
+# answer is constrained to the GetItemData JSON schema
+FAST_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with classifying items against the UNSPSC taxonomy. "
+        "Use only the item code and the search results provided. If you cannot verify a field, "
+        "set it to null. Do not generate or guess any information. "
+        "Validation is true only if you can confirm the item exists. " + CONFIDENCE_INSTRUCTIONS,
+    ),
+    ("human", "Item code: {item_code}\n\nSearch results:\n{search_results}"),
+]
+
+# Prompt for classifying a micro-batch of items in one completion (see server.py)
+BATCH_MESSAGES = [
+    (
+        "system",
+        "You are an AI assistant tasked with classifying items against the UNSPSC taxonomy. "
+        "Several numbered items follow, each with its own search results. Classify every item "
+        "independently, using only its own code and search results, and return one result per item "
+        "in the same order, copying each item code exactly. If you cannot verify a field, set it to null. "
+        "Do not generate or guess any information. "
+        "Validation is true only if you can confirm the item exists. " + CONFIDENCE_INSTRUCTIONS,
+    ),
+    ("human", "{items}"),
+]
+
+# Transcripts are stored per prompt version so a prompt change never mixes with older runs
+PROMPT_VERSION = prompt_version(AGENT_MESSAGES, FAST_MESSAGES)
+# Stamped on each classified row so prompt or model upgrades can re-queue only what they affect
+CLASSIFIER_VERSION = classifier_version(PROMPT_VERSION, MODEL, ESCALATION_MODEL)
+
+
+@functools.cache
+def get_llm():
+    """The ChatOpenAI client on the shared connection pool."""
+    return registry.chat_openai(MODEL)
+
+
+@functools.cache
+def get_escalation_llm():
+    """The larger ChatOpenAI client used by the last routing tier."""
+    return registry.chat_openai(ESCALATION_MODEL)
+
+
+@functools.cache
+def get_google_search():
+    """The GoogleSerperAPIWrapper tool with additional parameters."""
+    return registry.serper(
+        gl="us",  # Set the country code
+        hl="en",  # Set the language
+        type="search",  # Specify the search type
+    )
+
+
+@functools.cache
+def get_parser():
+    from langchain_core.output_parsers import PydanticOutputParser
+
+    return PydanticOutputParser(pydantic_object=GetItemData)
+
+
+@functools.cache
+def get_prompt():
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    return ChatPromptTemplate.from_messages([*AGENT_MESSAGES, MessagesPlaceholder(variable_name="agent_scratchpad")])
+
+
+@functools.cache
+def get_fast_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(FAST_MESSAGES)
+
+
+@functools.cache
+def get_batch_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages(BATCH_MESSAGES)
+
+
+_LAZY_ATTRIBUTES = {
+    "llm": get_llm,
+    "escalation_llm": get_escalation_llm,
+    "google_search": get_google_search,
+    "parser": get_parser,
+    "prompt": get_prompt,
+    "fast_prompt": get_fast_prompt,
+}
+
+
+def __getattr__(name: str):
+    # Keep agent_item.llm, agent_item.parser etc. working for callers of the old module globals
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Define the function to process the item code
+@coalesce("items")
 def process_item_code(item_code: str) -> GetItemData:
     """
     Process the item code and return the item data.
 
+    Concurrent calls for the same item code share one agent run.
+
     Args:
         item_code (str): The code of the item.
 
     Returns:
         GetItemData: The item data.
     """
+    from langchain.agents import AgentExecutor, create_openai_functions_agent
+    from langchain_core.tools import StructuredTool
 
     tools = [
         StructuredTool.from_function(
             name="investigate_item",
-            func=google_search.run,
+            func=condensed_search(get_google_search(), item_code),
             description="Use Google search to find information about the item code.",
         )
     ]
 
-    # Update the system message in the prompt
-    updated_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are an AI assistant tasked with gathering information about items."),
-        ("human", "I need information on an item with the code: {item_code}"),
-        ("system", "Certainly! I'll use the available tools to search for information about the item with code {item_code}. "
-                   "Please provide only factual information that you can verify. If you cannot find specific information, "
-                   "leave the field empty or set it to None. Do not generate or guess any information. "
-                   "Provide the following details:\n"
-                   "1. Validation of whether it's a valid item (true only if you can confirm it exists)\n"
-                   "2. The UNSPSC classification code (if available)\n"
-                   "3. The UNSPSC classification name (if available)\n"
-                   "4. The website (if a reliable source is found)\n"
-                   "5. Any additional relevant comments (factual information only)\n\n"
-                   "Format the information as follows:\n"
-                   "{format_instructions}"),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ])
-
-    agent = create_openai_functions_agent(llm, tools, updated_prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
-
-    result = agent_executor.invoke(
+    agent = create_openai_functions_agent(get_llm(), tools, get_prompt())
+    agent_executor = AgentExecutor(
+        agent=agent, tools=tools, verbose=agent_verbose(), max_execution_time=stages["agent"].timeout,
+        return_intermediate_steps=True,
+    )
+
+    result = run_stage(
+        "agent",
+        call_agent,
+        agent_executor.invoke,
         {
             "item_code": item_code,
-            "format_instructions": parser.get_format_instructions(),
-        }
+            "format_instructions": get_parser().get_format_instructions(),
+        },
+    )
+    store.record(item_code, "agent", agent_transcript(result))
+    parsed_data = get_parser().parse(result["output"])
+    detail("Processed item %s: %s", item_code, parsed_data)
+    return parsed_data
+
+
+def search_item(item_code: str) -> str:
+    """
+    Run the single Serper query for an item code, or skip it when the code is self-describing.
+
+    Args:
+        item_code (str): The code of the item.
+
+    Returns:
+        str: The condensed search context for the prompt.
+    """
+    if not needs_search(item_code):
+        return NO_SEARCH_RESULTS
+    query = build_item_query(item_code)
+    results = run_stage("search", call_search, get_google_search().results, query)
+    store.record(item_code, "search", {"query": query, "results": results})
+    return condense_results(results, terms_for(item_code), key=item_code)
+
+
+def classify_item(item_code: str, search_results: str, model=None) -> GetItemData:
+    """
+    Classify an item with exactly one structured-output completion.
+
+    Args:
+        item_code (str): The code of the item.
+        search_results (str): The context returned by search_item.
+        model: The ChatOpenAI client to use. Defaults to the mini model.
+
+    Returns:
+        GetItemData: The item data.
+    """
+    parsed_data = invoke_structured(
+        model or get_llm(), get_fast_prompt(), GetItemData, {"item_code": item_code, "search_results": search_results},
+        key=item_code,
     )
-    parsed_data = parser.parse(result["output"])
-    logging.info(f"Processed item {item_code}: {parsed_data}")
+    detail("Processed item %s (pipeline): %s", item_code, parsed_data)
     return parsed_data
 
 
-def get_items_to_process(cursor, batch_size):
+def process_item_code_fast(item_code: str) -> GetItemData:
+    """
+    Process the item code without the agent loop: one search, one completion.
+
+    Args:
+        item_code (str): The code of the item.
+
+    Returns:
+        GetItemData: The item data.
+    """
+    return classify_item(item_code, search_item(item_code))
+
+
+def classify_items_batch(item_codes: List[str], search_results: List[str], model=None) -> List[GetItemData | None]:
+    """
+    Classify several items with one structured-output completion.
+
+    Args:
+        item_codes (list): The codes of the items.
+        search_results (list): The context returned by search_item for each code.
+        model: The ChatOpenAI client to use. Defaults to the mini model.
+
+    Returns:
+        list: One GetItemData per item code, or None where the model gave no answer for it.
+    """
+    batch = invoke_structured(
+        model or get_llm(), get_batch_prompt(), GetItemDataBatch,
+        {"items": format_batch("Item code", item_codes, search_results)},
+    )
+    results = match_batch(item_codes, batch.results, "item_code")
+    for item_code, item_data in zip(item_codes, results):
+        if item_data is not None:
+            store.record(item_code, "llm", {"content": item_data.json()})
+    logging.info(f"Processed {len(item_codes)} items in one batch, {results.count(None)} unanswered")
+    return results
+
+
+def build_item_router() -> TieredRouter:
+    """
+    Build the tiered router for items: mini model without search, mini model
+    with search, then the larger model with search.
+
+    Returns:
+        TieredRouter: The router, with the AP_Items_For_Classification threshold.
+    """
+    return TieredRouter(
+        [
+            ("mini_no_search", lambda item_code: classify_item(item_code, NO_SEARCH_RESULTS)),
+            ("mini_search", process_item_code_fast),
+            ("large_search", lambda item_code: classify_item(item_code, search_item(item_code), get_escalation_llm())),
+        ],
+        threshold_for("AP_Items_For_Classification"),
+    )
+
+
+def get_items_to_process(cursor, batch_size, by_spend: bool = False, selected: bool = False):
     """
     Retrieve items that need processing from the database.
 
     Args:
         cursor: The database cursor.
         batch_size (int): The number of items to retrieve.
+        by_spend (bool): Order by spend-weighted priority, highest first, else by id. Requires
+            priority.refresh_priority(conn, "items") to have been run.
+        selected (bool): Only items staged by fingerprints.select_rows on this connection.
 
     Returns:
         list: A list of tuples containing (id, item_code) for items to process.
     """
-    query = """
-    SELECT id, item_code
-    FROM main.AP_Items_For_Classification
-    WHERE valid IS NULL
-    LIMIT ?
-    """
+    pending = PRIORITY_TARGETS["items"]["pending"].format(alias="i")
+    if selected:
+        pending += " AND " + SELECTED_ROWS.format(alias="i")
+    if by_spend:
+        query = f"""
+        SELECT i.id, i.item_code
+        FROM main.AP_Items_For_Classification i
+        {priority_join("items", "i")}
+        WHERE {pending}
+        ORDER BY COALESCE(p.weighted_spend, 0) DESC, i.id
+        LIMIT ?
+        """
+    else:
+        query = f"""
+        SELECT i.id, i.item_code
+        FROM main.AP_Items_For_Classification i
+        WHERE {pending}
+        ORDER BY i.id
+        LIMIT ?
+        """
     cursor.execute(query, (batch_size,))
     return cursor.fetchall()
 
@@ -186,6 +400,7 @@ def update_item_info(conn, item_id, item_data):
         )
         affected_rows = cursor.rowcount
         conn.commit()
+        write_levels(conn, "items", item_id, item_data.classification_code, item_data.classification_name)
         logging.info(f"Updated item {item_id}. Affected rows: {affected_rows}")
     except Exception as e:
         logging.error(f"Error updating item {item_id}: {str(e)}")
@@ -204,80 +419,309 @@ def get_classified_count(conn):
     return cursor.fetchone()[0]
 
 
-def process_single_item(id, item_code):
+def process_single_item(id, item_code, mode: str = "agent", router: TieredRouter | None = None):
     """
     Process a single item by retrieving and updating its information.
 
+    Every stage call for the row, including the agent fallback, shares one
+    row deadline, so a straggler cannot hold up its batch indefinitely. The
+    raw responses are recorded in the row's transcript under ``item_code``.
+
     Args:
         id: The ID of the item.
         item_code: The code of the item.
+        mode (str): "pipeline" tries the single-shot path first and falls back to
+            the agent; "routed" escalates through the router's tiers and falls back
+            to the agent; "agent" uses the agent only.
+        router (TieredRouter | None): The router used in "routed" mode.
 
     Returns:
         tuple: (bool, GetItemData) - Success status and item data
-    """
-    try:
-        print(f"Processing item: {item_code}")
 
-        # First attempt
+    Raises:
+        GuardError: If a circuit breaker or the run budget stops the run; these are not retried.
+    """
+    with row_deadline(), store.row("items", id), row_context("items", id, item_code):
         try:
-            item_data = process_item_code(item_code)
+            logging.info("Processing item: %s", item_code)
+
+            if mode == "pipeline":
+                try:
+                    return True, process_item_code_fast(item_code)
+                except GuardError:
+                    raise
+                except Exception as e:
+                    logging.warning("Pipeline mode failed for %s, falling back to agent: %s", item_code, e)
+
+            if mode == "routed":
+                try:
+                    return True, router.classify(item_code)
+                except GuardError:
+                    raise
+                except Exception as e:
+                    logging.warning("Routed mode failed for %s, falling back to agent: %s", item_code, e)
+
+            # First attempt
+            try:
+                item_data = process_item_code(item_code)
+            except GuardError:
+                raise
+            except Exception as e:
+                logging.warning("Error on first attempt for %s: %s", item_code, e)
+
+                # Second attempt with modified query
+                modified_item_code = item_code.split('(')[0].strip()
+                logging.info("Retrying with modified item code: %s", modified_item_code)
+                item_data = process_item_code(modified_item_code)
+
+            return True, item_data
+        except GuardError:
+            raise
         except Exception as e:
-            print(f"Error on first attempt for {item_code}: {str(e)}")
+            logging.error("Error processing item %s: %s", item_code, e)
+            return False, None
+
+def process_items_staged(max_items: int = 5, search_workers: int = 8, llm_workers: int = 8,
+                         buffer_size: int = 64, search_rate: float | None = None,
+                         by_spend: bool = True, half_life_days: float | None = None,
+                         db_path: str = DB_PATH, progress=None, ids: Iterable[Any] | None = None):
+    """
+    Process items through the staged search -> LLM -> writer pipeline.
 
-            # Second attempt with modified query
-            modified_item_code = item_code.split('(')[0].strip()
-            print(f"Retrying with modified item code: {modified_item_code}")
-            item_data = process_item_code(modified_item_code)
+    Searches for upcoming rows are prefetched into a bounded buffer while the
+    LLM stage works, so the Serper and OpenAI waits overlap.
+
+    Args:
+        max_items (int): The maximum number of items to process.
+        search_workers (int): Concurrency of the search stage.
+        llm_workers (int): Concurrency of the LLM stage.
+        buffer_size (int): Capacity of the prefetched search buffer.
+        search_rate (float | None): Maximum Serper calls per second.
+        by_spend (bool): Process the highest-spend items first and track spend coverage.
+        half_life_days (float | None): Recency half-life for the spend weighting.
+        db_path (str): The work database.
+        progress: Optional tracker whose ``update(success)`` is called for every written or failed row.
+        ids: Only process these item ids (e.g. the ones re-queued by reclassify).
+
+    Returns:
+        dict: Stage counters, queue-depth metrics and rows/sec.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    try:
+        coverage = None
+        if by_spend:
+            coverage = prepare_priority(conn, "items", half_life_days)
+            by_spend = coverage is not None
+        ensure_hash_columns(conn, "items")
+        ensure_level_columns(conn, "items")
+        ensure_spend_keys(conn)
+        if ids is not None:
+            select_rows(conn, ids)
+        items = get_items_to_process(conn.cursor(), max_items, by_spend, ids is not None)
+        item_codes = {str(id): item_code for id, item_code in items}
+
+        def write(item_id, item_data):
+            update_item_info(conn, float(item_id), item_data)
+            stamp(conn, "items", float(item_id), CLASSIFIER_VERSION)
+            store.save("items", item_id, item_codes[item_id], PROMPT_VERSION)
+            if coverage:
+                coverage.record(item_codes[item_id])
+            if progress:
+                progress.update(True)
+
+        def fail(item_id, key):
+            store.discard("items", item_id)
+            if progress:
+                progress.update(False)
+
+        pipeline = StagedPipeline(
+            search_fn=search_item,
+            classify_fn=classify_item,
+            write_fn=write,
+            fallback_fn=process_item_code,
+            search_workers=search_workers,
+            llm_workers=llm_workers,
+            buffer_size=buffer_size,
+            search_rate=search_rate,
+            fatal_errors=(GuardError,),
+            kind="items",
+            on_failure=fail,
+        )
+        stats = pipeline.run((str(id), item_code) for id, item_code in items)
+        stats["guards"] = guard_report()
+        stats["stages"] = stage_report()
+        stats["single_flight"] = flight_report()
+        stats["http"] = registry.stats()
+        if coverage:
+            stats["coverage"] = coverage.report()
+            logging.info(f"Spend coverage: {stats['coverage']}")
+        return stats
+    finally:
+        conn.close()
 
-        return True, item_data
-    except Exception as e:
-        print(f"Error processing item {item_code}: {str(e)}")
-        return False, None
 
-def process_items(batch_size: int = 5, max_items: int = 5):
-    conn = sqlite3.connect("spend_intake2.db", check_same_thread=False)
+def process_items(batch_size: int = 5, max_items: int = 5, mode: str = "agent",
+                  by_spend: bool = True, half_life_days: float | None = None,
+                  max_workers: int = MAX_WORKERS, db_path: str = DB_PATH, progress=None,
+                  ids: Iterable[Any] | None = None):
+    """
+    Process unclassified items in batches until ``max_items`` have been handled.
+
+    Args:
+        batch_size (int): The number of items fetched per batch.
+        max_items (int): The maximum number of items to process.
+        mode (str): "agent", "pipeline", "routed" or "staged"; see process_single_item.
+        by_spend (bool): Process the highest-spend items first and track spend coverage.
+        half_life_days (float | None): Recency half-life for the spend weighting.
+        max_workers (int): Items processed concurrently (search and LLM workers in staged mode).
+        db_path (str): The work database.
+        progress: Optional tracker whose ``update(success)`` is called for every finished item.
+        ids: Only process these item ids (e.g. the ones re-queued by reclassify).
+    """
+    if mode == "staged":
+        process_items_staged(max_items, search_workers=max_workers, llm_workers=max_workers,
+                             by_spend=by_spend, half_life_days=half_life_days, db_path=db_path,
+                             progress=progress, ids=ids)
+        return
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     cursor = conn.cursor()
+    router = build_item_router() if mode == "routed" else None
 
     try:
+        ensure_hash_columns(conn, "items")
+        ensure_level_columns(conn, "items")
+        ensure_spend_keys(conn)
+        if ids is not None:
+            select_rows(conn, ids)
+        coverage = None
+        if by_spend:
+            coverage = prepare_priority(conn, "items", half_life_days)
+            by_spend = coverage is not None
+
         total_processed = 0
-        while total_processed < max_items:
+        stopped = None
+        while total_processed < max_items and stopped is None:
             # Retrieve items that need processing
-            items = get_items_to_process(cursor, min(batch_size, max_items - total_processed))
+            items = get_items_to_process(cursor, min(batch_size, max_items - total_processed), by_spend,
+                                         ids is not None)
 
             if not items:
                 logging.info("No more items to process. Exiting.")
                 break
 
             # Use a thread pool to process items concurrently
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                futures = [
-                    executor.submit(process_single_item, str(id), item_code)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(process_single_item, str(id), item_code, mode, router): (id, item_code)
                     for id, item_code in items
-                ]
+                }
 
                 processed = 0
-                for future, (id, _) in zip(concurrent.futures.as_completed(futures), items):
-                    success, item_data = future.result()
+                for future in concurrent.futures.as_completed(futures):
+                    id, item_code = futures[future]
+                    try:
+                        success, item_data = future.result()
+                    except concurrent.futures.CancelledError:
+                        continue
+                    except GuardError as e:
+                        store.discard("items", id)
+                        # Stop dispatching; rows already in flight still finish and are written
+                        if stopped is None:
+                            stopped = e
+                            logging.error(f"Stopping run at item {id} ({item_code}): {e}")
+                            executor.shutdown(wait=False, cancel_futures=True)
+                        continue
+                    store.save("items", id, item_code, PROMPT_VERSION, "ok" if success else "failed")
                     if success and item_data:
                         update_item_info(conn, float(id), item_data)
+                        stamp(conn, "items", float(id), CLASSIFIER_VERSION)
+                        if coverage:
+                            coverage.record(item_code)
                     processed += 1
-                    logging.info(f"Processed item {id}: {'Success' if success else 'Failed'}")
+                    if progress:
+                        progress.update(success)
+                    logging.info("Processed item %s: %s", id, "Success" if success else "Failed")
 
             total_processed += processed
             logging.info(f"Processed {processed} out of {len(items)} items")
             logging.info(f"Total processed: {total_processed}")
-
-        logging.info(f"Reached maximum number of items to process ({max_items}). Exiting.")
+            if coverage:
+                logging.info(f"Spend classified: {coverage.percent():.1f}%")
+
+        if stopped is not None:
+            logging.error(f"Run stopped after {total_processed} items: {stopped}. {guard_report()}")
+        else:
+            logging.info(f"Reached maximum number of items to process ({max_items}). Exiting.")
+        if router:
+            logging.info(f"Routing report: {router.report()}")
+        if coverage:
+            logging.info(f"Spend coverage: {coverage.report()}")
+        stage_report()
+        flight_report()
+        registry.stats()
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logging.exception(f"An error occurred: {e}")
 
     finally:
         conn.close()
 
+def reparse_items(version: str | None = None, dry_run: bool = False, db_path: str = DB_PATH):
+    """
+    Rebuild the item result columns from stored transcripts without calling any API.
+
+    Args:
+        version (str | None): Only reparse transcripts from this prompt version.
+        dry_run (bool): Parse without writing.
+        db_path (str): The work database.
+
+    Returns:
+        dict: Counts of transcripts read, parsed, written and failed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_level_columns(conn, "items")
+        return reparse(
+            store, "items", GetItemData, get_parser(),
+            lambda item_id, item_data: update_item_info(conn, float(item_id), item_data),
+            version, dry_run,
+        )
+    finally:
+        conn.close()
+
+
+def reclassify_items(include_unhashed: bool = False, dry_run: bool = False, mode: str = "routed",
+                     db_path: str = DB_PATH, **options):
+    """
+    Re-queue and reprocess only the items whose inputs or classifier version changed.
+
+    Only the re-queued items are processed, in spend order; the rest of the
+    unclassified backlog is left alone.
+
+    Args:
+        include_unhashed (bool): Also redo items classified before input hashes were recorded.
+        dry_run (bool): Only count the changed items.
+        mode (str): The processing mode, see process_items.
+        db_path (str): The work database.
+        **options: Passed to process_items, e.g. ``max_workers`` or ``progress``.
+
+    Returns:
+        dict: Changed-item counts per reason and the number re-queued.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        counts, ids = reclassify(conn, "items", CLASSIFIER_VERSION, include_unhashed, dry_run)
+    finally:
+        conn.close()
+    if ids:
+        process_items(batch_size=1000, max_items=len(ids), mode=mode, db_path=db_path, ids=ids, **options)
+    return counts
+
+
 # Example usage
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    configure_logging()
     logging.info("Starting processing")
-    process_items(batch_size=1000, max_items=1000)  # Process up to 5 items total
+    process_items(batch_size=1000, max_items=1000, mode="routed")  # Process up to 1000 items total
     logging.info("Processing complete")
\ No newline at end of file
@@ -3,19 +3,33 @@ import csv
 import json
 import argparse
 import concurrent.futures
-import re  # Ensure this is imported
+import logging
+import threading
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
-from langchain.agents import AgentExecutor, create_openai_functions_agent
-from langchain.tools import StructuredTool
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_community.utilities import GoogleSerperAPIWrapper
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 
+from clients import registry
+from condense import condensed_search
+from contacts import extract_contacts
+from guards import GuardError, call_agent, call_search, guard_report
+from hedging import row_deadline, run_stage, stage_report, stages
+from logsetup import agent_verbose, configure_logging, detail, row_context
+from singleflight import coalesce, flight_report
+
 load_dotenv()
 
+# Terms that mark a snippet as useful for contact lookup, on top of the vendor name
+CONTACT_TERMS = "contact email phone sales accounts receivable billing"
+
+# Row-level concurrency and the results file; run profiles (see cli.py) override both
+MAX_WORKERS = 16
+OUTPUT_FILE = "output_results.csv"
+
+# How many vendors the local pass answered and how many needed the agent
+lookup_counts = {"local": 0, "agent": 0}
+_lookup_lock = threading.Lock()
+
 
 class EmailData(BaseModel):
     email: str
@@ -38,7 +52,13 @@ def extract_data_from_json(data: Dict[Any, Any]) -> Dict[str, Any]:
     }
 
     def extract_recursive(obj, current_key=""):
-        if isinstance(obj, dict):
+        if isinstance(obj, dict) and isinstance(obj.get("email"), str):
+            # {"email": ..., "type": "individual"} entries keep their type
+            result["emails"].append({"email": obj["email"], "type": str(obj.get("type", "unknown"))})
+            for key, value in obj.items():
+                if key not in ("email", "type"):
+                    extract_recursive(value, key)
+        elif isinstance(obj, dict):
             for key, value in obj.items():
                 extract_recursive(value, key)
         elif isinstance(obj, list):
@@ -59,19 +79,26 @@ def extract_data_from_json(data: Dict[Any, Any]) -> Dict[str, Any]:
 
 
 def clean_and_parse_output(output: str) -> dict:
-    # Try to extract JSON from the output
-    json_match = re.search(r'\{.*\}', output, re.DOTALL)
-    if json_match:
-        json_str = json_match.group(0)
+    # Take the first complete JSON object in the output; prose or a second object after it is ignored
+    decoder = json.JSONDecoder()
+    start = output.find("{")
+    while start != -1:
         try:
-            data = json.loads(json_str)
+            data, _ = decoder.raw_decode(output, start)
+        except json.JSONDecodeError:
+            start = output.find("{", start + 1)
+            continue
+        if isinstance(data, dict):
+            if not isinstance(data.get("emails"), list) or not isinstance(data.get("phone_numbers"), list):
+                # Nested or differently named fields, e.g. {"contact": {"email": ...}}
+                extracted = extract_data_from_json(data)
+                data = {**extracted, "company": data.get("company") or extracted["company"]}
             # Ensure all required fields are present
-            data.setdefault('company', 'Unknown')
+            data['company'] = data.get('company') or 'Unknown'
             data.setdefault('emails', [])
             data.setdefault('phone_numbers', [])
             return data
-        except json.JSONDecodeError:
-            pass
+        start = output.find("{", start + 1)
 
     # If JSON extraction fails, create a minimal valid structure
     return {
@@ -81,19 +108,25 @@ def clean_and_parse_output(output: str) -> dict:
     }
 
 
-from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate
-
-
 def process_item_code(item_code: str, prompt: str) -> str:
+    from langchain.agents import AgentExecutor, create_openai_functions_agent
+    from langchain_core.output_parsers import PydanticOutputParser
+    from langchain_core.prompts import (
+        ChatPromptTemplate, HumanMessagePromptTemplate, MessagesPlaceholder, SystemMessagePromptTemplate
+    )
+    from langchain_core.tools import StructuredTool
+    from langchain_openai import ChatOpenAI
+
+    # The fixed line below keeps its own client: moving it onto clients.registry needs the owner's sign-off
     llm = ChatOpenAI(model="gpt-4o-mini-2024-07-18",
                      api_key=os.environ.get("OPENAI_API_KEY"))  # do not ever modify this line
-    google_search = GoogleSerperAPIWrapper(api_key=os.environ.get("SERPER_API_KEY"))
+    google_search = registry.serper()
     parser = PydanticOutputParser(pydantic_object=GetItemData)
 
     tools = [
         StructuredTool.from_function(
             name="investigate_item",
-            func=google_search.run,
+            func=condensed_search(google_search, item_code, CONTACT_TERMS),
             description="Use Google search to find information about a point of contact for a company in question.",
         )
     ]
@@ -116,19 +149,64 @@ def process_item_code(item_code: str, prompt: str) -> str:
     ])
 
     agent = create_openai_functions_agent(llm, tools, chat_prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
+    agent_executor = AgentExecutor(
+        agent=agent, tools=tools, verbose=agent_verbose(), max_execution_time=stages["agent"].timeout
+    )
 
     try:
-        result = agent_executor.invoke({
+        result = run_stage("agent", call_agent, agent_executor.invoke, {
             "item_code": item_code,
             "format_instructions": parser.get_format_instructions()
         })
         return result.get("output", "")
+    except GuardError:
+        raise
     except Exception as e:
-        print(f"Error processing item_code {item_code}: {e}")
+        logging.error("Error processing item_code %s: %s", item_code, e)
         return ""  # Return an empty string or handle the error appropriately
 
 
+def search_contacts(vendor: str) -> Dict[str, Any]:
+    """Run one Serper query for the vendor's contact details and return the raw response."""
+    return run_stage("search", call_search, registry.serper().results, f"{vendor} {CONTACT_TERMS}")
+
+
+@coalesce("contacts")
+def lookup_contacts(vendor: str, prompt: str) -> dict:
+    """
+    Find a vendor's contact details, locally from one search when possible, else with the agent.
+
+    Args:
+        vendor (str): The vendor name.
+        prompt (str): The custom prompt (currently unused by the agent).
+
+    Returns:
+        dict: ``company``, ``emails``, ``phone_numbers`` and, when found, ``address`` and ``citation``.
+    """
+    try:
+        contacts = extract_contacts(search_contacts(vendor), vendor)
+    except GuardError:
+        raise
+    except Exception as e:
+        logging.warning("Local contact search failed for %s, using the agent: %s", vendor, e)
+        contacts = None
+    with _lookup_lock:
+        lookup_counts["local" if contacts else "agent"] += 1
+    if contacts:
+        return contacts
+    return clean_and_parse_output(process_item_code(vendor, prompt))
+
+
+def lookup_report() -> Dict[str, Any]:
+    """Summarise how many vendors the local pass answered, e.g. for the end-of-run log."""
+    with _lookup_lock:
+        report = dict(lookup_counts)
+    total = report["local"] + report["agent"]
+    report["local_rate"] = round(report["local"] / total, 3) if total else 0.0
+    logging.info(f"Contact lookup report: {report}")
+    return report
+
+
 def get_items_from_csv(csv_file: str) -> list[tuple]:
     items = []
     with open(csv_file, 'r') as file:
@@ -140,78 +218,108 @@ def get_items_from_csv(csv_file: str) -> list[tuple]:
 
 
 def process_single_item(id, vendor, prompt, output_csv):
-    try:
-        print(f"Processing vendor: {vendor}")
-        item_data = process_item_code(vendor, prompt)
-        print(f"Information for vendor {vendor}:")
-        print(item_data)
-
-        # Parse the JSON data
-        parsed_data = clean_and_parse_output(item_data)
-
-        # Extract relevant information
-        company = parsed_data.get('company', vendor)
-        emails = parsed_data.get('emails', [])
-        phone_numbers = parsed_data.get('phone_numbers', [])
-
-        # Determine if it's an individual or company contact
-        contact_type = 'individual' if any(e.get('type') == 'individual' for e in emails) else 'company'
-
-        # Get the first email and phone number (if available)
-        email = emails[0].get('email', 'N/A') if emails else 'N/A'
-        phone = phone_numbers[0] if phone_numbers else 'N/A'
-
-        # Write to CSV
-        output_csv.writerow([
-            id,
-            company,
-            contact_type,
-            "N/A",  # contact name
-            phone,
-            email,
-            "Google Search"  # citation
-        ])
-
-        return True
-    except Exception as e:
-        print(f"Error processing vendor {vendor}: {e}")
-        return False
-
-
-def process_items(id: str, varlookup: str, csv_file: str, prompt: str):
+    with row_deadline(), row_context("contacts", id, vendor):
+        try:
+            logging.info("Processing vendor: %s", vendor)
+            parsed_data = lookup_contacts(vendor, prompt)
+            detail("Information for vendor %s: %s", vendor, parsed_data)
+
+            # Extract relevant information
+            company = parsed_data.get('company', vendor)
+            emails = parsed_data.get('emails', [])
+            phone_numbers = parsed_data.get('phone_numbers', [])
+
+            # Determine if it's an individual or company contact
+            contact_type = 'individual' if any(e.get('type') == 'individual' for e in emails) else 'company'
+
+            # Get the first email and phone number (if available)
+            email = emails[0].get('email', 'N/A') if emails else 'N/A'
+            phone = phone_numbers[0] if phone_numbers else 'N/A'
+
+            # Write to CSV
+            output_csv.writerow([
+                id,
+                company,
+                contact_type,
+                "N/A",  # contact name
+                phone,
+                email,
+                parsed_data.get('citation', "Google Search")
+            ])
+
+            return True
+        except GuardError:
+            raise
+        except Exception as e:
+            logging.error("Error processing vendor %s: %s", vendor, e)
+            return False
+
+
+def process_items(id: str, csv_file: str, prompt: str, max_workers: int = MAX_WORKERS,
+                  output_file: str = OUTPUT_FILE, progress=None):
+    """
+    Look up contacts for one vendor or all vendors in a CSV and write them to ``output_file``.
+
+    Args:
+        id (str): The vendor ID to process, or "all".
+        csv_file (str): Input CSV of (id, vendor) rows with a header.
+        prompt (str): The custom prompt (currently unused by the agent).
+        max_workers (int): Vendors processed concurrently.
+        output_file (str): Where the results CSV is written.
+        progress: Optional tracker whose ``update(success)`` is called for every finished vendor.
+    """
     items = get_items_from_csv(csv_file)
 
-    output_file = 'output_results.csv'
     with open(output_file, 'w', newline='') as csvfile:
         csv_writer = csv.writer(csvfile)
         csv_writer.writerow(['id', 'vendor', 'real', 'contact name', 'contact phone', 'contact email', 'citation'])
 
         if id.lower() == 'all':
-            with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-                futures = [
-                    executor.submit(process_single_item, item_id, vendor, prompt, csv_writer)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(process_single_item, item_id, vendor, prompt, csv_writer): vendor
                     for item_id, vendor in items
-                ]
-                successful = sum(future.result() for future in concurrent.futures.as_completed(futures))
-            print(f"Successfully processed {successful} out of {len(items)} items")
+                }
+                successful = 0
+                stopped = None
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        success = future.result()
+                        successful += success
+                        if progress:
+                            progress.update(success)
+                    except concurrent.futures.CancelledError:
+                        continue
+                    except GuardError as e:
+                        if stopped is None:
+                            stopped = e
+                            logging.warning(f"Stopping run at vendor {futures[future]}: {e}")
+                            executor.shutdown(wait=False, cancel_futures=True)
+            logging.info(f"Successfully processed {successful} out of {len(items)} items")
+            if stopped is not None:
+                logging.warning(f"Run stopped: {stopped}. {guard_report()}")
+            lookup_report()
+            stage_report()
+            flight_report()
+            registry.stats()
         else:
             for item_id, vendor in items:
                 if item_id == id:
                     process_single_item(item_id, vendor, prompt, csv_writer)
                     break
             else:
-                print(f"No item found with ID: {id}")
+                logging.warning(f"No item found with ID: {id}")
 
-    print(f"Results have been written to {output_file}")
+    logging.info(f"Results have been written to {output_file}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process items based on input arguments.")
     parser.add_argument("id", help="The ID to process (or 'all' for all items)")
-    parser.add_argument("varlookup", help="The variable to look up")
     parser.add_argument("csv", help="Path to the input CSV file")
     parser.add_argument("--prompt", help="The custom prompt to use for processing", default="")
 
     args = parser.parse_args()
 
-    process_items(args.id, args.varlookup, args.csv, args.prompt)
+    configure_logging()
+    process_items(args.id, args.csv, args.prompt)
@@ -0,0 +1,217 @@
+"""
+assistant_runs.py
+
+A headless counterpart to utils.OpenAIManager for bulk use: no Streamlit
+session state or containers, many Assistants runs in flight at once under a
+concurrency limit, and a structured result per supplier.
+
+Runs are polled rather than streamed, so tool calls are answered with a plain
+submit-and-poll loop instead of a nested EventHandler per submission. Threads
+are either deleted after each run or wiped and reused from a small pool.
+"""
+
+import concurrent.futures
+import json
+import logging
+import queue
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+from guards import GuardError, breakers, budget
+
+# Config
+INVESTIGATE_MESSAGE = "Please investigate: {supplier_name}. Please respond with JSON"
+DEFAULT_CONCURRENCY = 8
+POLL_INTERVAL_MS = 500
+ASSISTANT_TOKEN_ESTIMATE = 8000  # reserved from the run budget per run until it settles
+RUN_ERROR_STATUS = {"server_error": 500, "rate_limit_exceeded": 429}
+
+
+class RunFailed(RuntimeError):
+    """A run that ended failed or expired, with the HTTP-like status the breaker classifies it by."""
+
+    def __init__(self, run):
+        error = run.last_error
+        super().__init__(f"Run {run.id} {run.status}: {error.message if error else ''}")
+        # An expired run timed out on the provider's side; a failed one counts only for server or rate-limit errors
+        self.status_code = 504 if run.status == "expired" else RUN_ERROR_STATUS.get(error.code if error else None, 400)
+
+
+def parse_response(text: str) -> Dict[str, Any]:
+    """Parse an assistant message as JSON, keeping the raw text when it isn't."""
+    try:
+        parsed = json.loads(text)
+    except json.JSONDecodeError:
+        return {"text": text}
+    return parsed if isinstance(parsed, dict) else {"value": parsed}
+
+
+def record_classification(arguments: Dict[str, Any]) -> str:
+    """Default handler for the get_vendor_classification tool: the arguments are the answer."""
+    return json.dumps({"received": True})
+
+
+class HeadlessAssistantManager:
+    """
+    Run the classification assistant for many suppliers concurrently, without Streamlit.
+
+    Args:
+        client: The OpenAI client.
+        assistant_id (str): The Assistant to run.
+        max_concurrency (int): Maximum runs in flight at once.
+        reuse_threads (bool): Wipe and reuse threads instead of deleting them after each run.
+        tool_handlers (dict | None): Function name -> ``handler(arguments) -> output`` for
+            tool calls. Defaults to recording get_vendor_classification arguments.
+        poll_interval_ms (int): How often runs are polled.
+    """
+
+    def __init__(self, client, assistant_id: str, max_concurrency: int = DEFAULT_CONCURRENCY,
+                 reuse_threads: bool = False, tool_handlers: Dict[str, Callable[[Dict[str, Any]], str]] | None = None,
+                 poll_interval_ms: int = POLL_INTERVAL_MS):
+        self.client = client
+        self.assistant_id = assistant_id
+        self.max_concurrency = max_concurrency
+        self.reuse_threads = reuse_threads
+        self.tool_handlers = tool_handlers or {"get_vendor_classification": record_classification}
+        self.poll_interval_ms = poll_interval_ms
+        self.idle_threads: queue.SimpleQueue = queue.SimpleQueue()
+
+    def _acquire_thread(self) -> str:
+        if self.reuse_threads:
+            try:
+                return self.idle_threads.get_nowait()
+            except queue.Empty:
+                pass
+        return self.client.beta.threads.create().id
+
+    def _release_thread(self, thread_id: str):
+        """Delete the thread, or wipe its messages and return it to the pool."""
+        try:
+            if not self.reuse_threads:
+                self.client.beta.threads.delete(thread_id)
+                return
+            for message in self.client.beta.threads.messages.list(thread_id=thread_id):
+                self.client.beta.threads.messages.delete(message.id, thread_id=thread_id)
+            self.idle_threads.put(thread_id)
+        except Exception as e:
+            logging.warning(f"Could not clean up thread {thread_id}: {e}")
+
+    def _handle_tool_calls(self, run, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        tool_outputs = []
+        for tool in run.required_action.submit_tool_outputs.tool_calls:
+            handler = self.tool_handlers.get(tool.function.name)
+            try:
+                arguments = json.loads(tool.function.arguments or "{}")
+            except json.JSONDecodeError as e:
+                arguments = {"error": f"Invalid arguments: {e}", "raw": tool.function.arguments}
+            tool_calls.append({"name": tool.function.name, "arguments": arguments})
+            output = handler(arguments) if handler else json.dumps({"error": f"Unknown tool {tool.function.name}"})
+            tool_outputs.append({"tool_call_id": tool.id, "output": output})
+        return tool_outputs
+
+    def _run(self, thread_id: str, supplier_name: str, spend: Dict[str, int]) -> Dict[str, Any]:
+        self.client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=INVESTIGATE_MESSAGE.format(supplier_name=supplier_name)
+        )
+        run = self.client.beta.threads.runs.create_and_poll(
+            thread_id=thread_id, assistant_id=self.assistant_id, poll_interval_ms=self.poll_interval_ms
+        )
+        tool_calls = []
+        while run.status == "requires_action":
+            run = self.client.beta.threads.runs.submit_tool_outputs_and_poll(
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=self._handle_tool_calls(run, tool_calls),
+                poll_interval_ms=self.poll_interval_ms,
+            )
+
+        if run.usage:
+            spend["tokens"] = run.usage.total_tokens
+        if run.status in ("failed", "expired"):
+            raise RunFailed(run)
+
+        responses = []
+        if run.status == "completed":
+            messages = self.client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id, order="asc")
+            for message in messages:
+                for content in message.content:
+                    if content.type == "text":
+                        responses.append(parse_response(content.text.value))
+
+        return {
+            "status": run.status,
+            "run_id": run.id,
+            "responses": responses,
+            "tool_calls": tool_calls,
+            "error": None,
+            "tokens": run.usage.total_tokens if run.usage else 0,
+        }
+
+    def process_supplier(self, supplier_name: str) -> Dict[str, Any]:
+        """
+        Run the assistant for one supplier.
+
+        Args:
+            supplier_name (str): The supplier to investigate.
+
+        Returns:
+            dict: supplier_name, status, run_id, responses (parsed messages),
+            tool_calls (name and parsed arguments), error, tokens and seconds.
+
+        Raises:
+            GuardError: If the assistants circuit or the run budget stops the run.
+        """
+        started = time.monotonic()
+        reservation = budget.reserve(tokens=ASSISTANT_TOKEN_ESTIMATE)
+        spend = {"tokens": 0}
+        try:
+            thread_id = self._acquire_thread()
+            try:
+                result = breakers["assistants"].call(self._run, thread_id, supplier_name, spend)
+            finally:
+                self._release_thread(thread_id)
+        finally:
+            budget.settle(reservation, tokens=spend["tokens"])
+        return {"supplier_name": supplier_name, **result, "seconds": round(time.monotonic() - started, 2)}
+
+    def process_suppliers(self, supplier_names: Iterable[str]) -> List[Dict[str, Any]]:
+        """
+        Run the assistant for many suppliers, at most ``max_concurrency`` at a time.
+
+        A failed supplier gets a result with status "failed"; a GuardError stops
+        dispatching and the remaining suppliers get status "cancelled".
+
+        Args:
+            supplier_names: The suppliers to investigate.
+
+        Returns:
+            list: One result per supplier, in input order.
+        """
+        supplier_names = list(supplier_names)
+        results: List[Dict[str, Any] | None] = [None] * len(supplier_names)
+        stopped = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(self.process_supplier, name): position
+                for position, name in enumerate(supplier_names)
+            }
+            for future in concurrent.futures.as_completed(futures):
+                position = futures[future]
+                name = supplier_names[position]
+                try:
+                    results[position] = future.result()
+                except concurrent.futures.CancelledError:
+                    results[position] = {"supplier_name": name, "status": "cancelled", "error": str(stopped)}
+                except GuardError as e:
+                    results[position] = {"supplier_name": name, "status": "cancelled", "error": str(e)}
+                    if stopped is None:
+                        stopped = e
+                        logging.error(f"Stopping assistant runs at {name}: {e}")
+                        executor.shutdown(wait=False, cancel_futures=True)
+                except Exception as e:
+                    logging.error(f"Assistant run failed for {name}: {e}")
+                    results[position] = {"supplier_name": name, "status": "failed", "error": str(e)}
+
+        completed = sum(1 for result in results if result["status"] == "completed")
+        logging.info(f"Assistant runs completed for {completed} of {len(results)} suppliers")
+        return results
@@ -0,0 +1,350 @@
+"""
+cli.py
+
+One entry point for the three pipelines: ``autoclassed run items|suppliers|contacts``
+(or ``python cli.py run ...``), plus ``reclassify`` and ``reparse`` for items
+and suppliers against the same profile's database.
+
+Settings come from a TOML run profile so concurrency, batch size, limits and
+paths can be tuned per environment without editing source. A profile has a
+``[run]`` table shared by all pipelines and optional ``[items]``,
+``[suppliers]`` and ``[contacts]`` tables that override it; command-line flags
+override both. While a run is in flight a status line reports rows done,
+throughput and ETA.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import tomllib
+from typing import Any, Dict, TextIO
+
+# Config
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PIPELINES = ("items", "suppliers", "contacts")
+DEFAULTS: Dict[str, Any] = {
+    "mode": "routed",  # items and suppliers: agent, pipeline, routed or staged
+    "concurrency": 16,
+    "batch_size": 1000,  # items fetched per batch; suppliers are fetched in one batch of `limit`
+    "limit": 1000,
+    "by_spend": True,
+    "db_path": "spend_intake2.db",
+    "transcript_db": "transcripts.db",
+    "llm_cache": "",  # SQLite file for LangChain's LLM cache; empty disables it
+    "csv": "",  # contacts: input CSV of (id, vendor) rows
+    "output": "output_results.csv",  # contacts: results CSV
+    "id": "all",  # contacts: one vendor ID, or all
+    "dry_run": False,
+    "log_level": "INFO",
+    "log_format": "text",  # "text", or "json" for one searchable object per line
+    "log_file": "",  # also write the log here; empty for stderr only
+    "log_sample_rate": 0.01,  # share of rows whose full results are logged
+    "agent_verbose": False,  # print LangChain's agent trace
+    "progress_interval": 2.0,
+}
+
+
+def load_profile(profile: str | None, pipeline: str, overrides: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """
+    Resolve the settings for one run.
+
+    Args:
+        profile (str | None): A TOML file, or the name of one in ``profiles/``. None uses the defaults.
+        pipeline (str): "items", "suppliers" or "contacts".
+        overrides (dict | None): Command-line values; None values are ignored.
+
+    Returns:
+        dict: DEFAULTS updated by the profile's [run] table, its pipeline table and the overrides.
+
+    Raises:
+        FileNotFoundError: If the profile does not exist.
+        ValueError: If the profile sets an unknown key.
+    """
+    settings = dict(DEFAULTS)
+    if profile:
+        path = profile if os.path.exists(profile) else os.path.join(PROFILE_DIR, f"{profile}.toml")
+        with open(path, "rb") as f:
+            data = tomllib.load(f)
+        for table in ("run", pipeline):
+            values = data.get(table, {})
+            unknown = set(values) - set(DEFAULTS)
+            if unknown:
+                raise ValueError(f"Unknown setting(s) in [{table}] of {path}: {', '.join(sorted(unknown))}")
+            settings.update(values)
+    settings.update({key: value for key, value in (overrides or {}).items() if value is not None})
+    return settings
+
+
+def format_duration(seconds: float | None) -> str:
+    """Format seconds as e.g. ``1h02m``, ``3m05s`` or ``42s``; ``?`` when unknown."""
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class Progress:
+    """
+    Thread-safe row counter that prints live throughput and ETA.
+
+    The pipelines call ``update(success)`` once per finished row; the status
+    line is redrawn at most every ``interval`` seconds.
+
+    Args:
+        label (str): Shown at the start of the line, e.g. "items".
+        total (int): Rows expected in this run.
+        interval (float): Minimum seconds between redraws.
+        stream: Where the status line is written.
+    """
+
+    def __init__(self, label: str, total: int, interval: float = 2.0, stream: TextIO | None = None):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_render = 0.0
+        self.done = 0
+        self.failed = 0
+
+    def update(self, success: bool = True):
+        with self.lock:
+            self.done += 1
+            if not success:
+                self.failed += 1
+            now = time.monotonic()
+            if now - self.last_render < self.interval:
+                return
+            self.last_render = now
+        self.render()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            done, failed = self.done, self.failed
+        elapsed = time.monotonic() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - done, 0)
+        return {
+            "done": done,
+            "failed": failed,
+            "total": self.total,
+            "rows_per_sec": round(rate, 2),
+            "elapsed": round(elapsed, 1),
+            "eta": remaining / rate if rate else None,
+        }
+
+    def render(self, final: bool = False):
+        stats = self.snapshot()
+        line = (
+            f"{self.label}: {stats['done']}/{stats['total']} ({stats['failed']} failed) "
+            f"{stats['rows_per_sec']:.2f} rows/s, "
+            + (f"took {format_duration(stats['elapsed'])}" if final else f"ETA {format_duration(stats['eta'])}")
+        )
+        self.stream.write(line + "\n")
+        self.stream.flush()
+
+
+def pending_rows(pipeline: str, settings: Dict[str, Any]) -> list:
+    """
+    List the rows this run would process (at most ``limit``), without calling any API or writing to the database.
+
+    Returns:
+        list: (id, item code / supplier name / vendor) tuples.
+    """
+    if pipeline == "contacts":
+        from agent_modular import get_items_from_csv
+
+        rows = get_items_from_csv(settings["csv"])
+        if str(settings["id"]).lower() != "all":
+            rows = [row for row in rows if row[0] == str(settings["id"])]
+        return rows
+
+    import sqlite3
+    from pathlib import Path
+
+    from priority import has_spend, preview_priority
+
+    # Read-only: the ordering is previewed in a temp table rather than refreshed in the database
+    conn = sqlite3.connect(f"{Path(settings['db_path']).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        # Same order as the run: highest spend first when there is spend to rank by
+        by_spend = bool(settings["by_spend"]) and has_spend(conn) and preview_priority(conn, pipeline)
+        if pipeline == "items":
+            from agent_item import get_items_to_process
+
+            return get_items_to_process(conn.cursor(), settings["limit"], by_spend)
+        from agent_company import get_suppliers_without_classification
+        from spend_keys import supplier_key
+        from supplier_inference import infer_supplier_classifications
+
+        # The run classifies these by inference before any agent call, so they are not work left
+        inferred = set(infer_supplier_classifications(conn, dry_run=True)["supplier_key"])
+        rows = get_suppliers_without_classification(conn.cursor(), settings["limit"] + len(inferred), by_spend)
+        return [row for row in rows if supplier_key(row[1]) not in inferred][:settings["limit"]]
+    finally:
+        conn.close()
+
+
+def configure(settings: Dict[str, Any]):
+    """Point the transcript store and the optional LLM cache at the profile's paths."""
+    from transcripts import store
+
+    store.path = settings["transcript_db"]
+    if settings["llm_cache"]:
+        from langchain.globals import set_llm_cache
+        from langchain_community.cache import SQLiteCache
+
+        set_llm_cache(SQLiteCache(database_path=settings["llm_cache"]))
+
+
+def run(pipeline: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run one pipeline with resolved settings.
+
+    Args:
+        pipeline (str): "items", "suppliers" or "contacts".
+        settings (dict): See load_profile.
+
+    Returns:
+        dict: The final progress snapshot, or the planned rows for a dry run.
+    """
+    rows = pending_rows(pipeline, settings)
+    if settings["dry_run"]:
+        logging.info(f"Dry run: {len(rows)} {pipeline} would be processed with {settings}")
+        for row in rows[:10]:
+            logging.info(f"  {row}")
+        return {"planned": len(rows)}
+
+    configure(settings)
+    progress = Progress(pipeline, len(rows), settings["progress_interval"])
+    if pipeline == "items":
+        from agent_item import process_items
+
+        process_items(settings["batch_size"], settings["limit"], settings["mode"], settings["by_spend"],
+                      max_workers=settings["concurrency"], db_path=settings["db_path"], progress=progress)
+    elif pipeline == "suppliers":
+        from agent_company import process_suppliers
+
+        process_suppliers(settings["limit"], settings["mode"], settings["by_spend"],
+                          max_workers=settings["concurrency"], db_path=settings["db_path"], progress=progress)
+    else:
+        from agent_modular import process_items as process_contacts
+
+        process_contacts(str(settings["id"]), settings["csv"], "", max_workers=settings["concurrency"],
+                         output_file=settings["output"], progress=progress)
+    progress.render(final=True)
+    return progress.snapshot()
+
+
+def reclassify(pipeline: str, settings: Dict[str, Any], include_unhashed: bool = False) -> Dict[str, int]:
+    """
+    Re-queue and reprocess only the rows whose inputs or classifier version changed.
+
+    Args:
+        pipeline (str): "items" or "suppliers".
+        settings (dict): See load_profile; ``dry_run`` only counts the changed rows.
+        include_unhashed (bool): Also redo rows classified before input hashes were recorded.
+
+    Returns:
+        dict: Changed-row counts per reason and the number re-queued.
+    """
+    configure(settings)
+    options = {"db_path": settings["db_path"], "max_workers": settings["concurrency"]}
+    if pipeline == "items":
+        from agent_item import reclassify_items
+
+        return reclassify_items(include_unhashed, settings["dry_run"], settings["mode"], **options)
+    from agent_company import reclassify_suppliers
+
+    return reclassify_suppliers(include_unhashed, settings["dry_run"], settings["mode"], **options)
+
+
+def reparse(pipeline: str, settings: Dict[str, Any], version: str | None = None) -> Dict[str, int]:
+    """
+    Rebuild result columns from stored transcripts without calling any API.
+
+    Args:
+        pipeline (str): "items" or "suppliers".
+        settings (dict): See load_profile; ``dry_run`` parses without writing.
+        version (str | None): Only reparse transcripts from this prompt version.
+
+    Returns:
+        dict: Counts of transcripts read, parsed, written and failed.
+    """
+    configure(settings)
+    if pipeline == "items":
+        from agent_item import reparse_items
+
+        return reparse_items(version, settings["dry_run"], settings["db_path"])
+    from agent_company import reparse_suppliers
+
+    return reparse_suppliers(version, settings["dry_run"], settings["db_path"])
+
+
+def main(argv: list | None = None) -> int:
+    arg_parser = argparse.ArgumentParser(prog="autoclassed", description="Run the AutoClassed pipelines.")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    run_command = commands.add_parser("run", help="Classify items or suppliers, or look up supplier contacts")
+    run_command.add_argument("pipeline", choices=PIPELINES)
+    run_command.add_argument("--profile", help="TOML profile file, or a profile name in profiles/")
+    run_command.add_argument("--mode", choices=["agent", "pipeline", "routed", "staged"])
+    run_command.add_argument("--concurrency", type=int)
+    run_command.add_argument("--batch-size", type=int)
+    run_command.add_argument("--limit", type=int)
+    run_command.add_argument("--db-path")
+    run_command.add_argument("--transcript-db")
+    run_command.add_argument("--llm-cache")
+    run_command.add_argument("--csv", help="Contacts input CSV")
+    run_command.add_argument("--output", help="Contacts results CSV")
+    run_command.add_argument("--id", help="Contacts: one vendor ID instead of all")
+    run_command.add_argument("--log-format", choices=["text", "json"])
+    run_command.add_argument("--log-file")
+    run_command.add_argument("--dry-run", action="store_true", default=None,
+                             help="List the rows that would be processed without calling any API")
+    reclassify_command = commands.add_parser("reclassify", help="Redo only rows whose inputs or classifier changed")
+    reclassify_command.add_argument("pipeline", choices=["items", "suppliers"])
+    reclassify_command.add_argument("--include-unhashed", action="store_true",
+                                    help="Also redo rows classified before input hashes were recorded")
+    reparse_command = commands.add_parser("reparse", help="Rebuild result columns from stored transcripts")
+    reparse_command.add_argument("pipeline", choices=["items", "suppliers"])
+    reparse_command.add_argument("--prompt-version", help="Only reparse transcripts from this prompt version")
+    for command in (reclassify_command, reparse_command):
+        command.add_argument("--profile", help="TOML profile file, or a profile name in profiles/")
+        command.add_argument("--db-path")
+        command.add_argument("--transcript-db")
+        command.add_argument("--dry-run", action="store_true", default=None,
+                             help="Only count (reclassify) or parse (reparse) without writing")
+    reclassify_command.add_argument("--mode", choices=["agent", "pipeline", "routed", "staged"])
+    reclassify_command.add_argument("--concurrency", type=int)
+    args = arg_parser.parse_args(argv)
+
+    options = ("command", "pipeline", "profile", "include_unhashed", "prompt_version")
+    overrides = {key: value for key, value in vars(args).items() if key not in options}
+    settings = load_profile(args.profile, args.pipeline, overrides)
+    from logsetup import configure_logging
+
+    configure_logging(settings["log_format"], settings["log_level"], settings["log_file"],
+                      settings["log_sample_rate"], settings["agent_verbose"])
+    if args.command == "reclassify":
+        reclassify(args.pipeline, settings, args.include_unhashed)
+        return 0
+    if args.command == "reparse":
+        reparse(args.pipeline, settings, args.prompt_version)
+        return 0
+    if args.pipeline == "contacts" and not settings["csv"]:
+        arg_parser.error("the contacts pipeline needs --csv or `csv` in the profile")
+
+    run(args.pipeline, settings)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+clients.py
+
+One registry of pooled HTTP clients shared by every agent and by
+utils.OpenAIManager, so OpenAI and Serper calls reuse warm keep-alive
+connections instead of paying a TCP and TLS handshake per client.
+
+Each upstream ("openai", "serper") gets one sync and one async httpx client
+with tuned pool limits, connect/read timeouts and HTTP/2 when the ``h2``
+package is installed. ``registry.stats()`` reports requests, new connections,
+TLS handshakes and the current pool size per upstream.
+"""
+
+import functools
+import importlib.util
+import logging
+import os
+import threading
+from typing import Any, Dict
+
+# httpx and LangChain are imported when the first client is built, keeping imports cheap
+
+# Config
+CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "60"))
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", "32"))
+KEEPALIVE_EXPIRY = 30.0
+HTTP2 = os.environ.get("HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+SERPER_URL = "https://google.serper.dev"
+
+
+class PoolStats:
+    """
+    Counts requests, new TCP connections and TLS handshakes for one upstream
+    through httpx request hooks and the httpcore ``trace`` extension.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "new_connections": 0, "tls_handshakes": 0}
+
+    def _count(self, event_name: str):
+        with self.lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.counts["new_connections"] += 1
+            elif event_name == "connection.start_tls.complete":
+                self.counts["tls_handshakes"] += 1
+
+    def on_request(self, request):
+        with self.lock:
+            self.counts["requests"] += 1
+        request.extensions["trace"] = lambda event_name, info: self._count(event_name)
+
+    async def on_async_request(self, request):
+        with self.lock:
+            self.counts["requests"] += 1
+
+        async def trace(event_name, info):
+            self._count(event_name)
+
+        request.extensions["trace"] = trace
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            counts = dict(self.counts)
+        requests = counts["requests"]
+        counts["reuse_rate"] = round(1 - counts["new_connections"] / requests, 3) if requests else 0.0
+        return counts
+
+
+def _pool_size(client) -> Dict[str, int]:
+    """Open and idle connections in a client's pool (best effort: httpx keeps the pool private)."""
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    return {
+        "open_connections": len(connections),
+        "idle_connections": sum(1 for connection in connections if connection.is_idle()),
+    }
+
+
+@functools.cache
+def pooled_serper_class():
+    """
+    Build the GoogleSerperAPIWrapper subclass that sends its requests through the
+    shared Serper clients (defined on first use so LangChain loads lazily).
+    """
+    from langchain_community.utilities import GoogleSerperAPIWrapper
+
+    class PooledSerperAPIWrapper(GoogleSerperAPIWrapper):
+        def _google_serper_api_results(self, search_term: str, search_type: str = "search", **kwargs: Any) -> dict:
+            response = registry.http_client("serper").post(
+                f"{SERPER_URL}/{search_type}",
+                headers={"X-API-KEY": self.serper_api_key or "", "Content-Type": "application/json"},
+                params={"q": search_term, **{key: value for key, value in kwargs.items() if value is not None}},
+            )
+            response.raise_for_status()
+            return response.json()
+
+        async def _async_google_serper_search_results(self, search_term: str, search_type: str = "search",
+                                                      **kwargs: Any) -> dict:
+            response = await registry.async_http_client("serper").post(
+                f"{SERPER_URL}/{search_type}",
+                headers={"X-API-KEY": self.serper_api_key or "", "Content-Type": "application/json"},
+                params={"q": search_term, **{key: value for key, value in kwargs.items() if value is not None}},
+            )
+            response.raise_for_status()
+            return response.json()
+
+    return PooledSerperAPIWrapper
+
+
+class ClientRegistry:
+    """
+    Lazily creates and shares one sync and one async httpx client per upstream.
+
+    Async clients hold connections bound to the event loop that opened them, so
+    use them from one long-lived loop.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients: Dict[str, Any] = {}
+        self.async_clients: Dict[str, Any] = {}
+        self.pool_stats: Dict[str, PoolStats] = {}
+        self._openai = None
+
+    @functools.cached_property
+    def timeout(self):
+        import httpx
+
+        return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+    def _client_options(self) -> Dict[str, Any]:
+        import httpx
+
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        return {"http2": HTTP2, "timeout": self.timeout, "limits": limits}
+
+    def _stats(self, name: str) -> PoolStats:
+        return self.pool_stats.setdefault(name, PoolStats())
+
+    def http_client(self, name: str = "openai"):
+        """The shared sync ``httpx.Client`` for an upstream."""
+        import httpx
+
+        with self.lock:
+            if name not in self.clients:
+                self.clients[name] = httpx.Client(
+                    **self._client_options(), event_hooks={"request": [self._stats(name).on_request]}
+                )
+            return self.clients[name]
+
+    def async_http_client(self, name: str = "openai"):
+        """The shared ``httpx.AsyncClient`` for an upstream."""
+        import httpx
+
+        with self.lock:
+            if name not in self.async_clients:
+                self.async_clients[name] = httpx.AsyncClient(
+                    **self._client_options(), event_hooks={"request": [self._stats(name).on_async_request]}
+                )
+            return self.async_clients[name]
+
+    def openai(self):
+        """The shared ``openai.OpenAI`` client, e.g. for the Assistants API."""
+        from openai import OpenAI
+
+        http_client = self.http_client("openai")
+        with self.lock:
+            if self._openai is None:
+                self._openai = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), timeout=self.timeout,
+                                      http_client=http_client)
+        return self._openai
+
+    def chat_openai(self, model: str, **kwargs):
+        """
+        Build a ChatOpenAI that sends its requests through the shared OpenAI clients.
+
+        Args:
+            model (str): The model name.
+            **kwargs: Passed to ChatOpenAI; ``api_key`` defaults to ``OPENAI_API_KEY``.
+        """
+        from langchain_openai import ChatOpenAI
+
+        kwargs.setdefault("api_key", os.environ.get("OPENAI_API_KEY"))
+        return ChatOpenAI(
+            model=model,
+            timeout=self.timeout,
+            http_client=self.http_client("openai"),
+            http_async_client=self.async_http_client("openai"),
+            **kwargs,
+        )
+
+    def serper(self, **params):
+        """
+        Build a Serper wrapper that sends its requests through the shared Serper clients.
+
+        Args:
+            **params: GoogleSerperAPIWrapper fields such as ``gl``, ``hl`` or ``type``.
+        """
+        return pooled_serper_class()(serper_api_key=os.environ.get("SERPER_API_KEY"), **params)
+
+    def stats(self) -> Dict[str, Any]:
+        """Requests, new connections, TLS handshakes, reuse rate and pool size per upstream."""
+        with self.lock:
+            names = set(self.clients) | set(self.async_clients)
+            report = {}
+            for name in sorted(names):
+                report[name] = {**self._stats(name).snapshot(), "http2": HTTP2}
+                if name in self.clients:
+                    report[name].update(_pool_size(self.clients[name]))
+        logging.info(f"HTTP pool stats: {report}")
+        return report
+
+    def close(self):
+        """Close the sync clients (async clients are closed with ``aclose`` from their loop)."""
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+
+registry = ClientRegistry()
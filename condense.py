@@ -0,0 +1,186 @@
+"""
+condense.py
+
+Condenses raw Serper responses before they reach a prompt: snippets are
+deduplicated, boilerplate is dropped, the rest is ranked by term overlap with
+the item or supplier being researched and capped at a token budget.
+"""
+
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, Iterable, List
+
+from guards import call_search
+from transcripts import store
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken ships with langchain-openai, but fall back to a rough estimate
+    tiktoken = None
+
+# Config
+SEARCH_TOKEN_BUDGET = int(os.environ.get("SEARCH_TOKEN_BUDGET", "400"))
+TOKENIZER_MODEL = "gpt-4o-mini"
+MIN_SNIPPET_CHARS = 25
+
+BOILERPLATE = re.compile(
+    r"(cookie|javascript|sign in|log in|create an account|all rights reserved|privacy policy"
+    r"|terms of (use|service)|free shipping|add to cart|click here|subscribe|enable js)",
+    re.IGNORECASE,
+)
+NON_WORD = re.compile(r"[^a-z0-9]+")
+TRAILING_LINK = re.compile(r"\s\([^()]*\)$")
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with the local tokenizer for the configured model.
+
+    Args:
+        text (str): The text to count.
+
+    Returns:
+        int: The number of tokens.
+    """
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+        except Exception as e:  # unknown model, or the BPE file can't be fetched offline
+            logging.warning(f"Falling back to estimated token counts: {e}")
+            _encoding = False
+    if not _encoding:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+
+def terms_for(*texts: str) -> set:
+    """
+    Split the strings describing the subject into lower-case match terms.
+
+    Args:
+        *texts (str): Item code, description, supplier name, query...
+
+    Returns:
+        set: The terms, ignoring one-character fragments.
+    """
+    return {term for text in texts for term in NON_WORD.split((text or "").lower()) if len(term) > 1}
+
+
+def extract_snippets(results: Dict[str, Any]) -> List[str]:
+    """
+    Flatten a Serper response into candidate snippets.
+
+    Args:
+        results (dict): The response from ``GoogleSerperAPIWrapper.results``.
+
+    Returns:
+        list: The snippets in the order Serper returned them.
+    """
+    snippets = []
+
+    answer_box = results.get("answerBox") or {}
+    if answer_box.get("answer") or answer_box.get("snippet"):
+        snippets.append(f"Answer: {answer_box.get('answer') or answer_box.get('snippet')}")
+
+    knowledge_graph = results.get("knowledgeGraph") or {}
+    if knowledge_graph.get("title"):
+        parts = [knowledge_graph.get("type"), knowledge_graph.get("description"), knowledge_graph.get("website")]
+        snippets.append(f"{knowledge_graph['title']}: {' '.join(p for p in parts if p)}")
+        for attribute, value in (knowledge_graph.get("attributes") or {}).items():
+            snippets.append(f"{knowledge_graph['title']} {attribute}: {value}")
+
+    for result in results.get("organic") or []:
+        if result.get("snippet"):
+            snippets.append(f"{result.get('title', '')}: {result['snippet']} ({result.get('link', '')})")
+        for attribute, value in (result.get("attributes") or {}).items():
+            snippets.append(f"{attribute}: {value}")
+
+    return [" ".join(snippet.split()) for snippet in snippets]
+
+
+def rank_snippets(snippets: Iterable[str], terms: set) -> List[str]:
+    """
+    Deduplicate, drop boilerplate and order snippets by term overlap.
+
+    Args:
+        snippets: The candidate snippets.
+        terms (set): The match terms from terms_for.
+
+    Returns:
+        list: The surviving snippets, best first; ties keep Serper's order.
+    """
+    seen = set()
+    scored = []
+    for position, snippet in enumerate(snippets):
+        normalized = NON_WORD.sub(" ", snippet.lower()).strip()
+        # The same snippet is often syndicated under different titles and links
+        body = NON_WORD.sub(" ", TRAILING_LINK.sub("", snippet.split(": ", 1)[-1]).lower()).strip()
+        if body in seen or len(body) < MIN_SNIPPET_CHARS or BOILERPLATE.search(snippet):
+            continue
+        seen.add(body)
+        overlap = len(terms & set(normalized.split()))
+        scored.append((-overlap, position, snippet))
+    return [snippet for _, _, snippet in sorted(scored)]
+
+
+def condense_results(results: Dict[str, Any], terms: set, token_budget: int | None = None,
+                     key: str = "") -> str:
+    """
+    Condense a Serper response into a prompt-ready context within a token budget.
+
+    Args:
+        results (dict): The response from ``GoogleSerperAPIWrapper.results``.
+        terms (set): The match terms from terms_for.
+        token_budget (int | None): Maximum tokens to keep. Defaults to SEARCH_TOKEN_BUDGET.
+        key (str): The row being processed, used in the log line.
+
+    Returns:
+        str: One snippet per line, or a marker if nothing useful was found.
+    """
+    budget = token_budget or SEARCH_TOKEN_BUDGET
+    snippets = extract_snippets(results)
+    raw_tokens = count_tokens(" ".join(snippets))
+
+    kept, used = [], 0
+    for snippet in rank_snippets(snippets, terms):
+        tokens = count_tokens(snippet) + 1
+        if used + tokens > budget:
+            continue
+        kept.append(snippet)
+        used += tokens
+
+    if not kept:
+        kept = ["No good Google Search Result was found"]
+    condensed = "\n".join(kept)
+    logging.info(
+        f"Condensed search results for {key}: {raw_tokens} -> {used} tokens "
+        f"({max(raw_tokens - used, 0)} saved)"
+    )
+    return condensed
+
+
+def condensed_search(google_search, *subject: str, token_budget: int | None = None) -> Callable[[str], str]:
+    """
+    Build a condensing replacement for ``google_search.run`` to use as an agent tool.
+
+    Args:
+        google_search: The GoogleSerperAPIWrapper instance.
+        *subject (str): The item code, description or supplier name being researched.
+        token_budget (int | None): Maximum tokens per tool call.
+
+    Returns:
+        Callable: A ``search(query)`` function returning condensed results.
+    """
+    subject_terms = terms_for(*subject)
+
+    def search(query: str) -> str:
+        """Search Google and return the most relevant snippets."""
+        results = call_search(google_search.results, query)
+        store.record(subject[0] if subject else query, "search", {"query": query, "results": results})
+        return condense_results(results, subject_terms | terms_for(query), token_budget, key=query)
+
+    return search
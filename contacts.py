@@ -0,0 +1,222 @@
+"""
+contacts.py
+
+Local contact extraction from Serper results. Most vendors publish an inbox
+or a phone number that already shows up in the search snippets or the
+knowledge graph. This pass pulls them out with compiled patterns, so the
+contact agent only runs when nothing credible is found.
+
+An email is credible when its domain belongs to the vendor: it is the
+domain of the vendor's knowledge-graph website, or its registered label
+spells out every distinctive word of the vendor's name (``abc-plumbing.com``
+for ABC Plumbing Inc, but not ``joesplumbing.com``). Addresses on directories
+and free-mail providers are ignored, as are directory pages. Phone numbers and
+addresses are credible only when they come from the knowledge graph or from a
+page on one of the vendor's domains; a snippet that merely mentions a word of
+the name may be a competitor's.
+"""
+
+import re
+from typing import Any, Dict, Iterator, List, Tuple
+from urllib.parse import urlparse
+
+EMAIL = re.compile(r"\b[A-Za-z0-9][A-Za-z0-9._%+-]{0,63}@(?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,24}\b")
+PHONE = re.compile(
+    r"(?<![\d-])(?:\+?1[\s.-]?)?\(?([2-9]\d{2})\)?[\s.-]?([2-9]\d{2})[\s.-]?(\d{4})"
+    r"(?:\s*(?:x|ext\.?|extension)\s*(\d{1,6}))?(?![\d-])",
+    re.IGNORECASE,
+)
+ADDRESS = re.compile(
+    r"\b(?:\d{1,6}(?:\s+(?:[NSEW]\.?|[A-Z][A-Za-z'-]*|\d+(?:st|nd|rd|th)))+?\s+"
+    r"(?:St|Street|Ave|Avenue|Rd|Road|Blvd|Boulevard|Dr|Drive|Ln|Lane|Way|Ct|Court|Pkwy|Parkway|Hwy|Highway"
+    r"|Pl|Place|Cir|Circle|Ter|Terrace|Trl|Trail)\.?"
+    r"|(?i:P\.?\s?O\.?\s+Box)\s+\d+)"
+    r"(?:,?\s+(?:Suite|Ste\.?|Unit|#)\s*[\w-]+)?,?\s+[A-Za-z][A-Za-z .'-]+,?\s+[A-Z]{2}\s+\d{5}(?:-\d{4})?\b"
+)
+
+# Local parts of shared inboxes, and those that reach sales or accounts receivable
+ROLE_INBOXES = {
+    "info", "sales", "contact", "contactus", "hello", "office", "admin", "support", "service",
+    "customerservice", "custserv", "orders", "order", "ar", "accounts", "accountsreceivable", "billing",
+    "invoices", "invoice", "remit", "remittance", "payments", "finance", "inquiries", "enquiries", "team",
+    "marketing", "hr", "careers", "jobs", "noreply", "no-reply", "webmaster", "help",
+}
+PREFERRED_INBOXES = {"sales", "ar", "accounts", "accountsreceivable", "billing", "invoices", "orders"}
+IGNORED_DOMAINS = {
+    "gmail.com", "yahoo.com", "hotmail.com", "outlook.com", "aol.com", "icloud.com", "example.com",
+    "zoominfo.com", "rocketreach.co", "signalhire.com", "contactout.com", "apollo.io", "dnb.com",
+    "bbb.org", "yelp.com", "linkedin.com", "facebook.com", "manta.com", "bizapedia.com", "sentry.io",
+}
+# Name terms too generic to tie a domain to a vendor; a domain label may include them or not
+GENERIC_TERMS = {
+    "inc", "llc", "ltd", "co", "corp", "corporation", "company", "the", "and", "of", "group", "services",
+    "service", "supply", "sales", "usa", "us", "america", "american", "international", "solutions",
+}
+# Second-level labels under a country code, as in example.co.uk
+COUNTRY_SECOND_LEVELS = {"co", "com", "net", "org", "gov", "ac", "edu"}
+
+
+def _domain(url_or_email: str) -> str:
+    host = url_or_email.rsplit("@", 1)[-1] if "@" in url_or_email else urlparse(url_or_email).netloc
+    host = host.lower().split(":")[0]
+    return host[4:] if host.startswith("www.") else host
+
+
+def _texts(results: Dict[str, Any]) -> Iterator[Tuple[str, str, bool]]:
+    """Yield (text, source link, from the knowledge graph) for every piece of a Serper response."""
+    knowledge_graph = results.get("knowledgeGraph") or {}
+    website = knowledge_graph.get("website") or ""
+    for key in ("title", "description", "website"):
+        if knowledge_graph.get(key):
+            yield str(knowledge_graph[key]), website, True
+    for attribute, value in (knowledge_graph.get("attributes") or {}).items():
+        yield f"{attribute}: {value}", website, True
+
+    answer_box = results.get("answerBox") or {}
+    for key in ("answer", "snippet"):
+        if answer_box.get(key):
+            yield str(answer_box[key]), answer_box.get("link", ""), False
+
+    for result in results.get("organic") or []:
+        link = result.get("link", "")
+        yield f"{result.get('title', '')} {result.get('snippet', '')}", link, False
+        for attribute, value in (result.get("attributes") or {}).items():
+            yield f"{attribute}: {value}", link, False
+
+
+def vendor_domains(results: Dict[str, Any], vendor: str) -> set:
+    """
+    The domains that belong to ``vendor``: its knowledge-graph website, and result
+    domains whose label spells out the vendor's name (see label_matches).
+
+    Args:
+        results (dict): The response from ``GoogleSerperAPIWrapper.results``.
+        vendor (str): The vendor name.
+
+    Returns:
+        set: Domains without ``www.``.
+    """
+    pattern = _label_pattern(vendor)
+    domains = set()
+    website = (results.get("knowledgeGraph") or {}).get("website")
+    if website:
+        domains.add(_domain(website))
+    for result in results.get("organic") or []:
+        domain = _domain(result.get("link", ""))
+        if domain and domain not in IGNORED_DOMAINS and label_matches(domain, pattern):
+            domains.add(domain)
+    return domains
+
+
+def _label(domain: str) -> str:
+    """The registered label of a domain: ``abc-plumbing`` for mail.abc-plumbing.co.uk."""
+    labels = domain.split(".")
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in COUNTRY_SECOND_LEVELS:
+        return labels[-3]
+    return labels[-2] if len(labels) >= 2 else domain
+
+
+def _label_pattern(vendor: str) -> re.Pattern | None:
+    """
+    Match a domain label made of every distinctive word of ``vendor``, in order,
+    optionally joined by hyphens and mixed with generic words (``abcplumbinginc``).
+
+    Returns:
+        re.Pattern | None: None when the name has no distinctive word to match on.
+    """
+    words = re.findall(r"[a-z0-9]+", vendor.lower())
+    distinctive = [word for word in words if len(word) > 2 and word not in GENERIC_TERMS]
+    if not distinctive:
+        return None
+    generic = "|".join(sorted(map(re.escape, GENERIC_TERMS), key=len, reverse=True))
+    filler = f"(?:-?(?:{generic}))*-?"
+    return re.compile(f"{filler}{filler.join(map(re.escape, distinctive))}{filler}")
+
+
+def label_matches(domain: str, pattern: re.Pattern | None) -> bool:
+    """Whether the domain's registered label is the vendor's name (see _label_pattern), not just contains a word."""
+    return pattern is not None and pattern.fullmatch(_label(domain)) is not None
+
+
+def belongs_to_vendor(domain: str, domains: set, pattern: re.Pattern | None) -> bool:
+    """Whether an email domain is one of the vendor's domains (or a subdomain), or its label is the vendor's name."""
+    if domain in IGNORED_DOMAINS:
+        return False
+    return any(domain == d or domain.endswith("." + d) for d in domains) or label_matches(domain, pattern)
+
+
+def inbox_type(email: str) -> str:
+    """
+    Classify an inbox as "company" (a role address such as sales@) or "individual" (a personal one).
+
+    Args:
+        email (str): The address.
+
+    Returns:
+        str: "company" or "individual".
+    """
+    local = email.split("@", 1)[0].lower()
+    if local in ROLE_INBOXES or re.sub(r"[^a-z]", "", local) in ROLE_INBOXES:
+        return "company"
+    return "individual"
+
+
+def format_phone(match: re.Match) -> str:
+    area, exchange, line, extension = match.groups()
+    return f"({area}) {exchange}-{line}" + (f" x{extension}" if extension else "")
+
+
+def extract_contacts(results: Dict[str, Any], vendor: str) -> Dict[str, Any] | None:
+    """
+    Pull credible emails, phone numbers and an address for ``vendor`` out of a Serper response.
+
+    Args:
+        results (dict): The response from ``GoogleSerperAPIWrapper.results``.
+        vendor (str): The vendor name.
+
+    Returns:
+        dict | None: ``company``, ``emails`` (``email`` and ``type``, sales and AR inboxes first),
+        ``phone_numbers``, ``address`` and ``citation`` (the page the first detail came from), in the
+        shape ``clean_and_parse_output`` returns; None if no credible email or phone number was found.
+    """
+    domains = vendor_domains(results, vendor)
+    pattern = _label_pattern(vendor)
+    emails: Dict[str, str] = {}
+    phones: Dict[str, str] = {}
+    address = None
+    citations: List[str] = []
+
+    for text, link, from_graph in _texts(results):
+        source = _domain(link) if link else ""
+        if source in IGNORED_DOMAINS:
+            continue
+        on_vendor_site = source in domains
+        for email in EMAIL.findall(text):
+            email = email.lower()
+            if not belongs_to_vendor(_domain(email), domains, pattern):
+                continue
+            if email not in emails:
+                emails[email] = inbox_type(email)
+                citations.append(link)
+        if from_graph or on_vendor_site:
+            for match in PHONE.finditer(text):
+                phone = format_phone(match)
+                if phone not in phones:
+                    phones[phone] = link
+                    citations.append(link)
+            if address is None:
+                found = ADDRESS.search(text)
+                address = found.group(0) if found else None
+
+    if not emails and not phones:
+        return None
+    ranked = sorted(emails.items(), key=lambda item: (
+        item[0].split("@", 1)[0] not in PREFERRED_INBOXES, item[1] != "individual"))
+    knowledge_graph = results.get("knowledgeGraph") or {}
+    return {
+        "company": knowledge_graph.get("title") or vendor,
+        "emails": [{"email": email, "type": kind} for email, kind in ranked],
+        "phone_numbers": list(phones),
+        "address": address,
+        "citation": next((link for link in citations if link), "Google Search"),
+    }
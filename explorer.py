@@ -0,0 +1,294 @@
+"""
+explorer.py
+
+Keeps the PyGWalker explorer responsive on large tables. PyGWalker computes
+in the browser, so the explorer never ships it more than a row budget.
+Depending on the data, it ships one of three things:
+
+- every row, when the table fits the budget
+- a spend cube: classified spend aggregated in SQLite by UNSPSC segment,
+  family, class and commodity (the indexed integer level columns, see
+  unspsc.py), supplier, region and month, when the cube fits
+- a stratified sample of rows otherwise, which keeps every classification
+  code (rare ones whole) and carries a ``sample_weight`` for scaling totals
+
+Exact figures are always one query away: ``drill_down`` runs the filtered
+query against SQLite on the server.
+
+The explorer only reads. The canonical key columns its spend join uses are
+added by the classification runs, or by ``python spend_keys.py``.
+"""
+
+import os
+import sqlite3
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from spend_keys import has_key_columns
+from unspsc import NAMES_TABLE
+
+# Config
+ROW_BUDGET = int(os.environ.get("EXPLORER_ROW_BUDGET", "50000"))
+MIN_PER_STRATUM = int(os.environ.get("EXPLORER_MIN_PER_STRATUM", "5"))
+DRILL_LIMIT = 5000
+
+# Dimension -> the expression it is read from in the spend-line join
+DIMENSION_COLUMNS = {
+    "segment_code": "i.unspsc_segment",
+    "family_code": "i.unspsc_family",
+    "class_code": "i.unspsc_class",
+    "commodity_code": "i.unspsc_commodity",
+    # The most specific level of the code, as an integer
+    "classification_code": "COALESCE(i.unspsc_commodity, i.unspsc_class, i.unspsc_family, i.unspsc_segment)",
+    "supplier_name": "TRIM(r.supplier_name)",
+    "region": "TRIM(r.company_region)",
+    "month": "substr(TRIM(r.gl_date), 1, 7)",
+}
+# The cube groups on the integer level columns; classification_code follows from them
+CUBE_DIMENSIONS = [dimension for dimension in DIMENSION_COLUMNS if dimension != "classification_code"]
+CUBE_LEVELS = ["segment", "family", "class", "commodity"]
+CUBE_MEASURES = ["spend", "lines", "items"]
+
+
+def spend_lines(filters: Dict[str, Any] | None = None) -> Tuple[str, list]:
+    """
+    The query for one row per classified spend line, with the cube dimensions.
+
+    Spend joins items on the indexed canonical ``item_key`` (see spend_keys.py),
+    and filters apply to the joined columns, so an indexed level column such as
+    ``class_code`` narrows the join instead of filtering its output.
+
+    Args:
+        filters (dict | None): Cube dimension -> value, matched with ``IS`` so None selects NULLs.
+
+    Returns:
+        tuple: The query and its parameters.
+    """
+    filters = filters or {}
+    columns = ",\n       ".join(f"{column} AS {dimension}" for dimension, column in DIMENSION_COLUMNS.items())
+    where = "".join(f"\n  AND {DIMENSION_COLUMNS[dimension]} IS ?" for dimension in filters)
+    query = f"""
+SELECT {columns},
+       TRIM(r.item_code) AS item_code,
+       r.item_key AS item_key,
+       CAST(r.transaction_line_value AS REAL) AS spend
+FROM main.spend_data_raw r
+JOIN main.AP_Items_For_Classification i ON i.item_key = r.item_key
+WHERE i.unspsc_segment IS NOT NULL{where}
+"""
+    # Values picked from the cube frame may be numpy scalars, which sqlite3 cannot bind
+    return query, [value.item() if hasattr(value, "item") else value for value in filters.values()]
+
+
+def require_keys(conn: sqlite3.Connection):
+    """
+    Check that spend_data_raw and the item table have the key columns the spend join reads.
+
+    Raises:
+        ValueError: If either table has no ``item_key`` column yet.
+    """
+    if not has_key_columns(conn, "spend_data_raw", "AP_Items_For_Classification"):
+        raise ValueError("Spend has no canonical keys yet; run `python spend_keys.py` or a classification run")
+
+
+def build_cube(conn: sqlite3.Connection) -> pd.DataFrame:
+    """
+    Aggregate classified spend by the cube dimensions in one SQL pass.
+
+    Args:
+        conn: The database connection.
+
+    Returns:
+        pd.DataFrame: One row per combination of CUBE_DIMENSIONS with spend, lines and items,
+        the most specific ``classification_code``, and the level and classification names
+        from the UNSPSC names table.
+
+    Raises:
+        ValueError: If the key columns have not been added yet (see require_keys).
+    """
+    require_keys(conn)
+    dimensions = ", ".join(CUBE_DIMENSIONS)
+    lines, _ = spend_lines()
+    query = f"""
+    SELECT {dimensions}, MAX(classification_code) AS classification_code,
+           SUM(spend) AS spend, COUNT(*) AS lines, COUNT(DISTINCT item_key) AS items
+    FROM ({lines})
+    GROUP BY {dimensions}
+    """
+    cube = pd.read_sql_query(query, conn)
+    names = pd.read_sql_query(f"SELECT code, name FROM main.{NAMES_TABLE}", conn).set_index("code")["name"]
+    for level in CUBE_LEVELS:
+        cube[f"{level}_name"] = cube[f"{level}_code"].map(names)
+    cube["classification_name"] = cube["classification_code"].map(names)
+    return cube
+
+
+def _field(fid: str, analytic_type: str, name: str | None = None) -> Dict[str, Any]:
+    """A PyGWalker field entry for a cube column."""
+    field = {"fid": fid, "name": name or fid, "basename": fid, "analyticType": analytic_type, "offset": 0,
+             "semanticType": "quantitative" if analytic_type == "measure" else "nominal"}
+    if analytic_type == "measure":
+        field["aggName"] = "sum"
+    return field
+
+
+def cube_spec(spec: Dict[str, Any]) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Map saved row-level PyGWalker charts onto the spend cube's columns.
+
+    ``spend`` and the classification columns exist in both; the row count
+    becomes the cube's ``lines`` measure, and each cell's spend is already a
+    sum. Fields the cube does not have (item-level ones such as ``item_code``,
+    ``valid`` or ``comments``) are removed from details and filters, range
+    filters on measures are removed because they were row-level thresholds,
+    and charts that plot a missing field are dropped.
+
+    Args:
+        spec (dict): The saved spec (gw_config.json).
+
+    Returns:
+        tuple: The cube spec, and the sorted names of the fields that had no cube column.
+    """
+    dimensions = CUBE_DIMENSIONS + ["classification_code", "classification_name"] + [
+        f"{level}_name" for level in CUBE_LEVELS]
+    fields = {fid: _field(fid, "dimension") for fid in dimensions}
+    fields.update({fid: _field(fid, "measure") for fid in CUBE_MEASURES})
+    fields["gw_count_fid"] = _field("lines", "measure", "Spend lines")
+    missing = set()
+
+    def mapped(field):
+        fid = field.get("fid", "")
+        if fid.startswith("gw_") and fid != "gw_count_fid":
+            if field.get("computed"):
+                missing.add(field.get("name", fid))
+                return None
+            return field  # PyGWalker's own measure name/value fields
+        if fid not in fields:
+            missing.add(fid)
+            return None
+        return {**fields[fid], **({"rule": field["rule"]} if "rule" in field else {})}
+
+    charts = []
+    for chart in spec.get("config", []):
+        encodings = {}
+        drawable = True
+        for channel, channel_fields in chart["encodings"].items():
+            if not isinstance(channel_fields, list):
+                encodings[channel] = channel_fields
+                continue
+            kept = [field for field in map(mapped, channel_fields) if field is not None]
+            if channel == "filters":
+                kept = [field for field in kept if field["analyticType"] == "dimension"]
+            elif channel not in ("dimensions", "measures", "details") and len(kept) < len(channel_fields):
+                drawable = False
+            encodings[channel] = kept
+        if not drawable:
+            continue
+        encodings["dimensions"] = [fields[fid] for fid in dimensions] + [
+            field for field in encodings.get("dimensions", []) if field["fid"].startswith("gw_")]
+        encodings["measures"] = [fields[fid] for fid in CUBE_MEASURES] + [
+            field for field in encodings.get("measures", []) if field["fid"].startswith("gw_")]
+        config = dict(chart.get("config", {}))
+        if "folds" in config:
+            config["folds"] = ["lines" if fid == "gw_count_fid" else fid for fid in config["folds"]
+                               if fid == "gw_count_fid" or fid in fields]
+        charts.append({**chart, "config": config, "encodings": encodings})
+    # The saved workflows compute over row-level fields; PyGWalker rebuilds them from the encodings
+    cube = {key: value for key, value in spec.items() if key != "workflow_list"}
+    cube["config"] = charts
+    return cube, sorted(missing)
+
+
+def stratified_sample(df: pd.DataFrame, budget: int = ROW_BUDGET, strata: str = "classification_code",
+                      min_per_stratum: int = MIN_PER_STRATUM, seed: int = 0) -> pd.DataFrame:
+    """
+    Sample about ``budget`` rows, keeping at least ``min_per_stratum`` rows of every stratum.
+
+    Strata smaller than the minimum are kept whole; the rest of the budget is
+    shared in proportion to stratum size. Rows are picked with one shuffle and
+    a per-stratum rank, with no per-group Python loop.
+
+    Args:
+        df (pd.DataFrame): The rows to sample.
+        budget (int): Target number of rows.
+        strata (str): The column to stratify by; nulls form their own stratum.
+        min_per_stratum (int): Rows kept from each stratum before sharing the rest.
+        seed (int): Random seed, so reruns show the same sample.
+
+    Returns:
+        pd.DataFrame: The sample, with ``sample_weight`` (population rows per sampled row) and
+        ``attrs["sampling"]`` holding population, rows and rate.
+    """
+    if len(df) <= budget:
+        sample = df.assign(sample_weight=1.0)
+    else:
+        keys = df[strata].astype(object).fillna("<null>")
+        counts = keys.value_counts()
+        floor = counts.clip(upper=min_per_stratum)
+        spare = counts - floor
+        # Share of each stratum's remaining rows that fits the remaining budget
+        rate = min(max((budget - floor.sum()) / spare.sum(), 0.0), 1.0) if spare.sum() else 0.0
+        quota = keys.map(floor + np.floor(spare * rate)).to_numpy()
+        sizes = keys.map(counts).to_numpy()
+        rank = keys.sample(frac=1, random_state=seed).groupby(keys).cumcount().reindex(df.index).to_numpy()
+        keep = rank < quota
+        sample = df[keep].assign(sample_weight=(sizes / quota)[keep])
+    sample.attrs["sampling"] = {
+        "population": len(df),
+        "rows": len(sample),
+        "rate": round(len(sample) / len(df), 4) if len(df) else 1.0,
+        "strata": strata,
+    }
+    return sample
+
+
+def choose_view(rows: int, cube_rows: int | None, budget: int = ROW_BUDGET) -> str:
+    """
+    Pick what the explorer ships to the browser.
+
+    Args:
+        rows (int): Rows in the item frame.
+        cube_rows (int | None): Rows in the spend cube; None when it could not be built.
+        budget (int): The row budget.
+
+    Returns:
+        str: "rows" if every row fits, else "cube" if the cube fits, else "sample".
+    """
+    if rows <= budget:
+        return "rows"
+    if cube_rows is not None and cube_rows <= budget:
+        return "cube"
+    return "sample"
+
+
+def drill_down(conn: sqlite3.Connection, filters: Dict[str, Any],
+               limit: int = DRILL_LIMIT) -> Tuple[pd.DataFrame, Dict[str, Any]]:
+    """
+    Run the exact server-side query behind a cube cell or sampled group.
+
+    Args:
+        conn: The database connection.
+        filters (dict): DIMENSION_COLUMNS key -> value; other keys are rejected.
+        limit (int): Spend lines returned; the totals cover every matching line.
+
+    Returns:
+        tuple: The matching spend lines, and exact totals (spend, lines, items, suppliers).
+
+    Raises:
+        ValueError: If a filter is not in DIMENSION_COLUMNS, or the key columns have not been added yet.
+    """
+    unknown = set(filters) - set(DIMENSION_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown drill-down filter(s): {', '.join(sorted(unknown))}")
+    require_keys(conn)
+    query, params = spend_lines(filters)
+
+    totals_query = f"""
+    SELECT COALESCE(SUM(spend), 0), COUNT(*), COUNT(DISTINCT item_key), COUNT(DISTINCT supplier_name)
+    FROM ({query})
+    """
+    spend, lines, items, suppliers = conn.execute(totals_query, params).fetchone()
+    rows = pd.read_sql_query(f"{query} ORDER BY spend DESC LIMIT ?", conn, params=params + [limit])
+    return rows, {"spend": spend, "lines": lines, "items": items, "suppliers": suppliers}
@@ -0,0 +1,279 @@
+"""
+fast_path.py
+
+Helpers for the single-shot pipeline mode: one Serper query, condensed to the
+useful snippets (see condense.py), followed by exactly one chat completion
+constrained to a JSON schema, or one completion for a micro-batch of rows.
+The agent loop in each module stays available as a fallback.
+
+Completions are streamed through json_stream.JSONStream: fields are validated
+as they arrive, so a bad field fails early, and the stream is closed as soon
+as text follows the top-level object, so trailing output is never paid for.
+"""
+
+import json
+import os
+import re
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple, Type
+
+from guards import budget, call_llm
+from hedging import check_cancelled, run_stage
+from json_stream import JSONStream
+from transcripts import store
+
+if TYPE_CHECKING:  # LangChain is imported by the callers on first use, not at import time
+    from langchain_core.prompts import ChatPromptTemplate
+
+# Config
+NO_SEARCH_RESULTS = "No search was run for this request."
+STREAM_COMPLETIONS = os.environ.get("STREAM_COMPLETIONS", "1") == "1"
+
+
+# Words that make a line self-describing (rent, tax, fees...) unless it also carries a part number;
+# NO_SEARCH_TERMS adds comma-separated words to the list
+NO_SEARCH_TERMS = {
+    "rent", "rental", "lease", "cam", "tax", "taxes", "rebate", "rebates", "freight", "shipping", "fee", "fees",
+    "labor", "labour", "deposit", "discount", "interest", "insurance", "utilities", "ticket", "mileage",
+} | {word.strip().lower() for word in os.environ.get("NO_SEARCH_TERMS", "").split(",") if word.strip()}
+# A token with a digit and at least four characters, e.g. UP18AZ48AJVCA or 4513040
+_PART_NUMBER = re.compile(r"(?=[\w-]*\d)[A-Za-z0-9][\w-]{3,}")
+
+
+def needs_search(term: str) -> bool:
+    """
+    Decide whether a term needs a web search before classification.
+
+    Part numbers are always searched, and so are brand or product names
+    without digits. Only self-describing text, such as ``Sales tax`` or
+    ``Peter Aardema (Base Rent)``, which names one of NO_SEARCH_TERMS and no
+    part number, is classified from the text alone.
+
+    Args:
+        term (str): The item code or description.
+
+    Returns:
+        bool: True if the term contains something worth searching for.
+    """
+    term = term or ""
+    if _PART_NUMBER.search(term):
+        return True
+    words = set(re.findall(r"[a-z]+", term.lower()))
+    return bool(words) and not words & NO_SEARCH_TERMS
+
+
+def build_item_query(item_code: str) -> str:
+    """
+    Build the Serper query for an item code.
+
+    The raw extract often appends a truncated work order reference, e.g.
+    ``UP18AZ48AJVCA (W18231586``, which only adds noise to the search.
+
+    Args:
+        item_code (str): The code of the item.
+
+    Returns:
+        str: The search query.
+    """
+    return item_code.split("(")[0].strip() or item_code.strip()
+
+
+def build_supplier_query(supplier_name: str) -> str:
+    """
+    Build the Serper query for a supplier name.
+
+    Args:
+        supplier_name (str): The name of the supplier.
+
+    Returns:
+        str: The search query.
+    """
+    return f"{' '.join(supplier_name.split())} company"
+
+
+def _strict_schema(schema: Dict[str, Any], definitions: Dict[str, Any]) -> Dict[str, Any]:
+    """Rewrite one node of a Pydantic schema for strict mode, inlining nested model references."""
+    if "$ref" in schema:
+        return _strict_schema(definitions[schema["$ref"].split("/")[-1]], definitions)
+    schema = {key: value for key, value in schema.items() if key not in ("default", "title")}
+    if schema.get("type") == "array" and "items" in schema:
+        return {**schema, "items": _strict_schema(schema["items"], definitions)}
+    if "properties" not in schema:
+        return schema
+
+    required = set(schema.get("required", []))
+    properties = {}
+    for name, prop in schema["properties"].items():
+        prop = _strict_schema(prop, definitions)
+        if name not in required and "anyOf" not in prop:
+            prop = {"anyOf": [prop, {"type": "null"}], "description": prop.get("description", "")}
+        properties[name] = prop
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def strict_response_format(model: Type[Any]) -> Dict[str, Any]:
+    """
+    Build an OpenAI ``json_schema`` response format for a Pydantic model.
+
+    Strict mode requires every property to be listed as required, so optional
+    fields are expressed as nullable instead. Nested models (e.g. a list of
+    results for a batched call) are inlined and made strict the same way.
+
+    Args:
+        model: The Pydantic model (v1 or v2) to describe.
+
+    Returns:
+        dict: The ``response_format`` payload for a chat completion.
+    """
+    schema = model.schema()
+    definitions = {**schema.get("definitions", {}), **schema.get("$defs", {})}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "strict": True,
+            "schema": _strict_schema(schema, definitions),
+        },
+    }
+
+
+def stream_structured(chain, inputs: Dict[str, Any], model: Type[Any]) -> Tuple[JSONStream, str]:
+    """
+    Stream one completion into a JSONStream, validating each field as it arrives.
+
+    The chain must request ``stream_usage`` so the final chunk reports the
+    call's tokens. Once the object is complete only the finish and usage
+    chunks should follow, so the stream is read to its end and the callback
+    charges the real usage; it is closed at once on trailing text instead.
+    A stream closed before its usage chunk has its tokens estimated (about
+    four characters each) and charged to the run budget.
+    The stream is also closed as soon as the hedged attempt running it is
+    cancelled, so a losing or timed-out attempt stops paying for tokens.
+
+    Args:
+        chain: The prompt piped into the bound model.
+        inputs (dict): The prompt variables.
+        model: The Pydantic model whose fields are validated as they arrive.
+
+    Returns:
+        tuple: The parser and any refusal text.
+
+    Raises:
+        StreamParseError: As soon as the streamed text cannot become a valid ``model``.
+        StageCancelled: If the attempt was cancelled while streaming.
+    """
+    parser = JSONStream(model)
+    refusal = ""
+    usage_seen = False
+    chunks = chain.stream(inputs)
+    try:
+        for chunk in chunks:
+            check_cancelled()
+            refusal += chunk.additional_kwargs.get("refusal") or ""
+            usage_seen = usage_seen or bool(getattr(chunk, "usage_metadata", None))
+            if parser.feed(chunk.content or "") and parser.trailing.strip():
+                break
+    finally:
+        chunks.close()
+        if not usage_seen:
+            prompt = chain.first.format(**inputs)
+            budget.charge(tokens=(len(prompt) + len(parser.text)) // 4)
+    return parser, refusal
+
+
+def invoke_structured(llm, prompt: "ChatPromptTemplate", model: Type[Any], inputs: Dict[str, Any],
+                      key: str | None = None):
+    """
+    Make exactly one chat completion and parse it straight into ``model``.
+
+    The call runs in the "llm" stage, so it is bounded by the stage timeout and
+    the row deadline and may be hedged. With STREAM_COMPLETIONS (the default)
+    the completion is streamed through stream_structured.
+
+    Args:
+        llm: The ChatOpenAI client.
+        prompt (ChatPromptTemplate): The prompt to format with ``inputs``.
+        model: The Pydantic model the completion must match.
+        inputs (dict): The prompt variables.
+        key (str | None): The item code or supplier name; the raw completion is
+            recorded in its transcript before parsing.
+
+    Returns:
+        An instance of ``model``.
+
+    Raises:
+        ValueError: If the model refuses or returns no content.
+        StreamParseError: If a streamed field is malformed or fails validation.
+    """
+    options = {"response_format": strict_response_format(model)}
+    if STREAM_COMPLETIONS:
+        options["stream_usage"] = True  # stream_options={"include_usage": True}
+    chain = prompt | llm.bind(**options)
+    if STREAM_COMPLETIONS:
+        parser, refusal = run_stage("llm", call_llm, stream_structured, chain, inputs, model)
+        if refusal:
+            raise ValueError(f"Model refused the request: {refusal}")
+        if key is not None:
+            store.record(key, "llm", {"content": parser.text[parser.start or 0:parser.end]})
+        return parser.parse()
+    message = run_stage("llm", call_llm, chain.invoke, inputs)
+    if message.additional_kwargs.get("refusal"):
+        raise ValueError(f"Model refused the request: {message.additional_kwargs['refusal']}")
+    if not message.content:
+        raise ValueError("Structured output response was empty")
+    if key is not None:
+        store.record(key, "llm", {"content": message.content})
+    return model.parse_obj(json.loads(message.content))
+
+
+def format_batch(label: str, keys: List[str], contexts: List[str]) -> str:
+    """
+    Lay out several rows and their search results for one batched completion.
+
+    Args:
+        label (str): What a key is, e.g. "Item code".
+        keys (list): The item codes or supplier names.
+        contexts (list): The search context for each key, in the same order.
+
+    Returns:
+        str: Numbered sections, one per key.
+    """
+    return "\n\n".join(
+        f"#{position} {label}: {key}\nSearch results:\n{context}"
+        for position, (key, context) in enumerate(zip(keys, contexts), start=1)
+    )
+
+
+def match_batch(keys: List[str], results: List[Any], key_field: str) -> List[Any]:
+    """
+    Line batched results up with the keys that were sent.
+
+    Results are matched on the key field first, so a reordered answer still
+    lines up. When the model rewrote a key (e.g. trimmed a work order suffix)
+    and returned one result per key, the keys left unmatched take the results
+    whose key matched nothing, in order; a result matched by key is never reused.
+
+    Args:
+        keys (list): The keys sent, in order.
+        results (list): The parsed results.
+        key_field (str): The result attribute holding the key, e.g. "item_code".
+
+    Returns:
+        list: One result per key, or None where the model gave no answer for it.
+    """
+    def norm(value) -> str:
+        return " ".join(str(value or "").split()).casefold()
+
+    by_key = {norm(getattr(result, key_field)): result for result in results}
+    matched = [by_key.get(norm(key)) for key in keys]
+    sent = {norm(key) for key in keys}
+    unclaimed = [result for result in results if norm(getattr(result, key_field)) not in sent]
+    missing = [position for position, result in enumerate(matched) if result is None]
+    if len(results) == len(keys) and len(unclaimed) == len(missing):
+        for position, result in zip(missing, unclaimed):
+            matched[position] = result
+    return matched
@@ -0,0 +1,250 @@
+"""
+fingerprints.py
+
+Input-hash change detection for incremental reclassification. When a row is
+classified, a hash of its classification inputs and the classifier version
+(prompt version plus model names) are stamped on it. ``reclassify`` then
+re-queues only the rows whose inputs were corrected or that were classified by
+an older prompt or model, so upgrades cost in proportion to what changed.
+
+Each row also stores ``current_hash``, the hash of its inputs as they are now.
+A trigger clears it whenever an input column is updated and ``find_changed``
+refills only the cleared rows, so finding changes is an index lookup on
+(classifier_version, input_hash, current_hash) rather than a Python hash of
+every row.
+"""
+
+import argparse
+import hashlib
+import logging
+import sqlite3
+from typing import Any, Dict, Iterable, List, Tuple
+
+from priority import TARGETS as PRIORITY_TARGETS
+
+# Classification inputs of each work table (those present on the table are
+# hashed), and the update that puts a row back in the processing queue
+TARGETS = {
+    "items": {"inputs": ("item_code", "item_description", "supplier_name"), "requeue": "valid = NULL"},
+    "suppliers": {"inputs": ("supplier_name",), "requeue": "classification_code = NULL"},
+}
+
+HASH_COLUMNS = {"input_hash": "TEXT", "current_hash": "TEXT", "classifier_version": "TEXT"}
+# Restricts a work query to the rows staged by select_rows
+SELECTED_ROWS = "{alias}.id IN (SELECT id FROM temp.selected_rows)"
+
+
+def fingerprint(*values) -> str:
+    """
+    Hash classification inputs. Runs of whitespace are collapsed, so reformatting alone is not a change.
+
+    Args:
+        *values: The input column values, in TARGETS order.
+
+    Returns:
+        str: The first 16 hex digits of a SHA-256 over the normalised values.
+    """
+    normalised = ["" if value is None else " ".join(str(value).split()) for value in values]
+    return hashlib.sha256("\x1f".join(normalised).encode("utf-8")).hexdigest()[:16]
+
+
+def classifier_version(prompt_version: str, *models: str) -> str:
+    """
+    Combine the prompt version and the model names into one version string.
+
+    Args:
+        prompt_version (str): See transcripts.prompt_version.
+        *models (str): The model names the classifier may use.
+
+    Returns:
+        str: e.g. ``"1a464f38e08b/gpt-4o-mini+gpt-4o"``.
+    """
+    return f"{prompt_version}/{'+'.join(models)}"
+
+
+def _table(kind: str) -> str:
+    return PRIORITY_TARGETS[kind]["table"]
+
+
+def _inputs(conn: sqlite3.Connection, kind: str) -> str:
+    """The input columns of ``kind`` present on its table, as an argument list for input_fingerprint."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA main.table_info({_table(kind)})")}
+    return ", ".join(column for column in TARGETS[kind]["inputs"] if column in existing)
+
+
+def ensure_hash_columns(conn: sqlite3.Connection, kind: str):
+    """
+    Add the hash and classifier_version columns, their index and the trigger
+    that clears ``current_hash`` when an input changes, and register the
+    input_fingerprint SQL function on the connection.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+    """
+    table = _table(kind)
+    conn.create_function("input_fingerprint", -1, fingerprint, deterministic=True)
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA main.table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column, column_type in HASH_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE main.{table} ADD COLUMN {column} {column_type}")
+    cursor.execute(f"DROP INDEX IF EXISTS main.idx_{table.lower()}_classifier")
+    cursor.execute(
+        f"CREATE INDEX IF NOT EXISTS main.idx_{table.lower()}_input_hash "
+        f"ON {table} (classifier_version, input_hash, current_hash)"
+    )
+    # Recreated each time so it covers input columns added since
+    cursor.execute(f"DROP TRIGGER IF EXISTS main.{table.lower()}_inputs_changed")
+    cursor.execute(
+        f"""
+        CREATE TRIGGER main.{table.lower()}_inputs_changed AFTER UPDATE OF {_inputs(conn, kind)} ON {table}
+        BEGIN
+            UPDATE {table} SET current_hash = NULL WHERE rowid = NEW.rowid;
+        END
+        """
+    )
+    conn.commit()
+
+
+def stamp(conn: sqlite3.Connection, kind: str, row_id: Any, version: str):
+    """
+    Record the input hash and classifier version of a freshly classified row.
+
+    The hash is computed in SQL from the row's current inputs, so it always
+    matches what was sent to the classifier. Requires ensure_hash_columns.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        row_id: The row's id.
+        version (str): The classifier version that produced the result.
+    """
+    inputs = _inputs(conn, kind)
+    conn.execute(
+        f"""
+        UPDATE main.{_table(kind)}
+        SET input_hash = input_fingerprint({inputs}), current_hash = input_fingerprint({inputs}),
+            classifier_version = ?
+        WHERE id = ?
+        """,
+        (version, row_id),
+    )
+    conn.commit()
+
+
+def find_changed(conn: sqlite3.Connection, kind: str, version: str,
+                 include_unhashed: bool = False) -> List[Tuple[Any, str]]:
+    """
+    Find classified rows whose inputs or classifier version no longer match.
+
+    Only rows whose ``current_hash`` was cleared (or never set) are hashed;
+    the comparison itself runs on the (classifier_version, input_hash,
+    current_hash) index.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        version (str): The current classifier version.
+        include_unhashed (bool): Also return rows classified before hashes were
+            recorded (or by supplier inference), which have no stamp.
+
+    Returns:
+        list: ``(id, reason)`` tuples, reason being "version", "input" or "unhashed".
+    """
+    ensure_hash_columns(conn, kind)
+    table = _table(kind)
+    classified = PRIORITY_TARGETS[kind]["classified"].format(alias="t")
+    cursor = conn.cursor()
+    cursor.execute(
+        f"UPDATE main.{table} SET current_hash = input_fingerprint({_inputs(conn, kind)}) WHERE current_hash IS NULL"
+    )
+    conn.commit()
+    cursor.execute(
+        f"""
+        SELECT t.id, CASE WHEN t.classifier_version = ? THEN 'input' ELSE 'version' END AS reason
+        FROM main.{table} t
+        WHERE (t.classifier_version < ? OR t.classifier_version > ?
+               OR (t.classifier_version = ? AND t.input_hash IS NOT t.current_hash))
+          AND {classified}
+        """,
+        (version, version, version, version),
+    )
+    changed = cursor.fetchall()
+    if include_unhashed:
+        cursor.execute(
+            f"SELECT t.id, 'unhashed' FROM main.{table} t WHERE t.classifier_version IS NULL AND {classified}"
+        )
+        changed += cursor.fetchall()
+    return [(row_id, reason) for row_id, reason in changed]
+
+
+def select_rows(conn: sqlite3.Connection, ids: Iterable[Any]):
+    """
+    Stage the ids a run is restricted to in ``temp.selected_rows`` (see SELECTED_ROWS).
+
+    Args:
+        conn: The connection the run's work queries use.
+        ids: The row ids, e.g. those re-queued by ``reclassify``.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.selected_rows")
+    conn.execute("CREATE TABLE temp.selected_rows (id PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO temp.selected_rows VALUES (?)", ((row_id,) for row_id in ids))
+    conn.commit()
+
+
+def reclassify(conn: sqlite3.Connection, kind: str, version: str, include_unhashed: bool = False,
+               dry_run: bool = False) -> Tuple[Dict[str, int], List[Any]]:
+    """
+    Put rows whose inputs or classifier version changed back in the processing queue.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        version (str): The current classifier version.
+        include_unhashed (bool): Also re-queue rows that have never been stamped.
+        dry_run (bool): Count the rows without re-queueing them.
+
+    Returns:
+        tuple: Changed-row counts per reason and the number re-queued, and the
+        re-queued ids (empty for a dry run).
+    """
+    changed = find_changed(conn, kind, version, include_unhashed)
+    counts = {"version": 0, "input": 0, "unhashed": 0, "requeued": 0}
+    for _, reason in changed:
+        counts[reason] += 1
+    ids = []
+    if not dry_run and changed:
+        ids = [row_id for row_id, _ in changed]
+        conn.executemany(
+            f"UPDATE main.{_table(kind)} SET {TARGETS[kind]['requeue']} WHERE id = ?",
+            [(row_id,) for row_id in ids],
+        )
+        conn.commit()
+        counts["requeued"] = len(ids)
+    logging.info(f"Reclassify {kind} for version {version}{' (dry run)' if dry_run else ''}: {counts}")
+    return counts, ids
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    arg_parser = argparse.ArgumentParser(description="Reclassify only rows whose inputs or classifier changed.")
+    arg_parser.add_argument("kind", choices=["items", "suppliers"])
+    arg_parser.add_argument("--include-unhashed", action="store_true",
+                            help="Also reclassify rows classified before input hashes were recorded")
+    arg_parser.add_argument("--dry-run", action="store_true", help="Only count the changed rows")
+    arg_parser.add_argument("--mode", default="routed", help="Processing mode for the re-queued rows")
+    arg_parser.add_argument("--db-path", help="The work database (defaults to the pipeline's DB_PATH)")
+    args = arg_parser.parse_args()
+    db_path = {"db_path": args.db_path} if args.db_path else {}
+
+    if args.kind == "items":
+        from agent_item import reclassify_items
+
+        reclassify_items(args.include_unhashed, args.dry_run, args.mode, **db_path)
+    else:
+        from agent_company import reclassify_suppliers
+
+        reclassify_suppliers(args.include_unhashed, args.dry_run, args.mode, **db_path)
@@ -0,0 +1,351 @@
+"""
+guards.py
+
+Circuit breakers per provider and a hard per-run budget, so a long
+classification run stops cleanly instead of burning through the batch when
+Serper is down or the OpenAI key hits its limit.
+
+Search calls go through ``call_search``, model calls through ``call_llm`` and
+whole agent runs through ``call_agent``. All three raise a GuardError subclass when the run should stop; callers must not
+retry those.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+# Config
+LLM_TOKEN_ESTIMATE = int(os.environ.get("LLM_TOKEN_ESTIMATE", "2000"))  # held per model call until it settles
+ASSISTANT_SLOW_CALL_SECONDS = float(os.environ.get("ASSISTANT_SLOW_CALL_SECONDS", "600"))  # whole runs, with tools
+AGENT_SLOW_CALL_SECONDS = float(os.environ.get("AGENT_SLOW_CALL_SECONDS", "180"))  # multi-step agent runs
+TRANSPORT_ERRORS = {
+    "ConnectionError", "TimeoutError", "APIConnectionError", "APITimeoutError",  # builtins, openai
+    "TransportError", "ConnectTimeout", "ReadTimeout", "Timeout", "ChunkedEncodingError",  # httpx, requests
+}
+
+
+class GuardError(Exception):
+    """Base class for errors that should stop a run rather than be retried."""
+
+    provider = "guard"
+
+
+class CircuitOpenError(GuardError):
+    """Raised when a provider's circuit stays open longer than its maximum pause."""
+
+
+class BudgetExceeded(GuardError):
+    """Raised when the run has spent its token, dollar or search budget."""
+
+    provider = "budget"
+
+
+class ProviderError(Exception):
+    """Wraps a provider failure so other providers' breakers don't count it."""
+
+    def __init__(self, provider: str, error: Exception):
+        super().__init__(f"{provider}: {error}")
+        self.provider = provider
+        self.error = error
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """
+    Whether an error means the provider itself is unhealthy: a transport error,
+    a 5xx or a 429. Errors in what the provider returned (an unparseable
+    completion, a Pydantic validation error) are the caller's problem and must
+    not trip the provider's breaker.
+    """
+    if isinstance(error, ProviderError):
+        error = error.error
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return any(cls.__name__ in TRANSPORT_ERRORS for cls in type(error).__mro__)
+
+
+class CircuitBreaker:
+    """
+    Trips when the error rate or the slow-call rate over the last calls is too high.
+
+    While open, callers are paused (dispatch stops) until ``cooldown`` has
+    passed; then a single probe call is let through in the half-open state.
+    A successful probe closes the circuit, a failed one re-opens it.
+
+    Args:
+        name (str): The provider name, e.g. "openai" or "serper".
+        error_rate (float): Failure share of the window that trips the circuit.
+        slow_call_seconds (float): Calls slower than this count as slow.
+        slow_rate (float): Slow-call share of the window that trips the circuit.
+        window (int): Number of recent calls considered.
+        min_calls (int): Calls needed in the window before the circuit can trip.
+        cooldown (float): Seconds to stay open before probing.
+        max_pause (float): Seconds a caller may wait before CircuitOpenError is raised.
+    """
+
+    def __init__(self, name: str, error_rate: float = 0.5, slow_call_seconds: float = 60.0,
+                 slow_rate: float = 0.5, window: int = 20, min_calls: int = 5,
+                 cooldown: float = 30.0, max_pause: float = 300.0):
+        self.name = name
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_rate = slow_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.max_pause = max_pause
+
+        self.condition = threading.Condition()
+        self.calls = collections.deque(maxlen=window)  # (failed, slow) per call
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+
+    def _acquire(self) -> bool:
+        """Wait until a call may proceed. Returns True if the call is the half-open probe."""
+        waited_since = time.monotonic()
+        with self.condition:
+            while True:
+                if self.state == "closed":
+                    return False
+                if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                    self.state = "half_open"
+                    logging.info(f"Circuit {self.name} half-open, probing")
+                if self.state == "half_open" and not self.probe_in_flight:
+                    self.probe_in_flight = True
+                    return True
+                if time.monotonic() - waited_since >= self.max_pause:
+                    raise CircuitOpenError(f"Circuit {self.name} open for more than {self.max_pause:g}s")
+                until_probe = self.cooldown - (time.monotonic() - self.opened_at)
+                self.condition.wait(timeout=min(max(until_probe, 0.01), 1.0))
+
+    def _record(self, probe: bool, failed: bool, elapsed: float):
+        slow = elapsed >= self.slow_call_seconds
+        with self.condition:
+            if probe:
+                self.probe_in_flight = False
+                if failed or slow:
+                    self._trip("probe failed")
+                else:
+                    self.state = "closed"
+                    self.calls.clear()
+                    logging.info(f"Circuit {self.name} closed")
+                self.condition.notify_all()
+                return
+
+            self.calls.append((failed, slow))
+            if self.state != "closed" or len(self.calls) < self.min_calls:
+                return
+            failures = sum(f for f, _ in self.calls) / len(self.calls)
+            slow_calls = sum(s for _, s in self.calls) / len(self.calls)
+            if failures >= self.error_rate:
+                self._trip(f"error rate {failures:.0%}")
+            elif slow_calls >= self.slow_rate:
+                self._trip(f"slow-call rate {slow_calls:.0%}")
+
+    def _trip(self, reason: str):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        logging.warning(f"Circuit {self.name} opened ({reason}); pausing dispatch for {self.cooldown:g}s")
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        Call ``fn`` through the breaker.
+
+        Only transport errors, 5xx and 429 count as failures (see
+        ``is_provider_failure``); other errors are re-raised and the call is
+        recorded as answered. Failures raised by another provider's guard are
+        passed through without being counted against this provider.
+        """
+        probe = self._acquire()
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            own = getattr(e, "provider", self.name) == self.name
+            if own or probe:
+                self._record(probe, own and is_provider_failure(e), time.monotonic() - started)
+            raise
+        self._record(probe, False, time.monotonic() - started)
+        return result
+
+    def report(self) -> Dict[str, Any]:
+        with self.condition:
+            return {"state": self.state, "trips": self.trips}
+
+
+class RunBudget:
+    """
+    Hard limits on tokens, dollars and search calls for one run. ``None`` means unlimited.
+
+    Calls in flight hold a reservation (``reserve``) that counts against the
+    limits until the call settles (``settle``) with its actual spend, so
+    concurrent calls cannot all pass the check and overshoot together.
+    """
+
+    def __init__(self, max_tokens: int | None = None, max_dollars: float | None = None,
+                 max_search_calls: int | None = None):
+        self.lock = threading.Lock()
+        self.configure(max_tokens, max_dollars, max_search_calls)
+
+    def configure(self, max_tokens: int | None = None, max_dollars: float | None = None,
+                  max_search_calls: int | None = None):
+        """Set the limits and reset the counters for a new run."""
+        with self.lock:
+            self.limits = {"tokens": max_tokens, "dollars": max_dollars, "search_calls": max_search_calls}
+            self.spent = {"tokens": 0, "dollars": 0.0, "search_calls": 0}
+            self.reserved = {"tokens": 0, "dollars": 0.0, "search_calls": 0}
+
+    def check(self):
+        """Raise BudgetExceeded if any limit has been reached, counting reservations."""
+        with self.lock:
+            self._check({})
+
+    def _check(self, estimate: Dict[str, float]):
+        for name, limit in self.limits.items():
+            if limit is None:
+                continue
+            committed = self.spent[name] + self.reserved[name]
+            if committed >= limit or committed + estimate.get(name, 0) > limit:
+                raise BudgetExceeded(
+                    f"Run budget exhausted: {name} {self.spent[name]} spent + {self.reserved[name]} "
+                    f"in flight + {estimate.get(name, 0)} requested > {limit}"
+                )
+
+    def reserve(self, tokens: int = 0, dollars: float | None = None, search_calls: int = 0) -> Dict[str, float]:
+        """
+        Check the limits and hold an estimate of one call's spend, atomically.
+
+        Args:
+            tokens (int): Estimated tokens.
+            dollars (float | None): Estimated cost; None prices ``tokens`` at the run's average so far.
+            search_calls (int): Search calls.
+
+        Returns:
+            dict: The reservation, to pass to ``settle``.
+
+        Raises:
+            BudgetExceeded: If the estimate does not fit in what is left.
+        """
+        with self.lock:
+            if dollars is None:
+                dollars = tokens * self.spent["dollars"] / self.spent["tokens"] if self.spent["tokens"] else 0.0
+            estimate = {"tokens": tokens, "dollars": dollars, "search_calls": search_calls}
+            self._check(estimate)
+            for name, amount in estimate.items():
+                self.reserved[name] += amount
+        return estimate
+
+    def settle(self, reservation: Dict[str, float], tokens: int = 0, dollars: float = 0.0, search_calls: int = 0):
+        """Release a reservation and charge the call's actual spend."""
+        with self.lock:
+            for name, amount in reservation.items():
+                self.reserved[name] -= amount
+            self.spent["tokens"] += tokens
+            self.spent["dollars"] += dollars
+            self.spent["search_calls"] += search_calls
+
+    def charge(self, tokens: int = 0, dollars: float = 0.0, search_calls: int = 0):
+        with self.lock:
+            self.spent["tokens"] += tokens
+            self.spent["dollars"] += dollars
+            self.spent["search_calls"] += search_calls
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"spent": dict(self.spent), "limits": dict(self.limits), "in_flight": dict(self.reserved)}
+
+
+def _env_number(name: str, cast):
+    value = os.environ.get(name)
+    return cast(value) if value else None
+
+
+breakers = {
+    "openai": CircuitBreaker("openai", slow_call_seconds=60.0),
+    "serper": CircuitBreaker("serper", slow_call_seconds=10.0),
+    # Assistants runs poll through tool calls for minutes, so they get their own breaker and
+    # slow-call threshold rather than tripping the one chat completions share
+    "assistants": CircuitBreaker("assistants", slow_call_seconds=ASSISTANT_SLOW_CALL_SECONDS),
+    # LangChain agent runs make several searches and completions per call, likewise
+    "agent": CircuitBreaker("agent", slow_call_seconds=AGENT_SLOW_CALL_SECONDS),
+}
+budget = RunBudget(
+    max_tokens=_env_number("RUN_MAX_TOKENS", int),
+    max_dollars=_env_number("RUN_MAX_DOLLARS", float),
+    max_search_calls=_env_number("RUN_MAX_SEARCH_CALLS", int),
+)
+
+
+def call_search(fn: Callable, *args, **kwargs):
+    """
+    Make a Serper call through the budget and the serper circuit breaker.
+
+    Raises:
+        BudgetExceeded: If the run's budget is exhausted.
+        CircuitOpenError: If Serper stays unavailable past the maximum pause.
+        ProviderError: If the call itself fails.
+    """
+    budget.settle(budget.reserve(search_calls=1), search_calls=1)
+
+    def search():
+        try:
+            return fn(*args, **kwargs)
+        except GuardError:
+            raise
+        except Exception as e:
+            raise ProviderError("serper", e) from e
+
+    return breakers["serper"].call(search)
+
+
+def _call_model(breaker: str, fn: Callable, *args, **kwargs):
+    """Reserve LLM_TOKEN_ESTIMATE tokens, call ``fn`` through ``breaker`` and settle with the callback's spend."""
+    from langchain_community.callbacks.manager import get_openai_callback
+
+    reservation = budget.reserve(tokens=LLM_TOKEN_ESTIMATE)
+    with get_openai_callback() as cb:
+        try:
+            return breakers[breaker].call(fn, *args, **kwargs)
+        finally:
+            budget.settle(reservation, tokens=cb.total_tokens, dollars=cb.total_cost)
+
+
+def call_llm(fn: Callable, *args, **kwargs):
+    """
+    Make a model call (a chain invocation) through the budget and the
+    openai circuit breaker, charging its tokens and cost to the run budget.
+
+    An estimate of ``LLM_TOKEN_ESTIMATE`` tokens is reserved before the call
+    and replaced by the callback's actual tokens and cost when it returns.
+
+    Raises:
+        BudgetExceeded: If the run's budget is exhausted.
+        CircuitOpenError: If OpenAI stays unavailable past the maximum pause.
+    """
+    return _call_model("openai", fn, *args, **kwargs)
+
+
+def call_agent(fn: Callable, *args, **kwargs):
+    """
+    Make an agent run (an AgentExecutor invocation) through the budget and the
+    agent circuit breaker, charging its tokens and cost like ``call_llm``.
+
+    A run spans several completions and searches, so it is timed against
+    AGENT_SLOW_CALL_SECONDS and cannot trip the breaker chat completions share.
+
+    Raises:
+        BudgetExceeded: If the run's budget is exhausted.
+        CircuitOpenError: If agent runs keep failing past the maximum pause.
+    """
+    return _call_model("agent", fn, *args, **kwargs)
+
+
+def guard_report() -> Dict[str, Any]:
+    """Summarise the budget and breaker states, e.g. for the end-of-run log."""
+    return {"budget": budget.report(), "breakers": {name: b.report() for name, b in breakers.items()}}
@@ -0,0 +1,294 @@
+"""
+hedging.py
+
+Per-stage timeouts, a per-row deadline and hedged requests to cut tail latency.
+
+Each stage ("search", "llm", "agent") runs its calls on its own bounded pool,
+so a stalled provider can only starve its own stage. A call's timeout starts
+when a pool thread picks it up, not when it is queued; the row's deadline
+still bounds the whole wait. For stages with hedging enabled, a duplicate
+request is fired once a call has run longer than the observed p95, if the
+stage has an idle thread; whichever answer arrives first wins.
+
+Losing and timed-out attempts are cancelled: queued ones never start, and
+running ones see ``check_cancelled()`` raise at their next checkpoint (the
+streamed completion checks it per chunk and closes its stream). Transcript
+events are buffered per attempt and only the winner's are kept.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from transcripts import store
+
+# Config
+ROW_DEADLINE_SECONDS = float(os.environ.get("ROW_DEADLINE_SECONDS", "300"))
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "1") == "1"
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_HOLDOUT = float(os.environ.get("HEDGE_HOLDOUT", "0.1"))  # share of hedge-eligible calls left unhedged
+LATENCY_WINDOW = 500
+
+_row_deadline: contextvars.ContextVar = contextvars.ContextVar("row_deadline", default=None)
+_attempt: contextvars.ContextVar = contextvars.ContextVar("stage_attempt", default=None)
+
+
+class StageTimeout(TimeoutError):
+    """Raised when a stage call exceeds its timeout or the row's deadline."""
+
+
+class StageCancelled(Exception):
+    """Raised by ``check_cancelled`` inside an attempt that lost the race or timed out."""
+
+
+def percentile(samples, p: float) -> float | None:
+    """Return the ``p``-th percentile of ``samples`` (nearest rank), or None if empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+@contextlib.contextmanager
+def row_deadline(seconds: float | None = None):
+    """
+    Set the overall deadline for the row processed in the current thread.
+
+    Args:
+        seconds (float | None): Time allowed for the whole row. Defaults to ROW_DEADLINE_SECONDS.
+    """
+    token = _row_deadline.set(time.monotonic() + (seconds or ROW_DEADLINE_SECONDS))
+    try:
+        yield
+    finally:
+        _row_deadline.reset(token)
+
+
+def check_cancelled():
+    """
+    Raise StageCancelled if the stage attempt running this code has been cancelled.
+
+    Long-running stage functions call this between units of work (e.g. per
+    streamed chunk) so a losing or timed-out attempt gives its thread back.
+    """
+    attempt = _attempt.get()
+    if attempt is not None and attempt.cancelled.is_set():
+        raise StageCancelled(f"{attempt.stage.name} attempt cancelled")
+
+
+class _Attempt:
+    """One submission of a stage call: its future, start time, cancel flag and buffered transcript events."""
+
+    def __init__(self, stage: "Stage", primary: bool, fn: Callable, args, kwargs):
+        self.stage = stage
+        self.primary = primary
+        self.submitted = time.monotonic()
+        self.started = None
+        self.cancelled = threading.Event()
+        self.events = []
+        self.future = stage.pool.submit(contextvars.copy_context().run, self._run, fn, args, kwargs)
+
+    def _run(self, fn: Callable, args, kwargs):
+        if self.cancelled.is_set():
+            raise StageCancelled(f"{self.stage.name} attempt cancelled before it started")
+        self.started = time.monotonic()
+        _attempt.set(self)
+        with self.stage.lock:
+            self.stage.running += 1
+        try:
+            with store.buffered(self.events):
+                return fn(*args, **kwargs)
+        finally:
+            with self.stage.lock:
+                self.stage.running -= 1
+                if self.primary:
+                    # A cancelled primary contributes its elapsed time, a lower bound on its latency
+                    self.stage.primary_latencies.append(time.monotonic() - self.started)
+
+    def deadline(self) -> float:
+        """When this attempt times out: ``timeout`` after it started, or after it was queued if it has not."""
+        return (self.started or self.submitted) + self.stage.timeout
+
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+
+class Stage:
+    """
+    Runs calls for one stage on its own pool with a timeout and optional hedging.
+
+    Args:
+        name (str): The stage name.
+        timeout (float): Seconds allowed per call, from the moment it starts running.
+        hedge (bool): Fire a duplicate request once a call exceeds the observed p95.
+        workers (int): Threads in the stage's pool, shared by primaries and hedges.
+    """
+
+    def __init__(self, name: str, timeout: float, hedge: bool = False, workers: int = 16):
+        self.name = name
+        self.timeout = timeout
+        self.hedge = hedge
+        self.workers = workers
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{name}")
+        self.lock = threading.Lock()
+        self.running = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.primary_latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        # Latency of hedge-eligible calls, split by whether they were allowed to hedge (see HEDGE_HOLDOUT)
+        self.eligible_latencies = {"hedged": collections.deque(maxlen=LATENCY_WINDOW),
+                                   "holdout": collections.deque(maxlen=LATENCY_WINDOW)}
+        self.counts = {"calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0}
+
+    def _hedge_delay(self) -> float | None:
+        if not (self.hedge and HEDGE_ENABLED):
+            return None
+        with self.lock:
+            if len(self.primary_latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return percentile(self.primary_latencies, HEDGE_PERCENTILE)
+
+    def _idle(self) -> bool:
+        with self.lock:
+            return self.running < self.workers
+
+    def call(self, fn: Callable, *args, **kwargs):
+        """
+        Call ``fn`` within the stage timeout and the row deadline, hedging if enabled.
+
+        Raises:
+            StageTimeout: If no call succeeds in time.
+        """
+        called = time.monotonic()
+        row_deadline = _row_deadline.get()
+        with self.lock:
+            self.counts["calls"] += 1
+        if row_deadline is not None and row_deadline <= called:
+            with self.lock:
+                self.counts["timeouts"] += 1
+            raise StageTimeout(f"Row deadline exceeded before {self.name} stage")
+
+        hedge_after = self._hedge_delay()
+        group = None
+        if hedge_after is not None:
+            group = "holdout" if random.random() < HEDGE_HOLDOUT else "hedged"
+        primary = _Attempt(self, True, fn, args, kwargs)
+        attempts = [primary]
+        failed = None
+        fired = False
+        try:
+            while attempts:
+                for attempt in [a for a in attempts if a.future.done()]:
+                    attempts.remove(attempt)
+                    if attempt.future.exception() is not None:
+                        failed = attempt
+                        continue
+                    store.commit(attempt.events)
+                    latency = time.monotonic() - called
+                    with self.lock:
+                        self.latencies.append(latency)
+                        if group is not None:
+                            self.eligible_latencies[group].append(latency)
+                        if not attempt.primary:
+                            self.counts["hedge_wins"] += 1
+                    return attempt.future.result()
+                if not attempts:
+                    break
+
+                now = time.monotonic()
+                for attempt in [a for a in attempts if a.deadline() <= now]:
+                    attempt.cancel()
+                    attempts.remove(attempt)
+                if not attempts or (row_deadline is not None and now >= row_deadline):
+                    with self.lock:
+                        self.counts["timeouts"] += 1
+                    # Timed-out attempts were cancelled mid-call; their partial events are not kept
+                    raise StageTimeout(f"{self.name} stage timed out after {now - called:.1f}s")
+
+                wake = min(a.deadline() for a in attempts)
+                if row_deadline is not None:
+                    wake = min(wake, row_deadline)
+                if group == "hedged" and not fired and attempts == [primary]:
+                    hedge_at = primary.started + hedge_after if primary.started else None
+                    if hedge_at is not None and now >= hedge_at and self._idle():
+                        attempts.append(_Attempt(self, False, fn, args, kwargs))
+                        fired = True
+                        with self.lock:
+                            self.counts["hedged"] += 1
+                        continue
+                    # Re-check shortly while the primary is queued or the pool has no idle thread
+                    wake = min(wake, hedge_at if hedge_at is not None and now < hedge_at else now + 0.05)
+                concurrent.futures.wait(
+                    [a.future for a in attempts], timeout=max(wake - now, 0),
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+        store.commit(failed.events)
+        raise failed.future.exception()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Counts, latency percentiles and the hedging effect.
+
+        ``p99_improvement_seconds`` compares hedge-eligible calls that could
+        hedge with a random holdout that could not, once both have enough
+        samples; comparing winners with primaries would be biased, since a
+        losing primary is cancelled before its latency is known.
+        """
+        with self.lock:
+            hedged = list(self.eligible_latencies["hedged"])
+            holdout = list(self.eligible_latencies["holdout"])
+            report = {
+                **self.counts,
+                "hedge_rate": round(self.counts["hedged"] / self.counts["calls"], 3) if self.counts["calls"] else 0.0,
+                "p50": percentile(self.latencies, 50),
+                "p95": percentile(self.latencies, 95),
+                "p99": percentile(self.latencies, 99),
+            }
+        if min(len(hedged), len(holdout)) >= HEDGE_MIN_SAMPLES:
+            report["p99_hedged"] = percentile(hedged, 99)
+            report["p99_holdout"] = percentile(holdout, 99)
+            report["p99_improvement_seconds"] = round(report["p99_holdout"] - report["p99_hedged"], 3)
+        return report
+
+
+stages = {
+    "search": Stage("search", timeout=float(os.environ.get("SEARCH_TIMEOUT_SECONDS", "15")),
+                    workers=int(os.environ.get("SEARCH_STAGE_WORKERS", "32"))),
+    "llm": Stage("llm", timeout=float(os.environ.get("LLM_TIMEOUT_SECONDS", "60")), hedge=True,
+                 workers=int(os.environ.get("LLM_STAGE_WORKERS", "32"))),
+    "agent": Stage("agent", timeout=float(os.environ.get("AGENT_TIMEOUT_SECONDS", "180")),
+                   workers=int(os.environ.get("AGENT_STAGE_WORKERS", "16"))),
+}
+
+
+def run_stage(stage: str, fn: Callable, *args, **kwargs):
+    """
+    Run ``fn`` through the named stage.
+
+    Args:
+        stage (str): "search", "llm" or "agent".
+        fn: The callable, e.g. ``call_llm``.
+        *args, **kwargs: Passed to ``fn``.
+
+    Returns:
+        The result of the first successful call.
+    """
+    return stages[stage].call(fn, *args, **kwargs)
+
+
+def stage_report() -> Dict[str, Any]:
+    """Summarise hedge rates and latency percentiles per stage."""
+    report = {name: stage.report() for name, stage in stages.items()}
+    logging.info(f"Stage latency report: {report}")
+    return report
@@ -0,0 +1,98 @@
+"""
+import_budget.py
+
+Measures cold import time of the entry-point modules with ``python -X importtime``
+and fails when one exceeds its budget, so an eager client or a heavy top-level
+import does not creep back in. Each module is imported in a fresh interpreter
+with the API keys removed, which also proves importing never needs credentials.
+
+Usage: ``python import_budget.py [--runs 3] [module ...]``
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List
+
+# Config: cumulative import time budget per module, in milliseconds
+BUDGETS_MS = {
+    "clients": 100,
+    "fast_path": 250,
+    "agent_item": 500,
+    "agent_company": 500,
+    "agent_modular": 500,
+}
+SECRET_VARIABLES = ("OPENAI_API_KEY", "SERPER_API_KEY", "ASSISTANT_ID")
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def parse_importtime(stderr: str) -> Dict[str, int]:
+    """
+    Parse ``-X importtime`` output into cumulative microseconds per top-level import.
+
+    Args:
+        stderr (str): The interpreter's stderr.
+
+    Returns:
+        dict: Module name -> cumulative microseconds, for modules imported at the outermost level.
+    """
+    cumulative = {}
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match and len(match.group(3)) == 1:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative
+
+
+def measure(module: str) -> int:
+    """
+    Import ``module`` in a fresh interpreter without API keys and return its cumulative import time.
+
+    Args:
+        module (str): The module to import.
+
+    Returns:
+        int: Cumulative import time in microseconds.
+
+    Raises:
+        RuntimeError: If the import fails.
+    """
+    env = {key: value for key, value in os.environ.items() if key not in SECRET_VARIABLES}
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{process.stderr.splitlines()[-1]}")
+    return parse_importtime(process.stderr)[module]
+
+
+def check(modules: List[str], runs: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Measure each module's best-of-``runs`` import time against its budget.
+
+    Returns:
+        dict: Module name -> {"ms", "budget_ms", "ok"}.
+    """
+    report = {}
+    for module in modules:
+        best = min(measure(module) for _ in range(runs)) / 1000
+        budget_ms = BUDGETS_MS.get(module)
+        report[module] = {"ms": round(best, 1), "budget_ms": budget_ms, "ok": budget_ms is None or best <= budget_ms}
+    return report
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Check cold import times against per-module budgets.")
+    arg_parser.add_argument("modules", nargs="*", default=list(BUDGETS_MS))
+    arg_parser.add_argument("--runs", type=int, default=3, help="Take the best of this many cold imports")
+    args = arg_parser.parse_args()
+
+    results = check(args.modules, args.runs)
+    for name, result in results.items():
+        status = "ok" if result["ok"] else "OVER BUDGET"
+        print(f"{name:<16} {result['ms']:>8.1f} ms  (budget {result['budget_ms']} ms)  {status}")
+    sys.exit(0 if all(result["ok"] for result in results.values()) else 1)
@@ -0,0 +1,160 @@
+"""
+json_stream.py
+
+Incremental parsing of a JSON object as a completion streams in. Each chunk
+is scanned once, tracking string, escape and nesting state, so the parser
+knows the moment the top-level object closes and the caller can close the
+stream instead of paying for trailing chatter.
+
+Every top-level field is parsed and validated against the Pydantic model as
+soon as its value is complete, so a malformed or mistyped field fails the
+call while the rest is still streaming and the retry starts sooner.
+"""
+
+import functools
+import json
+from typing import Any, Dict, Type
+
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+class StreamParseError(ValueError):
+    """Raised as soon as streamed text can no longer become a valid object."""
+
+
+@functools.cache
+def _field_validator(model: Type[Any], name: str):
+    """A callable validating one field's value, for Pydantic v2 models and v1 (``pydantic_v1``) ones."""
+    fields = getattr(model, "model_fields", None)
+    if fields is not None:
+        if name not in fields:
+            return None
+        from pydantic import TypeAdapter
+
+        return TypeAdapter(fields[name].annotation).validate_python
+    field = model.__fields__.get(name)
+    if field is None:
+        return None
+
+    def validate(value):
+        value, errors = field.validate(value, {}, loc=name)
+        if errors:
+            errors = errors if isinstance(errors, list) else [errors]
+            raise ValueError("; ".join(str(getattr(error, "exc", error)) for error in errors))
+        return value
+
+    return validate
+
+
+class JSONStream:
+    """
+    Feed a streamed completion chunk by chunk until its top-level object is complete.
+
+    Args:
+        model: The Pydantic model to validate fields against, or None to only check syntax.
+        skip_prefix (bool): Ignore text before the first ``{`` (e.g. an assistant's preamble)
+            rather than treating it as an error.
+    """
+
+    def __init__(self, model: Type[Any] | None = None, skip_prefix: bool = False):
+        self.model = model
+        self.skip_prefix = skip_prefix
+        self.text = ""
+        self.start = None  # index of the top-level "{"
+        self.end = None  # index just past the matching "}"
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.member_start = 0
+        self.fields: Dict[str, Any] = {}
+
+    @property
+    def complete(self) -> bool:
+        return self.end is not None
+
+    @property
+    def trailing(self) -> str:
+        """Text received after the object closed."""
+        return self.text[self.end:] if self.complete else ""
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Scan the next chunk of the completion.
+
+        Args:
+            chunk (str): The new text.
+
+        Returns:
+            bool: True once the top-level object is complete; later chunks are only kept as ``trailing``.
+
+        Raises:
+            StreamParseError: If the text so far cannot be the start of a valid object.
+        """
+        offset = len(self.text)
+        self.text += chunk
+        if self.complete:
+            return True
+        for i in range(offset, len(self.text)):
+            char = self.text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif self.start is None:
+                if char == "{":
+                    self.start, self.member_start = i, i + 1
+                    self.stack.append("}")
+                elif not char.isspace() and not self.skip_prefix:
+                    raise StreamParseError(f"Expected a JSON object, got {self.text[:40]!r}")
+            elif char == '"':
+                self.in_string = True
+            elif char in _CLOSERS:
+                self.stack.append(_CLOSERS[char])
+            elif char in "}]":
+                if char != self.stack.pop():
+                    raise StreamParseError(f"Mismatched {char!r} at {i}: {self.text[max(0, i - 40):i + 1]!r}")
+                if not self.stack:
+                    self._member(i)
+                    self.end = i + 1
+                    return True
+            elif char == "," and len(self.stack) == 1:
+                self._member(i)
+        return False
+
+    def _member(self, i: int):
+        """Parse and validate the top-level field that ends at index ``i``."""
+        member = self.text[self.member_start:i].strip()
+        self.member_start = i + 1
+        if not member:
+            return
+        try:
+            name, value = next(iter(json.loads("{" + member + "}").items()))
+        except (json.JSONDecodeError, StopIteration) as e:
+            raise StreamParseError(f"Malformed field {member[:60]!r}: {e}") from e
+        if self.model is not None:
+            validate = _field_validator(self.model, name)
+            if validate is not None:
+                try:
+                    validate(value)
+                except ValueError as e:  # Pydantic's ValidationError in both versions
+                    raise StreamParseError(f"Invalid {name}: {e}") from e
+        self.fields[name] = value
+
+    def value(self) -> Dict[str, Any]:
+        """
+        The parsed object.
+
+        Raises:
+            StreamParseError: If the object is not complete yet.
+        """
+        if not self.complete:
+            raise StreamParseError(f"Completion ended before the JSON object closed: {self.text[-60:]!r}")
+        return json.loads(self.text[self.start:self.end])
+
+    def parse(self):
+        """The parsed object as an instance of the model (or the dict without one)."""
+        value = self.value()
+        return self.model.parse_obj(value) if self.model is not None else value
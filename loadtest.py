@@ -0,0 +1,336 @@
+"""
+loadtest.py
+
+Offline capacity planning for the classification service (server.py).
+
+Replays a request mix drawn from spend-extract-shaped data (the item_code and
+supplier_name columns of ``data/sample_cleaned.csv``) against the service at
+a ramp of offered loads and reports, per step, the achieved throughput,
+latency percentiles, batching efficiency, cache hit rate and coalesced calls.
+
+By default the service runs in process with fake search and LLM backends
+whose latencies follow the real shape (a search per key, then one completion
+whose time grows with the batch size, and a slow agent fallback for the
+unanswered rows), so runs are repeatable and cost nothing. ``--url`` points
+the generator at a running service instead.
+
+The generator is open-loop: requests are fired on a Poisson (or bursty)
+schedule regardless of how fast answers come back, and latency is measured
+from the scheduled send time so a saturated service can't hide its queueing.
+
+Usage: ``python loadtest.py --kind item --rates 25,50,100,200 --duration 10``
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import http.client
+import json
+import random
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List
+
+from hedging import percentile
+from server import KINDS, ClassificationService, make_server, structured_backend
+
+# Config
+SAMPLE_CSV = "data/sample_cleaned.csv"
+KEY_COLUMNS = {"item": "item_code", "supplier": "supplier_name", "contact": "supplier_name"}
+CLIENT_WORKERS = 256
+# Fake backend latencies in seconds, before --time-scale
+FAKE_SEARCH_SECONDS = 0.4
+FAKE_LLM_BASE_SECONDS = 1.2
+FAKE_LLM_PER_KEY_SECONDS = 0.08
+FAKE_AGENT_SECONDS = 6.0
+FAKE_UNANSWERED_RATE = 0.03
+
+
+def load_keys(path: str, kind: str) -> List[str]:
+    """
+    Read the keys for ``kind`` from a spend extract, one per row, so frequent keys stay frequent.
+
+    Args:
+        path (str): The CSV file.
+        kind (str): "item", "supplier" or "contact".
+
+    Returns:
+        list: The whitespace-normalised keys, in file order, blanks dropped.
+    """
+    column = KEY_COLUMNS[kind]
+    with open(path, newline="", encoding="utf-8", errors="replace") as f:
+        return [" ".join(row[column].split()) for row in csv.DictReader(f) if (row.get(column) or "").strip()]
+
+
+class RequestMix:
+    """
+    Draws keys for the load: repeats of known keys at their observed frequency, or fresh unique keys.
+
+    Args:
+        keys (list): Keys as returned by load_keys (duplicates act as weights).
+        repeat_ratio (float): Share of requests for a key from the sample; the rest are unique.
+        seed (int): Random seed, for repeatable runs.
+    """
+
+    def __init__(self, keys: List[str], repeat_ratio: float = 0.6, seed: int = 7):
+        self.keys = keys
+        self.repeat_ratio = repeat_ratio
+        self.random = random.Random(seed)
+        self.unique = 0
+        self.lock = threading.Lock()
+
+    def next_key(self) -> str:
+        with self.lock:
+            key = self.random.choice(self.keys)
+            if self.random.random() < self.repeat_ratio:
+                return key
+            self.unique += 1
+            return f"{key} {self.unique:06d}"
+
+
+def arrivals(rate: float, duration: float, burst_size: int = 1, seed: int = 7) -> List[float]:
+    """
+    Schedule request send times for one load step.
+
+    Args:
+        rate (float): Mean requests per second.
+        duration (float): Length of the step in seconds.
+        burst_size (int): Requests sent together per arrival; 1 is a plain Poisson process.
+        seed (int): Random seed.
+
+    Returns:
+        list: Send offsets in seconds from the start of the step.
+    """
+    rng = random.Random(seed)
+    offsets, now = [], 0.0
+    while True:
+        now += rng.expovariate(rate / burst_size)
+        if now >= duration:
+            return offsets
+        offsets.extend([now] * burst_size)
+
+
+class FakeAnswer(dict):
+    """A result dict with the ``.dict()`` of a parsed Pydantic answer."""
+
+    def dict(self):
+        return dict(self)
+
+
+def fake_backends(time_scale: float = 1.0, unanswered_rate: float = FAKE_UNANSWERED_RATE,
+                  seed: int = 7) -> Dict[str, Any]:
+    """
+    Build fake backends with the latency shape of the real ones, through server.structured_backend.
+
+    Args:
+        time_scale (float): Multiplies every fake latency (e.g. 0.1 for a quick run).
+        unanswered_rate (float): Share of batched rows the fake model leaves unanswered,
+            which sends them to the slow fake agent.
+        seed (int): Random seed.
+
+    Returns:
+        dict: Kind -> backend, for ClassificationService.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def jitter(seconds: float) -> float:
+        with lock:
+            return seconds * time_scale * rng.lognormvariate(0, 0.35)
+
+    def search(key: str) -> str:
+        time.sleep(jitter(FAKE_SEARCH_SECONDS))
+        return f"Search results for {key}"
+
+    def classify_batch(key_field: str):
+        def classify(keys: List[str], contexts: List[str]) -> List[Any]:
+            time.sleep(jitter(FAKE_LLM_BASE_SECONDS + FAKE_LLM_PER_KEY_SECONDS * len(keys)))
+            with lock:
+                answered = [rng.random() >= unanswered_rate for _ in keys]
+            return [FakeAnswer({key_field: key, "validation": True, "classification_code": "40141700"}) if ok
+                    else None for key, ok in zip(keys, answered)]
+        return classify
+
+    def agent(key_field: str):
+        def run(key: str):
+            time.sleep(jitter(FAKE_AGENT_SECONDS))
+            return FakeAnswer({key_field: key, "validation": True, "classification_code": "40141700"})
+        return run
+
+    def contacts(vendors: List[str]) -> List[Any]:
+        time.sleep(jitter(FAKE_AGENT_SECONDS))
+        return [{"company": vendor, "emails": [], "phone_numbers": []} for vendor in vendors]
+
+    return {
+        "item": structured_backend(search, classify_batch("item_code"), agent("item_code")),
+        "supplier": structured_backend(search, classify_batch("supplier_name"), agent("supplier_name")),
+        "contact": contacts,
+    }
+
+
+class LoadGenerator:
+    """
+    Fires requests at a service on a schedule and records latency per request.
+
+    Args:
+        url (str): The service base URL.
+        kind (str): "item", "supplier" or "contact".
+        mix (RequestMix): Where keys come from.
+        workers (int): Client threads, each with its own keep-alive connection.
+    """
+
+    def __init__(self, url: str, kind: str, mix: RequestMix, workers: int = CLIENT_WORKERS):
+        parsed = urllib.parse.urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.kind = kind
+        self.mix = mix
+        self.workers = workers
+        self.local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=600)
+        return self.local.connection
+
+    def _request(self, scheduled: float, key: str):
+        body = json.dumps({KINDS[self.kind]: key})
+        try:
+            connection = self._connection()
+            connection.request("POST", f"/classify/{self.kind}", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.local.connection = None
+            status = 0
+        return status, time.monotonic() - scheduled
+
+    def get(self, path: str) -> Dict[str, Any]:
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            connection.request("GET", path)
+            return json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+    def step(self, rate: float, duration: float, burst_size: int = 1, seed: int = 7) -> Dict[str, Any]:
+        """
+        Offer ``rate`` requests per second for ``duration`` seconds and wait for every answer.
+
+        Returns:
+            dict: Offered and achieved rates, status counts and latency percentiles in ms.
+        """
+        schedule = arrivals(rate, duration, burst_size, seed)
+        started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+            for offset in schedule:
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(self._request, started + offset, self.mix.next_key()))
+            results = [future.result() for future in futures]
+        elapsed = time.monotonic() - started
+
+        statuses = collections.Counter(status for status, _ in results)
+        latencies = [latency for status, latency in results if status == 200]
+        return {
+            "offered_rps": rate,
+            "requests": len(results),
+            "achieved_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "errors": len(results) - len(latencies),
+            "statuses": dict(statuses),
+            **{f"p{p}_ms": round((percentile(latencies, p) or 0) * 1000, 1) for p in (50, 95, 99)},
+        }
+
+
+def metrics_delta(before: Dict[str, Any], after: Dict[str, Any], kind: str, requests: int) -> Dict[str, Any]:
+    """
+    Turn two /metrics snapshots into the batching, cache and coalescing figures for one step.
+
+    Returns:
+        dict: Average batch size, backend calls per request, cache hit rate and coalesced calls.
+    """
+    batching = {key: after["batching"][kind][key] - before["batching"][kind][key]
+                for key in ("batches", "backend_keys")}
+    hits = after["cache"]["hits"] - before["cache"]["hits"]
+    misses = after["cache"]["misses"] - before["cache"]["misses"]
+    coalesced = after["single_flight"]["coalesced"] - before["single_flight"]["coalesced"]
+    return {
+        "batches": batching["batches"],
+        "avg_batch_size": round(batching["backend_keys"] / batching["batches"], 2) if batching["batches"] else 0.0,
+        "batch_calls_per_request": round(batching["batches"] / requests, 3) if requests else 0.0,
+        "cache_hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+        "coalesced": coalesced,
+    }
+
+
+def ramp(generator: LoadGenerator, rates: List[float], duration: float, burst_size: int = 1,
+         seed: int = 7) -> List[Dict[str, Any]]:
+    """
+    Run one step per offered rate and combine client-side and service-side figures.
+
+    Returns:
+        list: One report dict per step.
+    """
+    reports = []
+    for step, rate in enumerate(rates):
+        before = generator.get("/metrics")
+        report = generator.step(rate, duration, burst_size, seed + step)
+        report.update(metrics_delta(before, generator.get("/metrics"), generator.kind, report["requests"]))
+        reports.append(report)
+        print_step(report)
+    return reports
+
+
+def print_step(report: Dict[str, Any]):
+    print(
+        f"offered {report['offered_rps']:>7.1f} rps | achieved {report['achieved_rps']:>7.1f} rps | "
+        f"errors {report['errors']:>4} | p50 {report['p50_ms']:>8.1f} ms | p95 {report['p95_ms']:>8.1f} ms | "
+        f"p99 {report['p99_ms']:>8.1f} ms | batch {report['avg_batch_size']:>5.2f} | "
+        f"cache {report['cache_hit_rate']:>5.1%} | coalesced {report['coalesced']:>4}",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Ramp load against the classification service.")
+    arg_parser.add_argument("--kind", choices=list(KINDS), default="item")
+    arg_parser.add_argument("--rates", default="25,50,100,200,400", help="Offered requests/sec per step")
+    arg_parser.add_argument("--duration", type=float, default=10, help="Seconds per step")
+    arg_parser.add_argument("--repeat-ratio", type=float, default=0.6,
+                            help="Share of requests for keys from the sample; the rest are unique")
+    arg_parser.add_argument("--burst-size", type=int, default=1, help="Requests sent together per arrival")
+    arg_parser.add_argument("--csv", default=SAMPLE_CSV, help="Spend extract to draw keys from")
+    arg_parser.add_argument("--url", help="Test a running service instead of an in-process one with fakes")
+    arg_parser.add_argument("--time-scale", type=float, default=1.0, help="Multiplies the fake latencies")
+    arg_parser.add_argument("--window-ms", type=float, help="Micro-batch window of the in-process service")
+    arg_parser.add_argument("--max-batch-size", type=int, help="Batch size cap of the in-process service")
+    arg_parser.add_argument("--workers", type=int, help="Batches in flight per kind in the in-process service")
+    arg_parser.add_argument("--seed", type=int, default=7)
+    arg_parser.add_argument("--json", help="Also write the step reports to this file")
+    args = arg_parser.parse_args()
+
+    httpd = None
+    url = args.url
+    if url is None:
+        options = {name: value for name, value in (("window_ms", args.window_ms),
+                                                   ("max_batch_size", args.max_batch_size),
+                                                   ("workers", args.workers)) if value is not None}
+        service = ClassificationService(fake_backends(args.time_scale, seed=args.seed), **options)
+        httpd = make_server("127.0.0.1", 0, service)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{httpd.server_port}"
+
+    mix = RequestMix(load_keys(args.csv, args.kind), args.repeat_ratio, args.seed)
+    generator = LoadGenerator(url, args.kind, mix)
+    results = ramp(generator, [float(rate) for rate in args.rates.split(",")], args.duration,
+                   args.burst_size, args.seed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if httpd is not None:
+        httpd.shutdown()
+        httpd.service.close()
@@ -0,0 +1,211 @@
+"""
+logsetup.py
+
+Low-overhead logging for high-throughput runs.
+
+Records are handed to a queue and written by a single listener thread, so
+worker threads never block on console or file I/O. Every record logged while
+a row is processed carries that row's correlation id, kind, id and key (the
+context is copied into stage threads along with the row deadline), and
+``LOG_FORMAT=json`` writes one searchable JSON object per line.
+
+Full per-row detail (parsed results, raw outputs) goes through ``detail``,
+which logs it for a sampled share of rows (``LOG_SAMPLE_RATE``, 1% by
+default) and at DEBUG for the rest. LangChain's agent trace is off unless
+``AGENT_VERBOSE=1``.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict
+
+# Config
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # "text" or "json"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FILE = os.environ.get("LOG_FILE", "")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+AGENT_VERBOSE = os.environ.get("AGENT_VERBOSE", "0") == "1"
+TEXT_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+_row: contextvars.ContextVar = contextvars.ContextVar("log_row", default=None)
+_settings = {"sample_rate": LOG_SAMPLE_RATE, "agent_verbose": AGENT_VERBOSE}
+_listener = None
+
+# Attributes every LogRecord has; anything else was passed with ``extra``
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+@contextlib.contextmanager
+def row_context(kind: str, row_id: Any = None, key: str | None = None):
+    """
+    Tag every record logged in this block, and in the stage calls it makes, with one row's correlation fields.
+
+    Args:
+        kind (str): "items", "suppliers", "contacts" or "request".
+        row_id: The row's id, if it has one.
+        key (str | None): The item code, supplier name or vendor.
+    """
+    token = _row.set({
+        "correlation_id": uuid.uuid4().hex[:12],
+        "row_kind": kind,
+        "row_id": None if row_id is None else str(row_id),
+        "row_key": key,
+        "sampled": random.random() < _settings["sample_rate"],
+    })
+    try:
+        yield
+    finally:
+        _row.reset(token)
+
+
+def current_row() -> Dict[str, Any]:
+    """The correlation fields of the row being processed, or an empty dict."""
+    return _row.get() or {}
+
+
+def is_sampled() -> bool:
+    """Whether the current row was picked for full-detail logging."""
+    return bool(current_row().get("sampled"))
+
+
+def detail(message: str, *args, logger: logging.Logger | None = None):
+    """
+    Log bulky per-row detail: at INFO for sampled rows, at DEBUG for the rest.
+
+    Pass values as ``%s`` arguments rather than an f-string, so unsampled
+    rows never pay for formatting them.
+    """
+    logger = logger or logging.getLogger()
+    if is_sampled():
+        logger.info(message, *args, extra={"detail": True})
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args)
+
+
+def agent_verbose() -> bool:
+    """Whether AgentExecutors should print LangChain's step-by-step trace."""
+    return _settings["agent_verbose"]
+
+
+class CorrelationFilter(logging.Filter):
+    """Copies the current row's correlation fields onto each record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field, value in current_row().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, message, row fields and extras."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES})
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records with their message merged and traceback rendered, but leaves
+    the formatting to the listener's handlers so each can use its own format.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(fmt: str | None = None, level: str | None = None, log_file: str | None = None,
+                      sample_rate: float | None = None, agent_verbose: bool | None = None):
+    """
+    Route all logging through a queue to stderr (and optionally a file) in text or JSON lines.
+
+    Safe to call again: the new listener takes over first, then the previous one
+    writes out what it had queued and its handlers (and any open log file) are closed.
+
+    Args:
+        fmt (str | None): "text" or "json". Defaults to LOG_FORMAT.
+        level (str | None): The root level. Defaults to LOG_LEVEL.
+        log_file (str | None): Also write to this file; empty for stderr only. Defaults to LOG_FILE.
+        sample_rate (float | None): Share of rows logged in full detail. Defaults to LOG_SAMPLE_RATE.
+        agent_verbose (bool | None): Print LangChain's agent trace. Defaults to AGENT_VERBOSE.
+    """
+    global _listener
+    fmt = fmt or LOG_FORMAT
+    log_file = LOG_FILE if log_file is None else log_file
+    if sample_rate is not None:
+        _settings["sample_rate"] = sample_rate
+    if agent_verbose is not None:
+        _settings["agent_verbose"] = agent_verbose
+
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = _RecordQueueHandler(records)
+    queue_handler.addFilter(CorrelationFilter())
+
+    previous = _listener
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    replaced = list(root.handlers)
+    root.addHandler(queue_handler)
+    for handler in replaced:
+        root.removeHandler(handler)
+    root.setLevel(level or LOG_LEVEL)
+    # httpx logs every request at INFO, which is exactly the noise this mode removes
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if previous is not None:
+        _stop_listener(previous)
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    """Write out the listener's queued records, then close its handlers."""
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+@atexit.register
+def stop_logging():
+    """Write out every queued record and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _stop_listener(_listener)
+        _listener = None
@@ -1,7 +1,52 @@
-import streamlit as st
-from pygwalker.api.streamlit import StreamlitRenderer
-import pandas as pd
+"""
+main.py
+
+Streamlit data explorer for classified items.
+
+The explorer frame is loaded once and shared read-only by every session
+through ``st.cache_resource``, rather than pickled and copied into each
+session by ``st.cache_data``. Only the charted columns are read, repetitive
+text such as classification and supplier names is stored as categoricals,
+and integers are downcast. The cache is keyed on the database's
+``data_version``, so the frame is reloaded when the data changes instead of
+never.
+
+Tables larger than the row budget are shown as a spend cube or a stratified
+sample (see explorer.py), with exact drill-down queries run on the server.
+"""
+
+import json
+import os
 import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+from explorer import MIN_PER_STRATUM, ROW_BUDGET, build_cube, choose_view, cube_spec, drill_down, stratified_sample
+
+# Config
+DB_PATH = os.environ.get("SPEND_DB", "spend_intake2.db")
+TABLE_NAME = "AP_Items_For_Classification"
+# Columns the explorer charts, where the table has them; others are not read
+EXPLORER_COLUMNS = [
+    "id", "item_code", "valid", "classification_code", "classification_name", "comments", "website",
+    "spend", "supplier_name", "company_region", "company_division", "bu_region",
+]
+CATEGORICAL_COLUMNS = [
+    "valid", "classification_code", "classification_name", "supplier_name",
+    "company_region", "company_division", "bu_region",
+]
+# Other text columns become categorical when at most this share of their values is distinct
+CATEGORY_RATIO = 0.5
+GW_CONFIG = "gw_config.json"
+# Explorer views offered in the sidebar; "Auto" lets choose_view decide
+VIEWS = {"Auto": None, "All rows": "rows", "Spend cube": "cube", "Stratified sample": "sample"}
+DRILL_DIMENSIONS = ["classification_code", "supplier_name", "region", "month"]
+
+_version_lock = threading.Lock()
+
 
 def connect_to_database(db_file_path: str) -> sqlite3.Connection:
     try:
@@ -11,11 +56,19 @@ def connect_to_database(db_file_path: str) -> sqlite3.Connection:
         st.error(f"Error connecting to database: {e}")
         raise
 
-def import_data_from_db(table_name: str, conn: sqlite3.Connection) -> pd.DataFrame:
+
+def table_columns(conn: sqlite3.Connection, table_name: str) -> list[str]:
+    """The column names of ``table_name``."""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+
+
+def import_data_from_db(table_name: str, conn: sqlite3.Connection, columns: list[str] | None = None) -> pd.DataFrame:
     try:
-        # Use string formatting to insert the table name, but with proper escaping
+        available = table_columns(conn, table_name)
+        selected = [column for column in (columns or available) if column in available]
+        # Use string formatting to insert the table and column names, but with proper escaping
         query = f"""
-        SELECT * 
+        SELECT {", ".join(f'"{column}"' for column in selected)}
         FROM "{table_name}"
         WHERE classification_name IS NOT NULL OR valid != '';
         """
@@ -27,38 +80,186 @@ def import_data_from_db(table_name: str, conn: sqlite3.Connection) -> pd.DataFra
         st.error(f"Error executing SQL query: {e}")
         raise
 
-@st.cache_data
-def load_clean_data(db_file_path: str, db_name: str) -> pd.DataFrame:
-    try:
-        with connect_to_database(db_file_path) as conn:
-            clean_data = import_data_from_db(db_name, conn)
-        return clean_data
-    except Exception as e:
-        st.error(f"Error loading clean data: {e}")
-        return pd.DataFrame()  # Return an empty DataFrame instead of None
+
+def optimize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Shrink a frame in place: categoricals for repetitive text, the smallest integer types for integers.
+
+    Float columns such as spend keep float64, since float32 would round large totals.
+
+    Args:
+        df (pd.DataFrame): The frame as read from SQLite.
+
+    Returns:
+        pd.DataFrame: The same frame.
+    """
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object:
+            if column in CATEGORICAL_COLUMNS or values.nunique() <= CATEGORY_RATIO * len(values):
+                df[column] = values.astype("category")
+        elif np.issubdtype(values.dtype, np.integer):
+            df[column] = pd.to_numeric(values, downcast="integer")
+    return df
+
+
+def memory_mb(df: pd.DataFrame) -> float:
+    """Memory used by ``df``, including the strings it holds, in MB."""
+    return round(df.memory_usage(deep=True).sum() / 2**20, 2)
+
+
+@st.cache_resource
+def _version_connection(db_file_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(db_file_path, check_same_thread=False)
+
+
+def data_version(db_file_path: str) -> tuple:
+    """
+    A token that changes whenever the database does.
+
+    ``PRAGMA data_version`` changes when another connection commits, including
+    writes still in the WAL; the file's mtime and size catch the database being
+    replaced. The pragma is only comparable on one connection, so a long-lived
+    one is kept for it.
+
+    Returns:
+        tuple: (mtime_ns, size, data_version).
+    """
+    stat = os.stat(db_file_path)
+    with _version_lock:
+        version = _version_connection(db_file_path).execute("PRAGMA data_version").fetchone()[0]
+    return stat.st_mtime_ns, stat.st_size, version
+
+
+@st.cache_resource(max_entries=1)
+def load_clean_data(db_file_path: str, db_name: str, version: tuple) -> pd.DataFrame:
+    """
+    Load the explorer frame, shared read-only by all sessions until ``version`` changes.
+
+    ``df.attrs["memory"]`` records the frame's size before and after optimize_frame.
+    Copy the frame before modifying it.
+
+    Args:
+        db_file_path (str): The SQLite database.
+        db_name (str): The table to load.
+        version (tuple): data_version(db_file_path); a new value reloads the frame.
+    """
+    with connect_to_database(db_file_path) as conn:
+        clean_data = import_data_from_db(db_name, conn, EXPLORER_COLUMNS)
+    before = memory_mb(clean_data)
+    clean_data = optimize_frame(clean_data)
+    clean_data.attrs["memory"] = {"before_mb": before, "after_mb": memory_mb(clean_data)}
+    return clean_data
+
+
+@st.cache_resource(max_entries=1)
+def load_cube(db_file_path: str, version: tuple) -> pd.DataFrame:
+    """The spend cube for explorer.build_cube, shared by all sessions until ``version`` changes."""
+    with connect_to_database(db_file_path) as conn:
+        return optimize_frame(build_cube(conn))
+
+
+@st.cache_resource(max_entries=2)
+def load_sample(db_file_path: str, db_name: str, version: tuple, budget: int) -> pd.DataFrame:
+    """A stratified sample of the explorer frame, shared by all sessions until ``version`` changes."""
+    return stratified_sample(load_clean_data(db_file_path, db_name, version), budget)
+
+
+def load_cube_spec(spec_path: str = GW_CONFIG) -> tuple[str, list[str]]:
+    """The saved charts mapped onto the cube's columns (see explorer.cube_spec), as a JSON string."""
+    with open(spec_path) as f:
+        spec, missing = cube_spec(json.load(f))
+    return json.dumps(spec), missing
+
+
+def describe_view(view: str, data: pd.DataFrame) -> str:
+    """A caption saying what the explorer is showing: all rows, a cube, or a sample and its rate."""
+    if view == "cube":
+        return (f"Spend cube: {len(data):,} cells aggregating {int(data['lines'].sum()):,} spend lines "
+                f"by UNSPSC level, supplier, region and month. Totals are exact.")
+    if view == "sample":
+        sampling = data.attrs["sampling"]
+        return (f"Stratified sample: {sampling['rows']:,} of {sampling['population']:,} rows "
+                f"({sampling['rate']:.1%}), stratified by {sampling['strata']}; every code keeps at least "
+                f"{MIN_PER_STRATUM} rows. Weight by sample_weight to estimate totals, or drill down for exact ones.")
+    return f"All {len(data):,} rows."
+
+
+def show_drill_down(cube: pd.DataFrame):
+    """Filters taken from the cube's values, and the exact server-side query they select."""
+    with st.expander("Drill down (exact query)"):
+        columns = st.columns(len(DRILL_DIMENSIONS))
+        filters = {}
+        for column, dimension in zip(columns, DRILL_DIMENSIONS):
+            choice = column.selectbox(dimension, ["(any)"] + sorted(cube[dimension].dropna().unique()))
+            if choice != "(any)":
+                filters[dimension] = choice
+        if st.button("Run query"):
+            with connect_to_database(DB_PATH) as conn:
+                rows, totals = drill_down(conn, filters)
+            spend, lines, items, suppliers = st.columns(4)
+            spend.metric("Spend", f"{totals['spend']:,.2f}")
+            lines.metric("Spend lines", f"{totals['lines']:,}")
+            items.metric("Items", f"{totals['items']:,}")
+            suppliers.metric("Suppliers", f"{totals['suppliers']:,}")
+            st.dataframe(rows, use_container_width=True)
+
 
 def main():
+    from pygwalker.api.streamlit import StreamlitRenderer
+
     st.set_page_config(layout="wide")  # Set wide layout
     st.title("Data Explorer")
 
-    db_file_path = "spend_intake2.db"
-    table_name = "AP_Items_For_Classification"
-
     with st.spinner("Loading clean data..."):
-        clean_data = load_clean_data(db_file_path, table_name)
-        
+        try:
+            version = data_version(DB_PATH)
+            clean_data = load_clean_data(DB_PATH, TABLE_NAME, version)
+        except Exception as e:
+            st.error(f"Error loading clean data: {e}")
+            clean_data = pd.DataFrame()
+
         if clean_data.empty:
             st.error("No data loaded. Please check your database and query.")
             return
 
+        memory = clean_data.attrs["memory"]
+        st.caption(f"{len(clean_data):,} rows in {memory['after_mb']} MB "
+                   f"(down from {memory['before_mb']} MB), shared by all sessions")
+
+        choice = st.sidebar.radio("View", list(VIEWS))
+        budget = int(st.sidebar.number_input("Row budget", min_value=1000, value=ROW_BUDGET, step=1000))
+        try:
+            cube = load_cube(DB_PATH, version)
+        except Exception as e:
+            # No spend_data_raw, or nothing classified yet: row views only
+            st.sidebar.warning(f"Spend cube unavailable: {e}")
+            cube = None
+        if cube is not None and cube.empty:
+            cube = None
+        view = VIEWS[choice] or choose_view(len(clean_data), None if cube is None else len(cube), budget)
+        if view == "cube" and cube is None:
+            view = "sample"
+        data = {"rows": clean_data, "cube": cube}.get(view)
+        if data is None:
+            data = load_sample(DB_PATH, TABLE_NAME, version, budget)
+        st.info(describe_view(view, data))
+        if cube is not None:
+            show_drill_down(cube)
+
         with st.spinner("Loading data explorer..."):
             try:
                 # Initialize pygwalker
-                pyg_html = StreamlitRenderer(clean_data)
+                spec = GW_CONFIG
+                if view == "cube":
+                    spec, missing = load_cube_spec()
+                    if missing:
+                        st.caption(f"Saved charts on the cube leave out fields it does not have: {', '.join(missing)}")
+                pyg_html = StreamlitRenderer(data, spec=spec)
                 pyg_html.explorer()
             except Exception as e:
                 st.error(f"Error initializing PyGWalker: {e}")
                 st.exception(e)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,10 @@
+"""
+scrubber
+
+Cleans the raw spend extract and loads it into spend_data_raw. Run it with
+``python -m misc.scrubber Spend_Intake.csv --db spend_intake2.db``.
+"""
+
+from .pipeline import canonical_keys, clean_header, coerce_types, scrub_chunk, scrub_csv, trim_text
+
+__all__ = ["canonical_keys", "clean_header", "coerce_types", "scrub_chunk", "scrub_csv", "trim_text"]
@@ -0,0 +1,20 @@
+import argparse
+import json
+
+from logsetup import configure_logging
+
+from .pipeline import CHUNK_ROWS, TABLE, scrub_csv
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog="python -m misc.scrubber",
+                                         description="Clean a raw spend extract and load it into SQLite.")
+    arg_parser.add_argument("csv", help="The raw extract")
+    arg_parser.add_argument("--db", default="spend_intake2.db", help="SQLite database to load")
+    arg_parser.add_argument("--table", default=TABLE)
+    arg_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    arg_parser.add_argument("--append", action="store_true", help="Append to the table instead of replacing it")
+    args = arg_parser.parse_args()
+
+    configure_logging()
+    report = scrub_csv(args.csv, args.db, args.table, args.chunk_rows, replace=not args.append)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,206 @@
+"""
+pipeline.py
+
+Chunked, vectorized cleaning of the raw spend extract before it is loaded
+into spend_data_raw. Every step is a whole-column pandas string, numeric or
+datetime operation, and there are no per-row Python loops. Text cleaning
+runs on each column's distinct values (``by_value``): the extract repeats the
+same padded supplier names, descriptions and codes thousands of times, so the
+string work is a small fraction of the row count.
+
+Each chunk is:
+
+- trimmed: the extract pads most text to a fixed width, and blank fields become NULL
+- quote-repaired: stray quotes such as ``"ARS_JDE`` and the ``X",,`` trailer are stripped
+- coerced: measures become numbers, dates are validated as ISO dates, and
+  low-cardinality text becomes categorical
+- keyed: ``supplier_key`` and ``item_key`` are canonical forms of the supplier
+  name and item code, for joins and de-duplication
+
+GL, cost centre and company codes are trimmed but stay text, so leading
+zeros such as company code ``09202`` survive.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from spend_keys import LEGAL_SUFFIXES
+
+# Config
+CHUNK_ROWS = int(os.environ.get("SCRUB_CHUNK_ROWS", "200000"))
+TABLE = "spend_data_raw"
+
+NUMERIC_COLUMNS = [
+    "transaction_line_number", "transaction_line_value", "transaction_line_unit_price",
+    "transaction_line_qty", "uom_volume", "currency_conversion", "payment_terms_days_due",
+    "pay_term_discount_amt", "po_line_number",
+]
+DATE_COLUMNS = ["date_extract", "gl_date", "order_or_invoice_date", "payment_date", "transaction_date"]
+CATEGORICAL_COLUMNS = [
+    "source_system", "gl_account_desc", "cost_centre_code_desc", "transaction_line_desc",
+    "transaction_currency", "uom", "internal_classification_desc", "on_off_catalog", "catalog_name",
+    "payment_terms_desc", "bu_level1", "bu_level2", "bu_level3", "bu_region", "bu_country", "bu_state",
+    "supplier_level1", "supplier_level2", "supplier_level3", "supplier_level4",
+    "category_level1", "category_level2", "category_level3", "category_level4",
+    "order_type", "item_service_line", "vendor_type", "company_name", "company_division",
+    "company_region", "company_zone", "company_service_line", "company_service_type",
+]
+# Trailer column the extract appends to every row; it carries no data
+DROP_COLUMNS = ["eof"]
+
+# A UTF-8 byte order mark, raw or decoded as Latin-1
+_BOM = re.compile("^(\ufeff|ï»¿)+")
+
+
+def by_value(values: pd.Series, fn: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """
+    Apply a vectorized string function to the distinct values of a column and map the results back.
+
+    Args:
+        values (pd.Series): The column.
+        fn: Takes and returns a Series of the same length, e.g. ``lambda s: s.str.strip()``.
+
+    Returns:
+        pd.Series: ``fn`` applied to every row, with nulls kept as nulls.
+    """
+    codes, uniques = pd.factorize(values)
+    cleaned = np.append(fn(pd.Series(uniques, dtype=object)).to_numpy(dtype=object), None)
+    return pd.Series(cleaned[codes], index=values.index)
+
+
+def clean_header(columns: Iterable[str]) -> List[str]:
+    """Strip the byte order mark, stray quotes and trailing commas from the column names."""
+    return [_BOM.sub("", str(name)).strip().strip('"').rstrip('",').strip() for name in columns]
+
+
+def trim_text(df: pd.DataFrame) -> pd.DataFrame:
+    """Trim padding from every text column, repair stray quotes and turn blank fields into NULL."""
+    for column in df.columns:
+        if df[column].dtype != object:
+            continue
+        df[column] = by_value(df[column], _trim)
+    return df
+
+
+def _trim(values: pd.Series) -> pd.Series:
+    values = values.str.strip()
+    if values.str.contains('"', regex=False).any():
+        values = values.str.replace(r'^"+|"+,*$', "", regex=True).str.strip()
+    return values.mask(values == "")
+
+
+def coerce_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert measures to numbers, validate dates and make low-cardinality text categorical."""
+    for column in df.columns.intersection(NUMERIC_COLUMNS):
+        df[column] = pd.to_numeric(df[column], errors="coerce")
+    for column in df.columns.intersection(DATE_COLUMNS):
+        # Keep valid dates as ISO text, which SQLite's date functions read directly
+        df[column] = by_value(df[column], lambda dates: dates.where(
+            pd.to_datetime(dates, format="%Y-%m-%d", errors="coerce").notna()))
+    for column in df.columns.intersection(CATEGORICAL_COLUMNS):
+        df[column] = df[column].astype("category")
+    return df
+
+
+def canonical_keys(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add ``supplier_key`` and ``item_key``.
+
+    ``item_key`` is the item code with whitespace collapsed and case folded,
+    the same form singleflight.normalize_key gives. ``supplier_key`` also
+    drops punctuation and trailing legal suffixes, so ``Rheem Sales Co.`` and
+    ``RHEEM SALES COMPANY INC`` share a key. These are the keys spend_keys
+    computes for the work tables.
+    """
+    if "item_code" in df:
+        df["item_key"] = by_value(df["item_code"],
+                                  lambda codes: codes.str.replace(r"\s+", " ", regex=True).str.casefold())
+    if "supplier_name" in df:
+        df["supplier_key"] = by_value(df["supplier_name"], _supplier_key)
+    return df
+
+
+def _supplier_key(names: pd.Series) -> pd.Series:
+    keys = (
+        names.str.casefold()
+        .str.replace("&", " and ", regex=False)
+        .str.replace(r"[^\w\s]", " ", regex=True)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.strip()
+        .str.replace(LEGAL_SUFFIXES, "", regex=True)
+    )
+    return keys.mask(keys == "")
+
+
+def scrub_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Clean one chunk of the raw extract.
+
+    Args:
+        df (pd.DataFrame): Raw rows read with ``dtype=str``.
+
+    Returns:
+        pd.DataFrame: The cleaned rows, with the trailer column dropped and the key columns added.
+    """
+    df = df.copy()
+    df.columns = clean_header(df.columns)
+    df = df.drop(columns=[column for column in DROP_COLUMNS if column in df])
+    df = trim_text(df)
+    df = coerce_types(df)
+    return canonical_keys(df)
+
+
+def scrub_csv(csv_path: str, db_path: str, table: str = TABLE, chunk_rows: int = CHUNK_ROWS,
+              replace: bool = True) -> Dict[str, Any]:
+    """
+    Clean a raw extract chunk by chunk and load it into SQLite.
+
+    Args:
+        csv_path (str): The raw extract.
+        db_path (str): The SQLite database.
+        table (str): The table to load, spend_data_raw by default.
+        chunk_rows (int): Rows read, cleaned and written at a time.
+        replace (bool): Replace the table rather than append to it.
+
+    Returns:
+        dict: Rows, chunks, seconds, rows/sec, and the sizes of the extract and of the database afterwards.
+    """
+    started = time.monotonic()
+    report = {"rows": 0, "chunks": 0}
+    columns: List[str] = []
+    conn = sqlite3.connect(db_path)
+    try:
+        reader = pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunk_rows,
+                             encoding="utf-8-sig")
+        for raw in reader:
+            clean = scrub_chunk(raw)
+            columns = list(clean.columns)
+            clean.to_sql(table, conn, if_exists="replace" if replace and not report["chunks"] else "append",
+                         index=False)
+            report["rows"] += len(clean)
+            report["chunks"] += 1
+            elapsed = time.monotonic() - started
+            logging.info(f"Scrubbed {report['rows']} rows in {elapsed:.1f}s "
+                         f"({report['rows'] / elapsed:,.0f} rows/s)")
+
+        cursor = conn.cursor()
+        for column in ("supplier_key", "item_key"):
+            if column in columns:
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS main.idx_{table}_{column} ON {table} ({column})")
+        conn.commit()
+    finally:
+        conn.close()
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    report["rows_per_sec"] = round(report["rows"] / report["seconds"]) if report["seconds"] else 0
+    report["csv_mb"] = round(os.path.getsize(csv_path) / 2**20, 1)
+    report["db_mb"] = round(os.path.getsize(db_path) / 2**20, 1)
+    logging.info(f"Scrub report: {report}")
+    return report
@@ -0,0 +1,307 @@
+"""
+priority.py
+
+Spend-weighted priority scheduling for the classification backlog. Spend from
+spend_data_raw is aggregated into a small indexed priority table (optionally
+decayed by recency), the work queries order by it, and SpendCoverage tracks
+the live share of spend classified.
+
+The table is only rebuilt when spend_data_raw (or the decay) has changed
+since the last build. Databases without spend_data_raw are processed in id
+order.
+"""
+
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict
+
+from spend_keys import (KEY_COLUMNS, ensure_key_columns, has_key_columns, item_key, register_key_functions,
+                        supplier_key)
+
+# Work table, its name column, the indexed canonical key joined to spend_data_raw (see
+# spend_keys.py), the priority table, and the conditions that mark a row as classified or pending
+TARGETS = {
+    "items": {
+        "table": "AP_Items_For_Classification",
+        "key": "item_code",
+        "key_column": "item_key",
+        "canonical": item_key,
+        "priority_table": "item_spend_priority",
+        "classified": "{alias}.valid IS NOT NULL AND {alias}.valid != ''",
+        "pending": "({alias}.valid IS NULL OR {alias}.valid = '')",
+    },
+    "suppliers": {
+        "table": "ARS_Supplier_Classification_List",
+        "key": "supplier_name",
+        "key_column": "supplier_key",
+        "canonical": supplier_key,
+        "priority_table": "supplier_spend_priority",
+        "classified": "{alias}.classification_code IS NOT NULL AND {alias}.classification_code != ''",
+        "pending": "({alias}.classification_code IS NULL OR {alias}.classification_code = '')",
+    },
+}
+SPEND_TABLE = "spend_data_raw"
+# What each priority table was built from, so unchanged spend is not re-aggregated
+STATE_TABLE = "spend_priority_state"
+
+MILESTONES = (25, 50, 75, 90, 95, 99)
+
+
+def recency_weight(half_life_days: float | None):
+    """
+    Build the SQLite function that decays spend by the age of its GL date.
+
+    Args:
+        half_life_days (float | None): Age at which spend counts half. None disables decay.
+
+    Returns:
+        Callable: ``weight(age_days)`` for ``conn.create_function``.
+    """
+    def weight(age_days):
+        if not half_life_days or age_days is None:
+            return 1.0
+        return 0.5 ** (max(age_days, 0.0) / half_life_days)
+
+    return weight
+
+
+def has_spend(conn: sqlite3.Connection) -> bool:
+    """Whether the database has a spend_data_raw table to prioritise by."""
+    return conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (SPEND_TABLE,)
+    ).fetchone() is not None
+
+
+def _spend_signature(conn: sqlite3.Connection, half_life_days: float | None) -> str:
+    """Changes whenever spend_data_raw's rows change, or the decay does (daily, with a half-life)."""
+    rows, last_rowid, total = conn.execute(
+        f"SELECT COUNT(*), MAX(rowid), SUM(CAST(transaction_line_value AS REAL)) FROM main.{SPEND_TABLE}"
+    ).fetchone()
+    decay = f"{half_life_days}@{datetime.date.today()}" if half_life_days else "none"
+    return f"canonical-keys:{rows}:{last_rowid}:{total!r}:{decay}"
+
+
+def _aggregate_spend(cursor: sqlite3.Cursor, into: str, key: str, half_life_days: float | None):
+    """Create table ``into`` with the spend and weighted spend of spend_data_raw per ``key`` expression."""
+    weight = "1.0"
+    cursor.execute("DROP TABLE IF EXISTS temp.date_weights")
+    if half_life_days:
+        cursor.execute("CREATE TEMP TABLE date_weights (gl_date TEXT PRIMARY KEY, weight REAL)")
+        decay = recency_weight(half_life_days)
+        cursor.execute(
+            f"SELECT DISTINCT TRIM(gl_date), julianday('now') - julianday(TRIM(gl_date)) FROM main.{SPEND_TABLE}"
+        )
+        cursor.executemany("INSERT OR IGNORE INTO temp.date_weights VALUES (?, ?)",
+                           [(date, decay(age)) for date, age in cursor.fetchall() if date is not None])
+        weight = "COALESCE(d.weight, 1.0)"
+
+    cursor.execute(
+        f"""
+        CREATE TABLE {into} AS
+        SELECT {key} AS key,
+               SUM(CAST(r.transaction_line_value AS REAL)) AS spend,
+               SUM(CAST(r.transaction_line_value AS REAL) * {weight}) AS weighted_spend
+        FROM main.{SPEND_TABLE} r
+        {"LEFT JOIN temp.date_weights d ON d.gl_date = TRIM(r.gl_date)" if half_life_days else ""}
+        WHERE {key} IS NOT NULL
+        GROUP BY {key}
+        """
+    )
+    cursor.execute("DROP TABLE IF EXISTS temp.date_weights")
+
+
+def refresh_priority(conn: sqlite3.Connection, kind: str, half_life_days: float | None = None,
+                     force: bool = False) -> int:
+    """
+    Build the spend priority table for ``kind`` from spend_data_raw, unless it is already current.
+
+    Recency weights are computed once per distinct GL date and joined in,
+    rather than by a Python function called for every spend line. The new
+    table replaces the old one in a single transaction.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        half_life_days (float | None): Recency half-life; None weights all spend equally.
+        force (bool): Rebuild even if spend_data_raw has not changed.
+
+    Returns:
+        int: The number of keys in the priority table.
+    """
+    target = TARGETS[kind]
+    table = target["priority_table"]
+    key = target["key_column"]
+    ensure_key_columns(conn, SPEND_TABLE)
+    ensure_key_columns(conn, target["table"])
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS main.{STATE_TABLE} (priority_table TEXT PRIMARY KEY, signature TEXT)")
+    signature = _spend_signature(conn, half_life_days)
+    cursor.execute(f"SELECT signature FROM main.{STATE_TABLE} WHERE priority_table = ?", (table,))
+    built = cursor.fetchone()
+    if not force and built and built[0] == signature and conn.execute(
+            "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+        count = cursor.execute(f"SELECT COUNT(*) FROM main.{table}").fetchone()[0]
+        logging.info(f"{table} is up to date with {count} keys")
+        return count
+
+    cursor.execute(f"DROP TABLE IF EXISTS main.{table}_next")
+    _aggregate_spend(cursor, f"main.{table}_next", f"r.{key}", half_life_days)
+    cursor.execute(f"DROP TABLE IF EXISTS main.{table}")
+    cursor.execute(f"ALTER TABLE main.{table}_next RENAME TO {table}")
+    cursor.execute(f"CREATE UNIQUE INDEX main.idx_{table}_key ON {table} (key)")
+    cursor.execute(f"INSERT OR REPLACE INTO main.{STATE_TABLE} VALUES (?, ?)", (table, signature))
+    conn.commit()
+    cursor.execute(f"SELECT COUNT(*) FROM main.{table}")
+    count = cursor.fetchone()[0]
+    logging.info(f"Refreshed {table} with {count} keys")
+    return count
+
+
+def preview_priority(conn: sqlite3.Connection, kind: str, half_life_days: float | None = None) -> bool:
+    """
+    Build the priority table for ``kind`` as a temp table, without writing to the database.
+
+    The temp table shadows any stored one in priority_join, so dry runs on a
+    read-only connection list rows in the order a run would. Spend lines
+    whose key column is missing or NULL are keyed from their source column.
+
+    Args:
+        conn: The database connection; may be read-only.
+        kind (str): "items" or "suppliers".
+        half_life_days (float | None): Recency half-life; None weights all spend equally.
+
+    Returns:
+        bool: False if the work table has no key column yet to join on; order by id then.
+    """
+    target = TARGETS[kind]
+    if not has_key_columns(conn, target["table"]):
+        return False
+    key = target["key_column"]
+    source, canonical = KEY_COLUMNS[SPEND_TABLE][key]
+    register_key_functions(conn)
+    computed = f"{canonical.__name__}(r.{source})"
+    if has_key_columns(conn, SPEND_TABLE):
+        computed = f"COALESCE(r.{key}, {computed})"
+    cursor = conn.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{target['priority_table']}")
+    _aggregate_spend(cursor, f"temp.{target['priority_table']}", computed, half_life_days)
+    cursor.execute(f"CREATE UNIQUE INDEX temp.idx_{target['priority_table']}_key ON {target['priority_table']} (key)")
+    return True
+
+
+def prepare_priority(conn: sqlite3.Connection, kind: str,
+                     half_life_days: float | None = None) -> "SpendCoverage | None":
+    """
+    Refresh the priority table and start tracking spend coverage.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        half_life_days (float | None): Recency half-life; None weights all spend equally.
+
+    Returns:
+        SpendCoverage | None: None when the database has no spend_data_raw; process in id order then.
+    """
+    if not has_spend(conn):
+        logging.warning(f"No {SPEND_TABLE} table; processing {kind} in id order without spend coverage")
+        return None
+    refresh_priority(conn, kind, half_life_days)
+    return SpendCoverage(conn, kind)
+
+
+def priority_join(kind: str, alias: str = "w") -> str:
+    """
+    Return the LEFT JOIN that attaches ``weighted_spend`` to work-table rows, on the indexed key column.
+
+    Args:
+        kind (str): "items" or "suppliers".
+        alias (str): The alias used for the work table in the query.
+
+    Returns:
+        str: The JOIN clause; order by ``COALESCE(p.weighted_spend, 0) DESC``.
+    """
+    target = TARGETS[kind]
+    # Unqualified, so a temp table from preview_priority takes precedence over the stored one
+    return f"LEFT JOIN {target['priority_table']} p ON p.key = {alias}.{target['key_column']}"
+
+
+class SpendCoverage:
+    """
+    Live share of total spend covered by classified rows.
+
+    Args:
+        conn: The database connection. The priority table must already exist.
+        kind (str): "items" or "suppliers".
+    """
+
+    def __init__(self, conn: sqlite3.Connection, kind: str):
+        target = TARGETS[kind]
+        self.kind = kind
+        self.canonical = target["canonical"]
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.milestones: Dict[int, float] = {}
+
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COALESCE(SUM(spend), 0) FROM main.{target['priority_table']}")
+        self.total = cursor.fetchone()[0] or 0.0
+        # One row per key: duplicate work rows share their key's spend, which is covered once
+        cursor.execute(
+            f"""
+            SELECT w.{target['key_column']}, MAX(COALESCE(p.spend, 0)),
+                   MAX({target['classified'].format(alias='w')})
+            FROM main.{target['table']} w
+            {priority_join(kind)}
+            GROUP BY w.{target['key_column']}
+            """
+        )
+        self.covered = 0.0
+        self.pending: Dict[str, float] = {}
+        for key, spend, classified in cursor.fetchall():
+            if classified:
+                self.covered += spend
+            else:
+                self.pending[key] = spend
+        self._check_milestones()
+
+    def percent(self) -> float:
+        return 100.0 * self.covered / self.total if self.total else 0.0
+
+    def _check_milestones(self):
+        percent = self.percent()
+        for milestone in MILESTONES:
+            if percent >= milestone and milestone not in self.milestones:
+                self.milestones[milestone] = time.monotonic() - self.started
+                logging.info(
+                    f"{self.kind}: {milestone}% of spend classified "
+                    f"after {self.milestones[milestone]:.0f}s"
+                )
+
+    def record(self, key: str):
+        """
+        Mark ``key`` as classified and update the covered spend.
+
+        Args:
+            key (str): The item code or supplier name that was written.
+        """
+        with self.lock:
+            self.covered += self.pending.pop(self.canonical(key), 0.0)
+            self._check_milestones()
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarise coverage and the time taken to reach each milestone.
+
+        Returns:
+            dict: Percent of spend classified and seconds to each milestone.
+        """
+        with self.lock:
+            return {
+                "percent_spend_classified": round(self.percent(), 2),
+                "covered_spend": round(self.covered, 2),
+                "total_spend": round(self.total, 2),
+                "seconds_to_milestone": {f"{m}%": round(t, 1) for m, t in self.milestones.items()},
+            }
@@ -0,0 +1,123 @@
+"""
+routing.py
+
+Confidence-based tiered model routing. Each row is classified on the cheapest
+tier first and only escalates to the next (search-augmented, then larger model)
+tier when the reported confidence is below the table's threshold.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+from guards import GuardError
+
+# Config: per-table thresholds, overridable with e.g.
+# ROUTING_THRESHOLDS='{"AP_Items_For_Classification": 0.9}'
+DEFAULT_THRESHOLDS = {
+    "AP_Items_For_Classification": 0.8,
+    "ARS_Supplier_Classification_List": 0.75,
+}
+DEFAULT_THRESHOLD = 0.8
+
+CONFIDENCE_INSTRUCTIONS = (
+    "Also report confidence: your calibrated probability between 0 and 1 that the classification "
+    "code is correct. Calibrated means that across many answers given 0.8, about 80% are correct. "
+    "Use a low value whenever the code is a guess or the evidence is thin."
+)
+
+
+def threshold_for(table: str) -> float:
+    """
+    Look up the escalation threshold for a table.
+
+    Args:
+        table (str): The work table name.
+
+    Returns:
+        float: Rows below this confidence escalate to the next tier.
+
+    Raises:
+        ValueError: If ROUTING_THRESHOLDS is not a JSON object of numbers.
+    """
+    try:
+        overrides = json.loads(os.environ.get("ROUTING_THRESHOLDS") or "{}")
+        if not isinstance(overrides, dict):
+            raise ValueError("expected a JSON object")
+        thresholds = {**DEFAULT_THRESHOLDS, **overrides}
+        return float(thresholds.get(table, DEFAULT_THRESHOLD))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid ROUTING_THRESHOLDS: {e}") from e
+
+
+class TieredRouter:
+    """
+    Run a row through increasingly expensive tiers until one is confident enough.
+
+    Args:
+        tiers: ``(name, fn)`` pairs, cheapest first. Each ``fn(key)`` returns a
+            result with a ``confidence`` attribute.
+        threshold (float): Minimum confidence to accept a tier's answer.
+    """
+
+    def __init__(self, tiers: List[Tuple[str, Callable[[str], Any]]], threshold: float):
+        self.tiers = tiers
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.finished = {name: 0 for name, _ in tiers}
+        self.escalated = {name: 0 for name, _ in tiers}
+
+    def classify(self, key: str):
+        """
+        Classify ``key`` on the cheapest tier that meets the threshold.
+
+        The last tier's answer is accepted regardless of its confidence. A tier
+        that raises is treated as an escalation, except for GuardError, which stops the row.
+
+        Args:
+            key (str): The item code or supplier name.
+
+        Returns:
+            The accepted result.
+        """
+        for position, (name, fn) in enumerate(self.tiers):
+            last = position == len(self.tiers) - 1
+            try:
+                result = fn(key)
+            except GuardError:
+                raise
+            except Exception as e:
+                if last:
+                    raise
+                logging.warning(f"Tier {name} failed for {key}, escalating: {e}")
+                result = None
+
+            confidence = getattr(result, "confidence", None) or 0.0
+            if result is not None and (last or confidence >= self.threshold):
+                with self.lock:
+                    self.finished[name] += 1
+                logging.info(f"Routed {key} to tier {name} (confidence {confidence:.2f})")
+                return result
+
+            with self.lock:
+                self.escalated[name] += 1
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarise where rows finished and how often each tier escalated.
+
+        Returns:
+            dict: Per-tier finished counts and escalation rates.
+        """
+        with self.lock:
+            total = sum(self.finished.values())
+            tiers = {}
+            for name, _ in self.tiers:
+                attempted = self.finished[name] + self.escalated[name]
+                tiers[name] = {
+                    "finished": self.finished[name],
+                    "escalation_rate": round(self.escalated[name] / attempted, 3) if attempted else 0.0,
+                }
+        return {"threshold": self.threshold, "rows": total, "tiers": tiers}
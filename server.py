@@ -1,3 +1,591 @@
-from extraction_openai_functions import chain as extraction_openai_functions_chain
+"""
+server.py
 
-add_routes(lookup, extraction_openai_functions_chain, path="\extraction-openai-functions")
+A local HTTP service for on-demand classification from intake forms and
+other internal systems.
+
+    POST /classify/item      {"item_code": "..."}
+    POST /classify/supplier  {"supplier_name": "..."}
+    POST /classify/contact   {"vendor": "..."}
+    POST /classify/<kind>/stream  {"keys": ["...", ...]}  -> NDJSON, one line per key as it finishes
+    GET  /metrics, GET /health
+
+Identical lookups already in flight are coalesced (see singleflight.py), and
+concurrent requests for the same kind are collected for a few milliseconds
+into a micro-batch: the batch's searches run in parallel and its items or
+suppliers are classified with one structured completion, falling back to the
+agent for any row the batch call did not answer. Results are cached, and at
+most ``SERVER_WORKERS`` batches run at once; while they are busy, new
+requests keep accumulating into larger batches instead of queueing one call
+each.
+
+Backends are plain callables ``backend(keys) -> results`` (one result dict or
+exception per key), so tests and load runs can swap in fakes.
+
+Usage: ``python server.py [--host 127.0.0.1] [--port 8080]``
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from hedging import percentile
+from logsetup import configure_logging
+from singleflight import SingleFlight, normalize_key
+
+# Config
+HOST = os.environ.get("SERVER_HOST", "127.0.0.1")
+PORT = int(os.environ.get("SERVER_PORT", "8080"))
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "5"))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "16"))
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "16"))  # batches in flight at once
+SEARCH_WORKERS = int(os.environ.get("SERVER_SEARCH_WORKERS", "32"))
+MAX_QUEUED = int(os.environ.get("SERVER_MAX_QUEUED", "2000"))  # waiting keys per kind before 503s
+CACHE_SIZE = int(os.environ.get("SERVER_CACHE_SIZE", "50000"))
+CACHE_TTL_SECONDS = float(os.environ.get("SERVER_CACHE_TTL_SECONDS", "86400"))
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("SERVER_REQUEST_TIMEOUT_SECONDS", "300"))
+MAX_STREAM_KEYS = 10000
+
+# Request field holding the key for each kind
+KINDS = {"item": "item_code", "supplier": "supplier_name", "contact": "vendor"}
+
+Backend = Callable[[List[str]], List[Any]]
+
+
+class Overloaded(RuntimeError):
+    """Raised when a kind already has MAX_QUEUED keys waiting for a batch."""
+
+
+class ResultCache:
+    """
+    A thread-safe LRU cache of successful results with a time-to-live.
+
+    Args:
+        max_size (int): Entries kept before the least recently used is evicted.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: Tuple[str, str]):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.counts["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts["hits"] += 1
+            return entry[1]
+
+    def put(self, key: Tuple[str, str], value: Dict[str, Any]):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.counts["evictions"] += 1
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {
+                **self.counts,
+                "size": len(self.entries),
+                "hit_rate": round(self.counts["hits"] / lookups, 3) if lookups else 0.0,
+            }
+
+
+class MicroBatcher:
+    """
+    Collects keys submitted within ``window_ms`` into one backend call.
+
+    A dispatcher thread takes up to ``max_batch_size`` waiting keys once the
+    window after the first key has passed and a worker slot is free, so under
+    load batches grow instead of calls queueing. Duplicate keys in a batch are
+    sent to the backend once.
+
+    Args:
+        name (str): The kind, for metrics and logs.
+        backend: Called as ``backend(keys)`` and returns one result or exception per key.
+        executor: The pool the batches run on.
+        max_in_flight (int): Batches running at once for this kind.
+        window_ms (float): How long to wait for more keys after the first one.
+        max_batch_size (int): Keys per backend call.
+        max_queued (int): Waiting keys before submit raises Overloaded.
+    """
+
+    def __init__(self, name: str, backend: Backend, executor: concurrent.futures.Executor,
+                 max_in_flight: int = SERVER_WORKERS, window_ms: float = BATCH_WINDOW_MS,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_queued: int = MAX_QUEUED):
+        self.name = name
+        self.backend = backend
+        self.executor = executor
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_queued = max_queued
+        self.condition = threading.Condition()
+        self.waiting: collections.deque = collections.deque()
+        self.lock = threading.Lock()
+        self.counts = {"batches": 0, "keys": 0, "backend_keys": 0, "rejected": 0, "failed_batches": 0}
+        self.batch_sizes = collections.deque(maxlen=1000)
+        self.queue_waits = collections.deque(maxlen=1000)
+        self.dispatcher = threading.Thread(target=self._dispatch, name=f"batcher-{name}", daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, key: str) -> concurrent.futures.Future:
+        """
+        Queue a key for the next batch.
+
+        Raises:
+            Overloaded: If too many keys are already waiting.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            if len(self.waiting) >= self.max_queued:
+                with self.lock:
+                    self.counts["rejected"] += 1
+                raise Overloaded(f"{len(self.waiting)} {self.name} lookups already queued")
+            self.waiting.append((key, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+                first_at = self.waiting[0][2]
+            delay = first_at + self.window - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.slots.acquire()
+            with self.condition:
+                batch = [self.waiting.popleft() for _ in range(min(self.max_batch_size, len(self.waiting)))]
+            try:
+                self.executor.submit(self._run, batch)
+            except RuntimeError:  # executor shut down
+                self.slots.release()
+                for _, future, _ in batch:
+                    future.cancel()
+                return
+
+    def _run(self, batch: List[Tuple[str, concurrent.futures.Future, float]]):
+        try:
+            started = time.monotonic()
+            unique = list(dict.fromkeys(key for key, _, _ in batch))
+            with self.lock:
+                self.counts["batches"] += 1
+                self.counts["keys"] += len(batch)
+                self.counts["backend_keys"] += len(unique)
+                self.batch_sizes.append(len(unique))
+                self.queue_waits.extend(started - queued_at for _, _, queued_at in batch)
+            try:
+                results = self.backend(unique)
+                if len(results) != len(unique):
+                    raise RuntimeError(f"{self.name} backend returned {len(results)} results for {len(unique)} keys")
+            except Exception as e:
+                logging.error(f"{self.name} batch of {len(unique)} failed: {e}")
+                with self.lock:
+                    self.counts["failed_batches"] += 1
+                results = [e] * len(unique)
+            by_key = dict(zip(unique, results))
+            for key, future, _ in batch:
+                result = by_key[key]
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self.slots.release()
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            batches = self.counts["batches"]
+            return {
+                **self.counts,
+                "waiting": len(self.waiting),
+                "avg_batch_size": round(self.counts["backend_keys"] / batches, 2) if batches else 0.0,
+                "max_batch_size": max(self.batch_sizes, default=0),
+                "queue_wait_p50_ms": round((percentile(self.queue_waits, 50) or 0) * 1000, 2),
+                "queue_wait_p95_ms": round((percentile(self.queue_waits, 95) or 0) * 1000, 2),
+            }
+
+
+_search_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="server-search")
+
+
+def structured_backend(search_fn: Callable[[str], str], batch_fn: Callable[[List[str], List[str]], List[Any]],
+                       fallback_fn: Callable[[str], Any]) -> Backend:
+    """
+    Build a backend that searches every key in parallel, classifies the batch with
+    one completion and sends keys the batch call could not answer to the agent.
+
+    Args:
+        search_fn: e.g. ``agent_item.search_item``.
+        batch_fn: e.g. ``agent_item.classify_items_batch``.
+        fallback_fn: e.g. ``agent_item.process_item_code``.
+
+    Returns:
+        Backend: ``backend(keys)`` returning one result dict or exception per key.
+    """
+    def search(key: str):
+        try:
+            return search_fn(key)
+        except Exception as e:
+            logging.warning(f"Search failed for {key}, using the agent: {e}")
+            return None
+
+    def fallback(key: str):
+        try:
+            return fallback_fn(key).dict()
+        except Exception as e:
+            return e
+
+    def backend(keys: List[str]) -> List[Any]:
+        contexts = list(_search_pool.map(search, keys))
+        searched = [position for position, context in enumerate(contexts) if context is not None]
+        results: List[Any] = [None] * len(keys)
+        try:
+            if searched:
+                answers = batch_fn([keys[i] for i in searched], [contexts[i] for i in searched])
+                for position, answer in zip(searched, answers):
+                    results[position] = answer.dict() if answer is not None else None
+        except Exception as e:
+            logging.warning(f"Batch call for {len(searched)} keys failed, using the agent: {e}")
+        missing = [position for position, result in enumerate(results) if result is None]
+        for position, result in zip(missing, _search_pool.map(fallback, [keys[i] for i in missing])):
+            results[position] = result
+        return results
+
+    return backend
+
+
+def contact_backend(vendors: List[str]) -> List[Any]:
+    """Look up contacts with agent_modular (local extraction, else the agent), one vendor per call, in parallel."""
+    from agent_modular import lookup_contacts
+
+    def lookup(vendor: str):
+        try:
+            contacts = lookup_contacts(vendor, "")
+            if not contacts["emails"] and not contacts["phone_numbers"]:
+                raise ValueError(f"No contact information found for {vendor}")
+            return contacts
+        except Exception as e:
+            return e
+
+    return list(_search_pool.map(lookup, vendors))
+
+
+def default_backends() -> Dict[str, Backend]:
+    """The item, supplier and contact backends built on the agent modules."""
+    import agent_company
+    import agent_item
+
+    return {
+        "item": structured_backend(agent_item.search_item, agent_item.classify_items_batch,
+                                   agent_item.process_item_code),
+        "supplier": structured_backend(agent_company.search_supplier, agent_company.classify_suppliers_batch,
+                                       agent_company.process_company_name),
+        "contact": contact_backend,
+    }
+
+
+class ClassificationService:
+    """
+    Cache lookup, micro-batching and metrics in front of the backends.
+
+    Args:
+        backends (dict | None): Kind -> backend. Defaults to default_backends().
+        workers (int): Batches in flight at once per kind.
+        window_ms (float): Micro-batch collection window.
+        max_batch_size (int): Keys per backend call.
+        cache (ResultCache | None): The result cache.
+    """
+
+    def __init__(self, backends: Dict[str, Backend] | None = None, workers: int = SERVER_WORKERS,
+                 window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE,
+                 cache: ResultCache | None = None):
+        backends = backends or default_backends()
+        self.cache = cache or ResultCache()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers * len(backends), thread_name_prefix="server-batch"
+        )
+        self.batchers = {
+            kind: MicroBatcher(kind, backend, self.executor, workers, window_ms, max_batch_size)
+            for kind, backend in backends.items()
+        }
+        self.flight = SingleFlight("service")
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.latencies = {kind: collections.deque(maxlen=5000) for kind in backends}
+        self.counts = {kind: {"requests": 0, "errors": 0} for kind in backends}
+
+    def _record(self, kind: str, started: float, ok: bool):
+        with self.lock:
+            self.latencies[kind].append(time.monotonic() - started)
+            self.counts[kind]["requests"] += 1
+            if not ok:
+                self.counts[kind]["errors"] += 1
+
+    def submit(self, kind: str, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """
+        Start a lookup, or join the identical one already in flight.
+
+        Returns:
+            tuple: A future for the result dict, and whether it came from the cache.
+
+        Raises:
+            KeyError: If ``kind`` has no backend.
+            Overloaded: If the kind's batch queue is full.
+        """
+        batcher = self.batchers[kind]
+        key = " ".join(str(key).split())
+        cache_key = (kind, normalize_key(key))
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            future = concurrent.futures.Future()
+            future.set_result(cached)
+            return future, True
+        future, leader = self.flight.begin(cache_key)
+        if not leader:
+            return future, False
+        try:
+            batched = batcher.submit(key)
+        except Overloaded as e:
+            future.set_exception(e)
+            self.flight.forget(cache_key, future)
+            raise
+
+        def resolve(done: concurrent.futures.Future):
+            if done.cancelled():
+                future.set_exception(concurrent.futures.CancelledError())
+            elif done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                self.cache.put(cache_key, done.result())
+                future.set_result(done.result())
+            self.flight.forget(cache_key, future)
+
+        batched.add_done_callback(resolve)
+        return future, False
+
+    def classify(self, kind: str, key: str, timeout: float = REQUEST_TIMEOUT_SECONDS) -> Dict[str, Any]:
+        """
+        Classify one key.
+
+        Returns:
+            dict: ``{"key", "result", "cached", "seconds"}``.
+
+        Raises:
+            KeyError, Overloaded: See submit.
+            concurrent.futures.TimeoutError: If no result arrives in time.
+            Exception: Whatever the backend raised for this key.
+        """
+        started = time.monotonic()
+        ok = False
+        try:
+            future, cached = self.submit(kind, key)
+            result = future.result(timeout=timeout)
+            ok = True
+            return {"key": key, "result": result, "cached": cached, "seconds": round(time.monotonic() - started, 4)}
+        finally:
+            if kind in self.counts:
+                self._record(kind, started, ok)
+
+    def classify_many(self, kind: str, keys: List[str],
+                      timeout: float = REQUEST_TIMEOUT_SECONDS) -> Iterator[Dict[str, Any]]:
+        """
+        Classify many keys, yielding each result as soon as it is ready.
+
+        Yields:
+            dict: ``{"key", "result", "cached"}`` or ``{"key", "error"}``.
+        """
+        started = time.monotonic()
+        # Duplicate keys share one future; every requested key still gets its own line
+        futures: Dict[concurrent.futures.Future, List[Tuple[str, bool]]] = {}
+        for key in keys:
+            try:
+                future, cached = self.submit(kind, key)
+            except Overloaded as e:
+                yield {"key": key, "error": str(e)}
+                continue
+            futures.setdefault(future, []).append((key, cached))
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                for key, cached in futures[future]:
+                    try:
+                        yield {"key": key, "result": future.result(), "cached": cached}
+                        self._record(kind, started, True)
+                    except Exception as e:
+                        yield {"key": key, "error": str(e)}
+                        self._record(kind, started, False)
+        except concurrent.futures.TimeoutError:
+            for future, entries in futures.items():
+                if not future.done():
+                    for key, _ in entries:
+                        yield {"key": key, "error": "timed out"}
+
+    def metrics(self) -> Dict[str, Any]:
+        """Request counts, latency percentiles, batching and cache statistics."""
+        with self.lock:
+            requests = {
+                kind: {
+                    **self.counts[kind],
+                    "p50_ms": round((percentile(self.latencies[kind], 50) or 0) * 1000, 2),
+                    "p95_ms": round((percentile(self.latencies[kind], 95) or 0) * 1000, 2),
+                    "p99_ms": round((percentile(self.latencies[kind], 99) or 0) * 1000, 2),
+                }
+                for kind in self.counts
+            }
+        return {
+            "uptime_seconds": round(time.monotonic() - self.started, 1),
+            "requests": requests,
+            "batching": {kind: batcher.report() for kind, batcher in self.batchers.items()},
+            "cache": self.cache.report(),
+            "single_flight": self.flight.report(),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    """JSON request handler; the service is attached to the server as ``server.service``."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, so busy clients don't reconnect per lookup
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        data = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        return data
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send_json(200, service.metrics())
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if len(parts) not in (2, 3) or parts[0] != "classify" or parts[1] not in service.batchers \
+                or (len(parts) == 3 and parts[2] != "stream"):
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        kind = parts[1]
+        try:
+            data = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+
+        if len(parts) == 3:
+            keys = data.get("keys")
+            if not isinstance(keys, list) or not all(isinstance(key, str) and key.strip() for key in keys):
+                self._send_json(400, {"error": "'keys' must be a list of non-empty strings"})
+                return
+            if len(keys) > MAX_STREAM_KEYS:
+                self._send_json(413, {"error": f"At most {MAX_STREAM_KEYS} keys per stream"})
+                return
+            self._stream(service.classify_many(kind, keys))
+            return
+
+        key = data.get(KINDS.get(kind, "key"), data.get("key"))
+        if not isinstance(key, str) or not key.strip():
+            self._send_json(400, {"error": f"Missing '{KINDS.get(kind, 'key')}'"})
+            return
+        try:
+            self._send_json(200, service.classify(kind, key))
+        except Overloaded as e:
+            self._send_json(503, {"error": str(e)})
+        except concurrent.futures.TimeoutError:
+            self._send_json(504, {"error": f"No result for {key} within {REQUEST_TIMEOUT_SECONDS:.0f}s"})
+        except Exception as e:
+            self._send_json(502, {"error": f"Classification failed: {e}"})
+
+    def _stream(self, lines: Iterator[Dict[str, Any]]):
+        """Write each result as an NDJSON line in its own chunk as soon as it is ready."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for line in lines:
+            chunk = (json.dumps(line, default=str) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(chunk):X}\r\n".encode("ascii") + chunk + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class ClassificationHTTPServer(ThreadingHTTPServer):
+    """One thread per connection, with a listen backlog sized for bursts of internal clients."""
+
+    daemon_threads = True
+    request_queue_size = 256
+
+
+def make_server(host: str = HOST, port: int = PORT,
+                service: ClassificationService | None = None) -> ClassificationHTTPServer:
+    """
+    Build the HTTP server without starting it.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind; 0 picks a free one.
+        service (ClassificationService | None): Defaults to one using the real backends.
+
+    Returns:
+        ClassificationHTTPServer: Call ``serve_forever()`` to start it.
+    """
+    server = ClassificationHTTPServer((host, port), ClassificationHandler)
+    server.service = service or ClassificationService()
+    return server
+
+
+if __name__ == "__main__":
+    configure_logging()
+
+    arg_parser = argparse.ArgumentParser(description="Serve item, supplier and contact classification over HTTP.")
+    arg_parser.add_argument("--host", default=HOST)
+    arg_parser.add_argument("--port", type=int, default=PORT)
+    args = arg_parser.parse_args()
+
+    httpd = make_server(args.host, args.port)
+    logging.info(f"Serving classification on http://{args.host}:{httpd.server_port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        httpd.service.close()
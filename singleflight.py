@@ -0,0 +1,161 @@
+"""
+singleflight.py
+
+Single-flight coalescing of identical in-flight lookups. With many workers,
+or several service clients, the same item code or supplier name is often
+being researched at the same moment (duplicate rows in one batch are common).
+A cache only helps once the first lookup has finished; single-flight makes
+concurrent callers with the same normalised key wait on the one call already
+running and share its result or its exception. Transcript events recorded
+by the one call are shared too: every caller commits a copy to its own row.
+"""
+
+import concurrent.futures
+import functools
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from transcripts import store
+
+
+def normalize_key(key: Any) -> str:
+    """Collapse whitespace and case so trivially different spellings are one lookup."""
+    return " ".join(str(key).split()).casefold()
+
+
+class SingleFlight:
+    """
+    Tracks in-flight calls by key so duplicates wait for the first one.
+
+    Args:
+        name (str): Shown in reports, e.g. "items".
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.in_flight: Dict[Hashable, concurrent.futures.Future] = {}
+        self.waiters: Dict[Hashable, int] = {}
+        self.counts = {"calls": 0, "executions": 0, "coalesced": 0, "max_waiters": 0}
+
+    def begin(self, key: Hashable) -> Tuple[concurrent.futures.Future, bool]:
+        """
+        Join the call in flight for ``key``, or register a new one.
+
+        Returns:
+            tuple: The call's future, and True if the caller is the leader and must
+            resolve it and then call ``forget``.
+        """
+        with self.lock:
+            self.counts["calls"] += 1
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.counts["coalesced"] += 1
+                self.waiters[key] += 1
+                self.counts["max_waiters"] = max(self.counts["max_waiters"], self.waiters[key])
+                return future, False
+            future = concurrent.futures.Future()
+            self.in_flight[key] = future
+            self.waiters[key] = 0
+            self.counts["executions"] += 1
+            return future, True
+
+    def forget(self, key: Hashable, future: concurrent.futures.Future):
+        """Stop handing out ``future`` for ``key``; later callers start a new call."""
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+                self.waiters.pop(key, None)
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs):
+        """
+        Call ``fn``, unless a call for ``key`` is already running, in which case wait for its outcome.
+
+        Returns:
+            The result of the one call for ``key``.
+
+        Raises:
+            Whatever that call raised.
+        """
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.forget(key, future)
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            calls = self.counts["calls"]
+            return {
+                **self.counts,
+                "in_flight": len(self.in_flight),
+                "coalesce_rate": round(self.counts["coalesced"] / calls, 3) if calls else 0.0,
+            }
+
+
+flights: Dict[str, SingleFlight] = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(name: str) -> SingleFlight:
+    """The shared SingleFlight for ``name``, created on first use."""
+    with _flights_lock:
+        return flights.setdefault(name, SingleFlight(name))
+
+
+def coalesce(name: str):
+    """
+    Decorate a lookup so concurrent calls with the same normalised arguments run once.
+
+    Args:
+        name (str): The flight to use, e.g. "items".
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(fn: Callable) -> Callable:
+        flight = get_flight(name)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = tuple(normalize_key(arg) for arg in args) + tuple(
+                (keyword, normalize_key(value)) for keyword, value in sorted(kwargs.items())
+            )
+            try:
+                result, events = flight.do(key, buffered_call, *args, **kwargs)
+            except BaseException as e:
+                store.commit(list(getattr(e, "transcript_events", [])))
+                raise
+            store.commit(list(events))
+            return result
+
+        def buffered_call(*args, **kwargs):
+            events = []
+            try:
+                with store.buffered(events):
+                    return fn(*args, **kwargs), events
+            except BaseException as e:
+                e.transcript_events = events
+                raise
+
+        wrapper.flight = flight
+        return wrapper
+
+    return decorator
+
+
+def flight_report() -> Dict[str, Any]:
+    """Summarise calls, executions and coalesced calls per flight, e.g. for the end-of-run log."""
+    with _flights_lock:
+        report = {name: flight.report() for name, flight in flights.items()}
+    logging.info(f"Single-flight report: {report}")
+    return report
@@ -0,0 +1,149 @@
+"""
+spend_keys.py
+
+Canonical item and supplier keys for joining spend to the work tables.
+spend_data_raw and the work tables each carry an indexed ``item_key`` and/or
+``supplier_key`` column, so a join between them is an index lookup rather
+than a ``TRIM(a) = TRIM(b)`` nested loop over both tables.
+
+The keys are the ones the scrubber (misc/scrubber) writes when it loads the
+extract: ``item_key`` is the item code with whitespace collapsed and case
+folded; ``supplier_key`` also drops punctuation and trailing legal suffixes,
+so ``Rheem Sales Co.`` and ``RHEEM SALES COMPANY INC`` share a key. Tables
+loaded some other way get the columns, and missing keys are filled in one
+UPDATE per column.
+
+A trigger clears a row's key whenever its source column is updated, and the
+next ``ensure_key_columns`` refills only the cleared keys, so a renamed
+supplier or corrected item code keeps joining instead of silently dropping
+out of the canonical joins.
+"""
+
+import argparse
+import logging
+import re
+import sqlite3
+from typing import Any, Callable, Dict, Tuple
+
+LEGAL_SUFFIXES = re.compile(
+    r"(?:\s(?:inc|incorporated|llc|l l c|llp|lp|ltd|limited|co|corp|corporation|company|the))+$"
+)
+
+
+def item_key(value: Any) -> str | None:
+    """The canonical form of an item code, or None if it is blank."""
+    key = " ".join(str(value).split()).casefold() if value is not None else ""
+    return key or None
+
+
+def supplier_key(value: Any) -> str | None:
+    """The canonical form of a supplier name, or None if it is blank."""
+    if value is None:
+        return None
+    key = str(value).casefold().replace("&", " and ")
+    key = " ".join(re.sub(r"[^\w\s]", " ", key).split())
+    return LEGAL_SUFFIXES.sub("", key) or None
+
+
+# Table -> key column -> (source column, canonical function)
+KEY_COLUMNS: Dict[str, Dict[str, Tuple[str, Callable[[Any], str | None]]]] = {
+    "spend_data_raw": {"item_key": ("item_code", item_key), "supplier_key": ("supplier_name", supplier_key)},
+    "AP_Items_For_Classification": {"item_key": ("item_code", item_key)},
+    "ARS_Supplier_Classification_List": {"supplier_key": ("supplier_name", supplier_key)},
+}
+
+
+def register_key_functions(conn: sqlite3.Connection):
+    """Make item_key() and supplier_key() available to SQL on ``conn``."""
+    conn.create_function("item_key", 1, item_key, deterministic=True)
+    conn.create_function("supplier_key", 1, supplier_key, deterministic=True)
+
+
+def ensure_key_columns(conn: sqlite3.Connection, table: str) -> int:
+    """
+    Add and index ``table``'s key columns if missing, keep them in step with
+    their source columns, and fill keys that are NULL.
+
+    The first time a key's trigger is created, keys that no longer match
+    their source (edited before the trigger existed) are recomputed too.
+
+    Args:
+        conn: The database connection.
+        table (str): spend_data_raw, AP_Items_For_Classification or ARS_Supplier_Classification_List.
+
+    Returns:
+        int: The number of rows whose keys were filled or recomputed; 0 if the table does not exist.
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA main.table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    if not existing:
+        return 0
+    register_key_functions(conn)
+    filled = 0
+    for column, (source, fn) in KEY_COLUMNS[table].items():
+        if source not in existing:
+            continue
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE main.{table} ADD COLUMN {column} TEXT")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS main.idx_{table.lower()}_{column} ON {table} ({column})")
+        trigger = f"{table.lower()}_{column}_source_changed"
+        stale = f"{column} IS NULL AND {source} IS NOT NULL"
+        if not cursor.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'trigger' AND name = ?",
+                              (trigger,)).fetchone():
+            stale = f"{column} IS NOT {fn.__name__}({source})"
+            cursor.execute(
+                f"""
+                CREATE TRIGGER main.{trigger} AFTER UPDATE OF {source} ON {table}
+                BEGIN
+                    UPDATE {table} SET {column} = NULL WHERE rowid = NEW.rowid;
+                END
+                """
+            )
+        cursor.execute(f"UPDATE main.{table} SET {column} = {fn.__name__}({source}) WHERE {stale}")
+        filled = max(filled, cursor.rowcount)
+    conn.commit()
+    if filled:
+        logging.info(f"Filled canonical keys on {filled} rows of {table}")
+    return filled
+
+
+def has_key_columns(conn: sqlite3.Connection, *tables: str) -> bool:
+    """
+    Whether ``tables`` (default: all keyed tables) that exist already have their key columns.
+
+    Read-only callers, such as dry runs, check this instead of calling ensure_key_columns.
+
+    Args:
+        conn: The database connection.
+        *tables (str): Table names from KEY_COLUMNS.
+
+    Returns:
+        bool: False if any existing table is missing one of its key columns.
+    """
+    for table in tables or KEY_COLUMNS:
+        existing = {row[1] for row in conn.execute(f"PRAGMA main.table_info({table})")}
+        if any(source in existing and column not in existing
+               for column, (source, _) in KEY_COLUMNS[table].items()):
+            return False
+    return True
+
+
+def ensure_spend_keys(conn: sqlite3.Connection):
+    """Key spend_data_raw and both work tables, where they exist."""
+    for table in KEY_COLUMNS:
+        ensure_key_columns(conn, table)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    arg_parser = argparse.ArgumentParser(description="Add, index and fill the canonical key columns.")
+    arg_parser.add_argument("--db", default="spend_intake2.db")
+    args = arg_parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        ensure_spend_keys(conn)
+    finally:
+        conn.close()
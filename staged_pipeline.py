@@ -0,0 +1,311 @@
+"""
+staged_pipeline.py
+
+A three-stage pipeline that overlaps the Serper and OpenAI network waits:
+a search stage prefetches results for upcoming rows into a bounded buffer,
+an LLM stage consumes that buffer, and a single writer stage persists results.
+Each stage has its own concurrency, and queue depths are tracked per stage.
+
+Like the agent path, every stage call for a row runs under the row's
+deadline, transcript key and logging context. The deadline covers the time
+the row is worked on; time spent waiting in the buffer does not count.
+"""
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from hedging import ROW_DEADLINE_SECONDS, row_deadline
+from logsetup import row_context
+from transcripts import store
+
+_DONE = object()
+
+
+class RateLimiter:
+    """
+    A thread-safe limiter that spaces calls to at most ``rate`` per second.
+    """
+
+    def __init__(self, rate: Optional[float]):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class QueueMetrics:
+    """
+    Tracks the depth of a queue every time an item is put on it.
+    """
+
+    def __init__(self, name: str, q: queue.Queue):
+        self.name = name
+        self.queue = q
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.total_depth = 0
+        self.max_depth = 0
+
+    def record(self):
+        depth = self.queue.qsize()
+        with self.lock:
+            self.samples += 1
+            self.total_depth += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            average = self.total_depth / self.samples if self.samples else 0.0
+            return {
+                "depth": self.queue.qsize(),
+                "max_depth": self.max_depth,
+                "avg_depth": round(average, 2),
+            }
+
+
+class StagedPipeline:
+    """
+    Run rows through search -> LLM -> writer stages with independent concurrency.
+
+    Args:
+        search_fn: Called as ``search_fn(key)`` and returns the search context.
+        classify_fn: Called as ``classify_fn(key, context)`` and returns the result.
+        write_fn: Called as ``write_fn(row_id, result)`` from the single writer thread.
+        fallback_fn: Optional, called as ``fallback_fn(key)`` when search or
+            classification fails (e.g. the agent path).
+        search_workers (int): Number of search threads.
+        llm_workers (int): Number of LLM threads.
+        buffer_size (int): Capacity of the prefetched search buffer.
+        search_rate (float | None): Maximum search calls per second.
+        fatal_errors (tuple): Exception types that stop the whole run (e.g. an
+            exhausted budget) instead of failing a single row.
+        kind (str): "items" or "suppliers", for the rows' logging context.
+        on_failure: Optional, called as ``on_failure(row_id, key)`` for every row that
+            fails (no result even after the fallback, or the write failed).
+        row_seconds (float | None): Time allowed per row. Defaults to ROW_DEADLINE_SECONDS.
+    """
+
+    def __init__(
+        self,
+        search_fn: Callable[[str], str],
+        classify_fn: Callable[[str, str], Any],
+        write_fn: Callable[[Any, Any], None],
+        fallback_fn: Optional[Callable[[str], Any]] = None,
+        search_workers: int = 8,
+        llm_workers: int = 8,
+        buffer_size: int = 64,
+        search_rate: Optional[float] = None,
+        fatal_errors: Tuple[type, ...] = (),
+        kind: str = "items",
+        on_failure: Optional[Callable[[Any, str], None]] = None,
+        row_seconds: Optional[float] = None,
+    ):
+        self.search_fn = search_fn
+        self.classify_fn = classify_fn
+        self.write_fn = write_fn
+        self.fallback_fn = fallback_fn
+        self.search_workers = search_workers
+        self.llm_workers = llm_workers
+        self.rate_limiter = RateLimiter(search_rate)
+        self.fatal_errors = fatal_errors
+        self.kind = kind
+        self.on_failure = on_failure
+        self.row_seconds = row_seconds or ROW_DEADLINE_SECONDS
+        self.stopped = threading.Event()
+        self.stop_reason = None
+
+        self.input_queue = queue.Queue(maxsize=search_workers * 2)
+        self.search_buffer = queue.Queue(maxsize=buffer_size)
+        self.write_queue = queue.Queue()
+        self.metrics = {
+            "input": QueueMetrics("input", self.input_queue),
+            "search_buffer": QueueMetrics("search_buffer", self.search_buffer),
+            "write": QueueMetrics("write", self.write_queue),
+        }
+
+        self.lock = threading.Lock()
+        self.counts = {"searched": 0, "search_failed": 0, "classified": 0, "fallback": 0,
+                       "failed": 0, "written": 0, "write_failed": 0}
+        self.active_searchers = search_workers
+        self.active_classifiers = llm_workers
+
+    def _count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _stop(self, key: str, error: Exception):
+        with self.lock:
+            if self.stop_reason is None:
+                self.stop_reason = f"{key}: {error}"
+                logging.error(f"Stopping pipeline at {key}: {error}")
+        self.stopped.set()
+
+    @contextlib.contextmanager
+    def _row(self, row_id: Any, key: str, seconds: float):
+        """Scope a stage call to one row: its remaining deadline, transcript and logging context."""
+        with row_deadline(max(seconds, 1e-3)), store.row(self.kind, row_id), row_context(self.kind, row_id, key):
+            yield
+
+    def _fail(self, row_id: Any, key: str, counter: str = "failed"):
+        self._count(counter)
+        if self.on_failure is not None:
+            try:
+                self.on_failure(row_id, key)
+            except Exception as e:
+                logging.error(f"Failure callback failed for row {row_id}: {e}")
+
+    def _put(self, name: str, q: queue.Queue, item):
+        q.put(item)
+        self.metrics[name].record()
+
+    def _search_worker(self):
+        while True:
+            item = self.input_queue.get()
+            if item is _DONE:
+                break
+            if self.stopped.is_set():
+                continue
+            row_id, key = item
+            self.rate_limiter.wait()
+            started = time.monotonic()
+            try:
+                with self._row(row_id, key, self.row_seconds):
+                    context = self.search_fn(key)
+                self._count("searched")
+            except self.fatal_errors as e:
+                self._stop(key, e)
+                continue
+            except Exception as e:
+                logging.warning(f"Search stage failed for {key}: {e}")
+                self._count("search_failed")
+                context = None
+            remaining = self.row_seconds - (time.monotonic() - started)
+            self._put("search_buffer", self.search_buffer, (row_id, key, context, remaining))
+
+        with self.lock:
+            self.active_searchers -= 1
+            last = self.active_searchers == 0
+        if last:
+            for _ in range(self.llm_workers):
+                self.search_buffer.put(_DONE)
+
+    def _llm_worker(self):
+        while True:
+            item = self.search_buffer.get()
+            if item is _DONE:
+                break
+            if self.stopped.is_set():
+                continue
+            row_id, key, context, remaining = item
+            result = None
+            with self._row(row_id, key, remaining):
+                try:
+                    if context is not None:
+                        result = self.classify_fn(key, context)
+                        self._count("classified")
+                except self.fatal_errors as e:
+                    self._stop(key, e)
+                    continue
+                except Exception as e:
+                    logging.warning(f"LLM stage failed for {key}: {e}")
+                if result is None and self.fallback_fn is not None:
+                    try:
+                        result = self.fallback_fn(key)
+                        self._count("fallback")
+                    except self.fatal_errors as e:
+                        self._stop(key, e)
+                        continue
+                    except Exception as e:
+                        logging.error(f"Fallback failed for {key}: {e}")
+            if result is None:
+                self._fail(row_id, key)
+                continue
+            self._put("write", self.write_queue, (row_id, key, result))
+
+        with self.lock:
+            self.active_classifiers -= 1
+            last = self.active_classifiers == 0
+        if last:
+            self.write_queue.put(_DONE)
+
+    def _writer(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _DONE:
+                break
+            row_id, key, result = item
+            try:
+                self.write_fn(row_id, result)
+                self._count("written")
+            except Exception as e:
+                logging.error(f"Writer stage failed for row {row_id}: {e}")
+                self._fail(row_id, key, "write_failed")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Return the current stage counters and queue-depth metrics.
+        """
+        with self.lock:
+            counts = dict(self.counts)
+            stop_reason = self.stop_reason
+        return {
+            "counts": counts,
+            "queues": {name: m.snapshot() for name, m in self.metrics.items()},
+            "stopped": stop_reason,
+        }
+
+    def run(self, rows: Iterable[Tuple[Any, str]], report_every: float = 10.0) -> Dict[str, Any]:
+        """
+        Push every ``(row_id, key)`` through the pipeline and wait for the writer to finish.
+
+        Args:
+            rows: The rows to process.
+            report_every (float): Seconds between progress log lines.
+
+        Returns:
+            dict: The final snapshot plus elapsed time and rows/sec.
+        """
+        started = time.monotonic()
+        threads = [threading.Thread(target=self._search_worker, daemon=True)
+                   for _ in range(self.search_workers)]
+        threads += [threading.Thread(target=self._llm_worker, daemon=True)
+                    for _ in range(self.llm_workers)]
+        writer = threading.Thread(target=self._writer, daemon=True)
+        for thread in threads + [writer]:
+            thread.start()
+
+        last_report = started
+        for row in rows:
+            if self.stopped.is_set():
+                break
+            self._put("input", self.input_queue, row)
+            if time.monotonic() - last_report >= report_every:
+                logging.info(f"Pipeline progress: {self.snapshot()}")
+                last_report = time.monotonic()
+        for _ in range(self.search_workers):
+            self.input_queue.put(_DONE)
+
+        while writer.is_alive():
+            writer.join(timeout=report_every)
+            if writer.is_alive():
+                logging.info(f"Pipeline progress: {self.snapshot()}")
+
+        elapsed = time.monotonic() - started
+        stats = self.snapshot()
+        stats["elapsed_seconds"] = round(elapsed, 2)
+        stats["rows_per_second"] = round(stats["counts"]["written"] / elapsed, 2) if elapsed else 0.0
+        logging.info(f"Pipeline finished: {stats}")
+        return stats
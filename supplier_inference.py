@@ -0,0 +1,200 @@
+"""
+supplier_inference.py
+
+Derives supplier classifications from the classifications of the items they
+sell, without any LLM calls. One set-based SQL aggregation joins spend_data_raw
+to the classified items, then pandas computes each supplier's spend-weighted
+UNSPSC distribution at class, family and segment level. Suppliers with a
+dominant category are classified directly; ambiguous ones are left for the agent.
+
+Spend is joined to items and suppliers on the indexed canonical keys (see
+spend_keys.py), and only suppliers that are still unclassified are
+aggregated. The assignments are written with one UPDATE ... FROM a temp table.
+"""
+
+import logging
+import sqlite3
+import time
+
+import pandas as pd
+
+from priority import TARGETS as PRIORITY_TARGETS, has_spend
+from spend_keys import ensure_spend_keys, has_key_columns
+from unspsc import LEVEL_COLUMNS, ensure_level_columns, level_values
+
+# Most specific level first: the code prefix length and the zero padding to 8 digits
+LEVELS = [("class", 6), ("family", 4), ("segment", 2)]
+DEFAULT_MIN_DOMINANCE = 0.6
+
+EXTRA_COLUMNS = {"dominance_score": "REAL", "classification_source": "TEXT"}
+RESULT_COLUMNS = ["supplier_key", "classification_code", "classification_name", "level", "dominance_score"]
+
+
+def ensure_inference_columns(conn: sqlite3.Connection):
+    """
+    Add the dominance_score and classification_source columns to the supplier table if missing.
+
+    Args:
+        conn: The database connection.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA main.table_info(ARS_Supplier_Classification_List)")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column, column_type in EXTRA_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE main.ARS_Supplier_Classification_List ADD COLUMN {column} {column_type}")
+    conn.commit()
+
+
+def load_supplier_item_spend(conn: sqlite3.Connection, fill_keys: bool = True) -> pd.DataFrame:
+    """
+    Aggregate spend per unclassified supplier and item classification code in one SQL pass.
+
+    Each row also carries the supplier's total spend across all of its lines,
+    classified items or not, as the denominator for dominance.
+
+    Args:
+        conn: The database connection.
+        fill_keys (bool): Fill missing canonical keys first; False reads them as stored.
+
+    Returns:
+        pd.DataFrame: Columns supplier_key, classification_code, classification_name, spend, total_spend.
+    """
+    if fill_keys:
+        ensure_spend_keys(conn)
+    pending = PRIORITY_TARGETS["suppliers"]["pending"].format(alias="s")
+    query = f"""
+    WITH totals AS (
+        SELECT supplier_key, SUM(CAST(transaction_line_value AS REAL)) AS total_spend
+        FROM main.spend_data_raw
+        WHERE supplier_key IN (SELECT s.supplier_key FROM main.ARS_Supplier_Classification_List s WHERE {pending})
+        GROUP BY supplier_key
+    )
+    SELECT r.supplier_key,
+           TRIM(i.classification_code) AS classification_code,
+           MAX(i.classification_name) AS classification_name,
+           SUM(CAST(r.transaction_line_value AS REAL)) AS spend,
+           MAX(t.total_spend) AS total_spend
+    FROM main.spend_data_raw r
+    JOIN totals t ON t.supplier_key = r.supplier_key
+    JOIN main.AP_Items_For_Classification i ON i.item_key = r.item_key
+    WHERE i.classification_code IS NOT NULL AND TRIM(i.classification_code) != ''
+    GROUP BY r.supplier_key, TRIM(i.classification_code)
+    """
+    return pd.read_sql_query(query, conn)
+
+
+def infer_classifications(spend: pd.DataFrame, min_dominance: float = DEFAULT_MIN_DOMINANCE) -> pd.DataFrame:
+    """
+    Pick each supplier's dominant UNSPSC category from its item spend.
+
+    The most specific level (class, then family, then segment) whose top
+    category holds at least ``min_dominance`` of the supplier's total spend
+    wins. Spend on unclassified items counts against dominance, so a supplier
+    whose classified items are a small share of its spend is left for the agent.
+
+    Args:
+        spend (pd.DataFrame): The output of load_supplier_item_spend.
+        min_dominance (float): Minimum share of spend for a category to be assigned.
+
+    Returns:
+        pd.DataFrame: One row per confidently classified supplier with
+        supplier_key, classification_code, classification_name, level and dominance_score.
+    """
+    spend = spend[spend["spend"] > 0].copy()
+    spend["digits"] = spend["classification_code"].str.replace(r"\D", "", regex=True).str.ljust(8, "0").str[:8]
+    spend = spend[spend["digits"].str.match(r"^[1-9]\d{7}$")]
+    classified = spend.groupby("supplier_key")["spend"].sum()
+    totals = spend.groupby("supplier_key")["total_spend"].max().clip(lower=classified)
+
+    # Exact codes carry names; use them to label rolled-up codes where an item has that code
+    names = spend.drop_duplicates("digits").set_index("digits")["classification_name"]
+
+    assigned = []
+    remaining = set(totals.index)
+    for level, width in LEVELS:
+        spend["code"] = spend["digits"].str[:width].str.ljust(8, "0")
+        by_code = spend[spend["supplier_key"].isin(remaining)].groupby(["supplier_key", "code"])["spend"].sum()
+        if by_code.empty:
+            break
+        top = by_code.sort_values(ascending=False).groupby(level="supplier_key").head(1).reset_index()
+        top["dominance_score"] = top["spend"] / top["supplier_key"].map(totals)
+        top = top[top["dominance_score"] >= min_dominance]
+        top["level"] = level
+        assigned.append(top)
+        remaining -= set(top["supplier_key"])
+
+    if not assigned:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    result = pd.concat(assigned, ignore_index=True).rename(columns={"code": "classification_code"})
+    result["classification_name"] = result["classification_code"].map(names)
+    return result[RESULT_COLUMNS]
+
+
+def infer_supplier_classifications(conn: sqlite3.Connection, min_dominance: float = DEFAULT_MIN_DOMINANCE,
+                                   dry_run: bool = False) -> pd.DataFrame:
+    """
+    Classify unclassified suppliers from their items' classifications.
+
+    Databases without spend_data_raw have nothing to infer from and are left unchanged.
+
+    Args:
+        conn: The database connection.
+        min_dominance (float): Minimum share of spend for a category to be assigned.
+        dry_run (bool): Compute the assignments without writing anything, from the keys as stored.
+
+    Returns:
+        pd.DataFrame: The assignments made (or that would be made).
+    """
+    started = time.monotonic()
+    if not has_spend(conn):
+        logging.info("No spend_data_raw table; skipping supplier inference")
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    if dry_run and not has_key_columns(conn):
+        logging.info("Canonical keys have not been added yet; nothing to preview for supplier inference")
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    inferred = infer_classifications(load_supplier_item_spend(conn, fill_keys=not dry_run), min_dominance)
+
+    if not dry_run and not inferred.empty:
+        ensure_inference_columns(conn)
+        ensure_level_columns(conn, "suppliers")
+        columns = ["supplier_key", "classification_code", "classification_name", "comments", "dominance_score",
+                   *LEVEL_COLUMNS]
+        cursor = conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS temp.inferred_suppliers")
+        cursor.execute(f"CREATE TEMP TABLE inferred_suppliers ({', '.join(columns)}, PRIMARY KEY (supplier_key))")
+        cursor.executemany(
+            f"INSERT INTO temp.inferred_suppliers VALUES ({', '.join('?' for _ in columns)})",
+            [
+                (
+                    row.supplier_key,
+                    row.classification_code,
+                    row.classification_name,
+                    f"Inferred from item classifications: {row.dominance_score:.0%} of spend in {row.level} "
+                    f"{row.classification_code}",
+                    float(row.dominance_score),
+                    *level_values(row.classification_code).values(),
+                )
+                for row in inferred.itertuples(index=False)
+            ],
+        )
+        cursor.execute(
+            f"""
+            UPDATE main.ARS_Supplier_Classification_List AS s
+            SET valid = 1, classification_code = x.classification_code,
+                classification_name = x.classification_name, comments = x.comments,
+                dominance_score = x.dominance_score, classification_source = 'item_inference',
+                {", ".join(f"{column} = x.{column}" for column in LEVEL_COLUMNS)}
+            FROM temp.inferred_suppliers AS x
+            WHERE s.supplier_key = x.supplier_key
+              AND {PRIORITY_TARGETS["suppliers"]["pending"].format(alias="s")}
+            """
+        )
+        cursor.execute("DROP TABLE temp.inferred_suppliers")
+        conn.commit()
+
+    logging.info(
+        f"Inferred classifications for {len(inferred)} suppliers in {time.monotonic() - started:.1f}s"
+        f"{' (dry run)' if dry_run else ''}"
+    )
+    return inferred
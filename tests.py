@@ -4,36 +4,76 @@ import sqlite3
 
 from agent_item import (
     GetItemData,
+    GetItemDataBatch,
     process_item_code,
-    get_items_without_classification,
+    get_items_to_process,
     update_item_info,
     process_single_item,
     process_items,
 )
+from assistant_runs import HeadlessAssistantManager
+from cli import Progress, load_profile, reclassify as reclassify_rows, run
+from agent_modular import clean_and_parse_output
+from condense import condense_results, terms_for
+from contacts import extract_contacts, inbox_type
+from fast_path import match_batch, needs_search, strict_response_format
+from explorer import build_cube, choose_view, cube_spec, drill_down, spend_lines, stratified_sample
+from fingerprints import ensure_hash_columns, find_changed, reclassify, select_rows, stamp
+from hedging import Stage, StageCancelled, StageTimeout, check_cancelled
+from guards import BudgetExceeded, CircuitBreaker, CircuitOpenError, ProviderError, RunBudget, is_provider_failure
+from import_budget import parse_importtime
+from json_stream import JSONStream, StreamParseError
+from logsetup import configure_logging, detail, row_context, stop_logging
+from main import data_version, load_clean_data
+from misc.scrubber import scrub_chunk, scrub_csv
+from loadtest import LoadGenerator, RequestMix, arrivals, fake_backends, load_keys, ramp
+from server import ClassificationService, make_server, structured_backend
+from spend_keys import ensure_key_columns, ensure_spend_keys, item_key, supplier_key
+from supplier_inference import infer_supplier_classifications
+from priority import SpendCoverage, prepare_priority, refresh_priority
+from routing import DEFAULT_THRESHOLD, TieredRouter, threshold_for
+from singleflight import SingleFlight, coalesce
+from staged_pipeline import QueueMetrics, RateLimiter, StagedPipeline
+from unspsc import backfill, ensure_level_columns, levels, rollup, write_levels
+from transcripts import TranscriptStore, reparse
+
+
+def item_data(item_code="12345", classification_code="40101701"):
+    return GetItemData(
+        item_code=item_code,
+        validation=True,
+        classification_code=classification_code,
+        classification_name="Air conditioners",
+        website="http://example.com",
+        comments="Test comment",
+    )
+
+
+def items_db(path=":memory:"):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT, "
+                 "classification_code TEXT, classification_name TEXT, comments TEXT, website TEXT)")
+    conn.executemany("INSERT INTO AP_Items_For_Classification (id, item_code, valid) VALUES (?, ?, ?)",
+                     [(1, "12345", None), (2, "67890", ""), (3, "DONE", "1")])
+    conn.commit()
+    return conn
 
 
 class TestItemProcessing(unittest.TestCase):
 
-    @patch("agent_item.create_openai_functions_agent")
-    @patch("agent_item.GoogleSerperAPIWrapper.run")
-    @patch("agent_item.PydanticOutputParser.parse")
-    def test_process_item_code(self, mock_parse, mock_run, mock_create_agent):
-        # Set up mocks
-        mock_create_agent.return_value = MagicMock()
-        mock_run.return_value = {
-            "output": '{"item_code": "12345", "validation": true, "classification_code": "1234", "classification_name": "Test Item", "website": "http://example.com", "comments": "Test comment"}'
+    @patch("agent_item.get_google_search")
+    @patch("agent_item.get_llm")
+    @patch("langchain.agents.AgentExecutor")
+    @patch("langchain.agents.create_openai_functions_agent")
+    @patch("agent_item.run_stage")
+    def test_process_item_code(self, mock_run_stage, mock_create_agent, mock_executor, mock_llm, mock_search):
+        mock_run_stage.return_value = {
+            "output": '{"item_code": "12345", "validation": true, "classification_code": "1234", '
+                      '"classification_name": "Test Item", "website": "http://example.com", '
+                      '"comments": "Test comment"}'
         }
-        mock_parse.return_value = GetItemData(
-            item_code="12345",
-            validation=True,
-            classification_code="1234",
-            classification_name="Test Item",
-            website="http://example.com",
-            comments="Test comment",
-        )
 
-        item_code = "12345"
-        result = process_item_code(item_code)
+        result = process_item_code("12345")
 
         self.assertEqual(result.item_code, "12345")
         self.assertTrue(result.validation)
@@ -41,116 +81,1554 @@ class TestItemProcessing(unittest.TestCase):
         self.assertEqual(result.classification_name, "Test Item")
         self.assertEqual(result.website, "http://example.com")
         self.assertEqual(result.comments, "Test comment")
+        self.assertEqual(mock_run_stage.call_args.args[0], "agent")
 
-    @patch("your_module.sqlite3.connect")
-    def test_get_items_without_classification(self, mock_connect):
-        # Mock database cursor
-        mock_cursor = MagicMock()
-        mock_cursor.fetchall.return_value = [(1, "12345"), (2, "67890")]
-        mock_connect.return_value.cursor.return_value = mock_cursor
-
-        conn = mock_connect.return_value
-        cursor = conn.cursor()
-        items = get_items_without_classification(cursor, 100)
-
-        self.assertEqual(len(items), 2)
-        self.assertEqual(items[0], (1, "12345"))
-        self.assertEqual(items[1], (2, "67890"))
-
-    @patch("your_module.sqlite3.connect")
-    def test_update_item_info(self, mock_connect):
-        # Mock database cursor
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-
-        conn = mock_connect.return_value
-        item_data = GetItemData(
-            item_code="12345",
-            validation=True,
-            classification_code="1234",
-            classification_name="Test Item",
-            website="http://example.com",
-            comments="Test comment",
-        )
+    def test_get_items_to_process(self):
+        conn = items_db()
+        items = get_items_to_process(conn.cursor(), 100)
 
-        update_item_info(conn, 1, item_data)
-
-        mock_cursor.execute.assert_called_once_with(
-            """
-            UPDATE main.item_descriptions
-            SET valid = ?, classification_code = ?, classification_name = ?, 
-                comments = ?, website = ?
-            WHERE id = ?
-        """,
-            (
-                item_data.validation,
-                item_data.classification_code,
-                item_data.classification_name,
-                item_data.comments,
-                item_data.website,
-                1,
-            ),
-        )
+        self.assertEqual(items, [(1.0, "12345"), (2.0, "67890")])
+        self.assertEqual(get_items_to_process(conn.cursor(), 1), [(1.0, "12345")])
+
+    def test_update_item_info(self):
+        conn = items_db()
+        ensure_level_columns(conn, "items")
+
+        update_item_info(conn, 1, item_data())
+
+        row = conn.execute("SELECT valid, classification_code, classification_name, comments, website, "
+                           "unspsc_class FROM AP_Items_For_Classification WHERE id = 1").fetchone()
+        self.assertEqual(row, ("1", "40101701", "Air conditioners", "Test comment", "http://example.com", 40101700))
 
     @patch("agent_item.process_item_code")
-    @patch("agent_item.update_item_info")
-    @patch("agent_item.get_items_without_classification")
-    @patch("agent_item.sqlite3.connect")
-    def test_process_single_item(
-        self, mock_connect, mock_get_items, mock_update_info, mock_process_item_code
-    ):
-        # Mock database cursor and other functions
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-
-        mock_get_items.return_value = [(1, "12345")]
-        mock_process_item_code.return_value = GetItemData(
-            item_code="12345",
-            validation=True,
-            classification_code="1234",
-            classification_name="Test Item",
-            website="http://example.com",
-            comments="Test comment",
-        )
-        mock_update_info.return_value = None
-
-        result = process_single_item(1, "12345", mock_connect.return_value)
-
-        self.assertTrue(result)
-        mock_process_item_code.assert_called_once_with("12345")
-        mock_update_info.assert_called_once_with(
-            mock_connect.return_value,
-            1,
-            GetItemData(
-                item_code="12345",
-                validation=True,
-                classification_code="1234",
-                classification_name="Test Item",
-                website="http://example.com",
-                comments="Test comment",
-            ),
-        )
+    def test_process_single_item(self, mock_process_item_code):
+        mock_process_item_code.side_effect = [ValueError("no result"), item_data()]
+
+        success, result = process_single_item("1", "12345 (W1")
+
+        self.assertTrue(success)
+        self.assertEqual(result, item_data())
+        self.assertEqual([call.args[0] for call in mock_process_item_code.call_args_list], ["12345 (W1", "12345"])
 
+    @patch("agent_item.store")
     @patch("agent_item.process_single_item")
-    @patch("agent_item.get_items_without_classification")
-    @patch("agent_item.sqlite3.connect")
-    def test_process_items(
-        self, mock_connect, mock_get_items, mock_process_single_item
-    ):
-        # Mock database cursor and other functions
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-
-        mock_get_items.return_value = [(1, "12345")]
-        mock_process_single_item.return_value = True
-
-        process_items(batch_size=100)
-
-        mock_get_items.assert_called_once_with(mock_cursor, 100)
-        mock_process_single_item.assert_called_once_with(
-            1, "12345", mock_connect.return_value
+    def test_process_items(self, mock_process_single_item, mock_store):
+        import os
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), "items.db")
+        items_db(path).close()
+        mock_process_single_item.side_effect = lambda id, item_code, mode, router: (True, item_data(item_code))
+
+        process_items(batch_size=100, max_items=100, by_spend=False, db_path=path)
+
+        self.assertEqual(sorted(call.args[1] for call in mock_process_single_item.call_args_list), ["12345", "67890"])
+        conn = sqlite3.connect(path)
+        pending = conn.execute("SELECT COUNT(*) FROM AP_Items_For_Classification "
+                               "WHERE valid IS NULL OR valid = ''").fetchone()[0]
+        self.assertEqual(pending, 0)
+
+
+class TestFastPath(unittest.TestCase):
+
+    def test_needs_search(self):
+        self.assertTrue(needs_search("UP18AZ48AJVCA (W18231586"))
+        self.assertTrue(needs_search("Honeywell thermostat"))  # a product name without digits
+        self.assertTrue(needs_search("Rent check 4513040"))  # a part number wins over "rent"
+        self.assertFalse(needs_search("Sales tax"))
+        self.assertFalse(needs_search("Peter Aardema (Base Rent)"))
+        self.assertFalse(needs_search("JOB/FIELD TICKET PURCHASE"))
+        self.assertFalse(needs_search("  "))
+
+    def test_strict_response_format(self):
+        schema = strict_response_format(GetItemDataBatch)["json_schema"]["schema"]
+        self.assertEqual(schema["required"], ["results"])
+        item = schema["properties"]["results"]["items"]
+        self.assertFalse(item["additionalProperties"])
+        self.assertEqual(set(item["required"]), set(GetItemData.__fields__))
+        self.assertIn({"type": "null"}, item["properties"]["website"]["anyOf"])
+        self.assertNotIn("anyOf", item["properties"]["item_code"])
+
+    def test_stream_is_read_to_its_usage_chunk(self):
+        from types import SimpleNamespace as NS
+
+        from fast_path import stream_structured
+
+        def chunk(content, usage=None):
+            return NS(content=content, additional_kwargs={}, usage_metadata=usage)
+
+        class Chain:
+            first = NS(format=lambda **inputs: "prompt")
+
+            def __init__(self, chunks):
+                self.chunks, self.read = chunks, 0
+
+            def stream(self, inputs):
+                for item in self.chunks:
+                    self.read += 1
+                    yield item
+
+        usage = {"input_tokens": 10, "output_tokens": 5, "total_tokens": 15}
+        with patch("fast_path.budget") as budget:
+            chain = Chain([chunk('{"item_code": "A1"'), chunk("}"), chunk(""), chunk("", usage)])
+            parser, _ = stream_structured(chain, {}, None)
+            self.assertEqual(chain.read, 4)  # finish and usage chunks after the object
+            budget.charge.assert_not_called()  # the callback charges the reported usage
+
+            chain = Chain([chunk('{"item_code": "A1"}'), chunk(" Let me know"), chunk("", usage)])
+            stream_structured(chain, {}, None)
+            self.assertEqual(chain.read, 2)  # trailing text closes the stream
+            budget.charge.assert_called_once()
+        self.assertEqual(parser.parse(), {"item_code": "A1"})
+
+    def test_match_batch(self):
+        answer = lambda code: GetItemData(item_code=code, validation=True)
+        reordered = [answer("b  2"), answer("A1")]
+        self.assertEqual([r.item_code for r in match_batch(["a1", "B 2"], reordered, "item_code")], ["A1", "b  2"])
+        # A rewritten key still lines up by position when every key got an answer
+        rewritten = [answer("X"), answer("A1")]
+        self.assertEqual(match_batch(["A1 (W123", "A1"], rewritten, "item_code")[0].item_code, "X")
+        # Reordered and rewritten: the slot's result belongs to another key, so the unmatched one is used
+        shuffled = [answer("B2"), answer("A1")]
+        self.assertEqual([r.item_code for r in match_batch(["A1 (W123", "B2"], shuffled, "item_code")], ["A1", "B2"])
+        self.assertEqual(match_batch(["A1", "B2", "C3"], [answer("A1")], "item_code")[1:], [None, None])
+
+
+class TestStagedPipeline(unittest.TestCase):
+
+    def test_rate_limiter_spaces_calls(self):
+        import time
+
+        limiter = RateLimiter(50)
+        started = time.monotonic()
+        for _ in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - started, 5 / 50 - 0.01)
+        RateLimiter(None).wait()  # unlimited never sleeps
+
+    def test_queue_metrics(self):
+        import queue
+
+        q = queue.Queue()
+        metrics = QueueMetrics("q", q)
+        for item in range(3):
+            q.put(item)
+            metrics.record()
+        q.get()
+        self.assertEqual(metrics.snapshot(), {"depth": 2, "max_depth": 3, "avg_depth": 2.0})
+
+    def test_search_prefetches_up_to_the_buffer_while_the_llm_stage_is_blocked(self):
+        import threading
+        import time
+
+        release = threading.Event()
+        searched = []
+
+        def search(key):
+            searched.append(key)
+            return key
+
+        def classify(key, context):
+            release.wait(5)
+            return context
+
+        pipeline = StagedPipeline(search, classify, lambda row_id, result: None,
+                                  search_workers=2, llm_workers=1, buffer_size=3)
+        runner = threading.Thread(target=pipeline.run, args=([(i, f"k{i}") for i in range(20)],), daemon=True)
+        runner.start()
+        time.sleep(0.3)
+        # One row held by the LLM worker, three buffered, and one waiting to be buffered per search worker
+        self.assertGreaterEqual(len(searched), 4)
+        self.assertLessEqual(len(searched), 1 + 3 + 2)
+        self.assertLessEqual(pipeline.metrics["search_buffer"].snapshot()["max_depth"], 3)
+        release.set()
+        runner.join(5)
+        self.assertEqual(pipeline.snapshot()["counts"]["written"], 20)
+
+    def test_rows_get_context_deadline_and_failures_are_reported(self):
+        from hedging import _row_deadline
+        from logsetup import current_row
+
+        seen, failed, written = {}, [], []
+
+        def classify(key, context):
+            seen[key] = (current_row().get("row_id"), current_row().get("row_kind"), _row_deadline.get())
+            if key == "bad":
+                raise ValueError("malformed")
+            return key
+
+        def write(row_id, result):
+            if result == "unwritable":
+                raise OSError("disk full")
+            written.append(row_id)
+
+        stats = StagedPipeline(lambda key: key, classify, write, kind="suppliers",
+                               on_failure=lambda row_id, key: failed.append(row_id), row_seconds=30,
+                               search_workers=1, llm_workers=1).run([(1, "good"), (2, "bad"), (3, "unwritable")])
+        self.assertEqual(seen["good"][:2], ("1", "suppliers"))
+        self.assertIsNotNone(seen["good"][2])
+        self.assertEqual(written, [1])
+        self.assertEqual(sorted(failed), [2, 3])
+        self.assertEqual((stats["counts"]["failed"], stats["counts"]["write_failed"]), (1, 1))
+
+
+class TestRouting(unittest.TestCase):
+
+    def test_threshold_for_reads_overrides(self):
+        import os
+
+        with patch.dict(os.environ, {"ROUTING_THRESHOLDS": ""}):
+            self.assertEqual(threshold_for("AP_Items_For_Classification"), 0.8)
+        with patch.dict(os.environ, {"ROUTING_THRESHOLDS": '{"AP_Items_For_Classification": "0.95"}'}):
+            self.assertEqual(threshold_for("AP_Items_For_Classification"), 0.95)
+            self.assertEqual(threshold_for("ARS_Supplier_Classification_List"), 0.75)
+            self.assertEqual(threshold_for("Other"), DEFAULT_THRESHOLD)
+        for invalid in ("0.9", "{not json", '{"AP_Items_For_Classification": "high"}'):
+            with patch.dict(os.environ, {"ROUTING_THRESHOLDS": invalid}):
+                with self.assertRaises(ValueError):
+                    threshold_for("AP_Items_For_Classification")
+
+    def tier(self, confidence=None, error=None):
+        calls = []
+
+        def fn(key):
+            calls.append(key)
+            if error:
+                raise error
+            return None if confidence is None else GetItemData(item_code=key, validation=True, confidence=confidence)
+
+        fn.calls = calls
+        return fn
+
+    def test_escalates_until_confident(self):
+        cheap, search, large = self.tier(0.5), self.tier(0.9), self.tier(0.99)
+        router = TieredRouter([("cheap", cheap), ("search", search), ("large", large)], threshold=0.8)
+        self.assertEqual(router.classify("A1").confidence, 0.9)
+        self.assertEqual((len(cheap.calls), len(search.calls), len(large.calls)), (1, 1, 0))
+        report = router.report()
+        self.assertEqual(report["tiers"]["cheap"], {"finished": 0, "escalation_rate": 1.0})
+        self.assertEqual(report["tiers"]["search"], {"finished": 1, "escalation_rate": 0.0})
+
+    def test_failing_tier_escalates_and_last_tier_is_accepted(self):
+        router = TieredRouter([("cheap", self.tier(error=ValueError("bad JSON"))), ("large", self.tier(0.1))], 0.8)
+        self.assertEqual(router.classify("A1").confidence, 0.1)
+        with self.assertRaises(ValueError):
+            TieredRouter([("only", self.tier(error=ValueError("down")))], 0.8).classify("A1")
+
+    def test_guard_error_stops_the_row(self):
+        large = self.tier(0.99)
+        router = TieredRouter([("cheap", self.tier(error=BudgetExceeded("spent"))), ("large", large)], 0.8)
+        with self.assertRaises(BudgetExceeded):
+            router.classify("A1")
+        self.assertEqual(large.calls, [])
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class TestGuards(unittest.TestCase):
+
+    def call_failing(self, breaker, error):
+        def call():
+            raise error
+        with self.assertRaises(type(error)):
+            breaker.call(call)
+
+    def test_only_transport_5xx_and_429_are_provider_failures(self):
+        self.assertTrue(is_provider_failure(HTTPError(503)))
+        self.assertTrue(is_provider_failure(HTTPError(429)))
+        self.assertTrue(is_provider_failure(ConnectionResetError("reset")))
+        self.assertTrue(is_provider_failure(ProviderError("serper", TimeoutError("slow"))))
+        self.assertFalse(is_provider_failure(HTTPError(400)))
+        self.assertFalse(is_provider_failure(StreamParseError("bad JSON")))
+        self.assertFalse(is_provider_failure(ValueError("validation error")))
+
+    def test_breaker_trips_probes_and_closes(self):
+        breaker = CircuitBreaker("openai", window=4, min_calls=4, cooldown=0.05, max_pause=5)
+        for _ in range(4):
+            self.call_failing(breaker, StreamParseError("bad JSON"))
+        self.assertEqual(breaker.report()["state"], "closed")
+        for _ in range(2):
+            self.call_failing(breaker, HTTPError(500))
+        self.assertEqual(breaker.report(), {"state": "open", "trips": 1})
+        # The next call waits out the cooldown and goes through as the probe; a failed probe re-opens
+        self.call_failing(breaker, HTTPError(429))
+        self.assertEqual(breaker.report(), {"state": "open", "trips": 2})
+        self.assertEqual(breaker.call(lambda: "ok"), "ok")
+        self.assertEqual(breaker.report()["state"], "closed")
+
+    def test_open_breaker_raises_after_max_pause(self):
+        breaker = CircuitBreaker("serper", window=1, min_calls=1, cooldown=60, max_pause=0.05)
+        self.call_failing(breaker, ProviderError("serper", ConnectionError("down")))
+        with self.assertRaises(CircuitOpenError):
+            breaker.call(lambda: "ok")
+
+    def test_other_providers_errors_are_not_counted(self):
+        breaker = CircuitBreaker("openai", window=1, min_calls=1)
+        self.call_failing(breaker, ProviderError("serper", ConnectionError("down")))
+        self.assertEqual(breaker.report()["state"], "closed")
+
+    def test_slow_calls_trip_the_breaker(self):
+        breaker = CircuitBreaker("openai", slow_call_seconds=0.0, window=2, min_calls=2)
+        breaker.call(lambda: "ok")
+        breaker.call(lambda: "ok")
+        self.assertEqual(breaker.report()["state"], "open")
+
+    def test_agent_runs_use_their_own_breaker(self):
+        from guards import breakers, call_agent
+
+        agent = CircuitBreaker("agent", slow_call_seconds=0.0, window=1, min_calls=1)
+        openai = CircuitBreaker("openai", slow_call_seconds=60.0, window=1, min_calls=1)
+        with patch.dict(breakers, {"agent": agent, "openai": openai}):
+            self.assertEqual(call_agent(lambda: {"output": "ok"}), {"output": "ok"})
+        # A slow multi-step run is recorded against the agent breaker only
+        self.assertEqual(agent.report()["state"], "open")
+        self.assertEqual(openai.report()["state"], "closed")
+
+    def test_budget_reservations_count_until_settled(self):
+        budget = RunBudget(max_tokens=1000)
+        first = budget.reserve(tokens=600)
+        with self.assertRaises(BudgetExceeded):
+            budget.reserve(tokens=600)  # would pass a check-only budget while the first call is in flight
+        budget.settle(first, tokens=300)
+        second = budget.reserve(tokens=600)
+        self.assertEqual(budget.report()["in_flight"]["tokens"], 600)
+        budget.settle(second, tokens=700)
+        self.assertEqual(budget.report()["spent"]["tokens"], 1000)
+        with self.assertRaises(BudgetExceeded):
+            budget.check()
+
+    def test_budget_prices_reservations_at_the_average_cost(self):
+        budget = RunBudget(max_dollars=1.0)
+        budget.settle(budget.reserve(tokens=100), tokens=1000, dollars=0.5)
+        self.assertAlmostEqual(budget.reserve(tokens=500)["dollars"], 0.25)
+        with self.assertRaises(BudgetExceeded):
+            budget.reserve(tokens=1000)
+        budget.configure(max_search_calls=1)
+        budget.settle(budget.reserve(search_calls=1), search_calls=1)
+        with self.assertRaises(BudgetExceeded):
+            budget.reserve(search_calls=1)
+
+
+class TestClients(unittest.TestCase):
+
+    def test_pool_stats_count_requests_connections_and_handshakes(self):
+        import httpx
+
+        from clients import PoolStats
+
+        stats = PoolStats()
+        client = httpx.Client(transport=httpx.MockTransport(lambda request: httpx.Response(200)),
+                              event_hooks={"request": [stats.on_request]})
+        for _ in range(4):
+            request = client.build_request("GET", "https://api.openai.com/v1/models")
+            client.send(request)
+            self.assertIn("trace", request.extensions)
+        # One new connection and handshake, as httpcore would report them for the first request
+        trace = request.extensions["trace"]
+        trace("connection.connect_tcp.complete", {})
+        trace("connection.start_tls.complete", {})
+        trace("http11.send_request_headers.complete", {})
+        self.assertEqual(stats.snapshot(), {"requests": 4, "new_connections": 1, "tls_handshakes": 1,
+                                            "reuse_rate": 0.75})
+        self.assertEqual(PoolStats().snapshot()["reuse_rate"], 0.0)
+
+    def test_pooled_serper_wrapper_posts_through_the_shared_client(self):
+        import httpx
+
+        from clients import ClientRegistry
+
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json={"organic": [{"title": "Rheem"}]})
+
+        registry = ClientRegistry()
+        registry.clients["serper"] = httpx.Client(transport=httpx.MockTransport(handler))
+        with patch("clients.registry", registry), patch.dict("os.environ", {"SERPER_API_KEY": "key"}):
+            search = registry.serper(gl="us", hl="en")
+            self.assertEqual(search.results("rheem water heater"), {"organic": [{"title": "Rheem"}]})
+            search.results("rheem water heater")
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0].method, "POST")
+        self.assertEqual(requests[0].url.path, "/search")
+        self.assertEqual(requests[0].headers["X-API-KEY"], "key")
+        self.assertEqual(requests[0].url.params["q"], "rheem water heater")
+        self.assertEqual(requests[0].url.params["gl"], "us")
+        self.assertNotIn("tbs", requests[0].url.params)  # unset options are not sent
+
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        self.store = TranscriptStore(":memory:", enabled=True)
+        patcher = patch("hedging.store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_until_cancelled(self, seen):
+        import time
+
+        while True:
+            try:
+                check_cancelled()
+            except StageCancelled:
+                seen.set()
+                raise
+            time.sleep(0.005)
+
+    def warm(self, stage, seconds=0.01):
+        stage.primary_latencies.extend([seconds] * 20)
+
+    def test_stages_have_their_own_pools(self):
+        import threading
+
+        release = threading.Event()
+        search, llm = Stage("search", timeout=5, workers=1), Stage("llm", timeout=5, workers=1)
+        search.pool.submit(release.wait)
+        self.assertEqual(llm.call(lambda: "ok"), "ok")  # not queued behind the stalled search
+        release.set()
+
+    def test_timeout_starts_when_the_call_starts(self):
+        import threading
+        import time
+
+        stage = Stage("search", timeout=0.3, workers=1)
+        busy = threading.Event()
+        stage.pool.submit(lambda: (busy.set(), time.sleep(0.25)))
+        busy.wait()
+        # Queued for 0.25s and runs for 0.2s: over 0.3s in total but within the timeout once started
+        self.assertEqual(stage.call(lambda: time.sleep(0.2) or "ok"), "ok")
+
+    def test_timed_out_call_is_cancelled_and_releases_its_thread(self):
+        import threading
+
+        stage, seen = Stage("llm", timeout=0.1, workers=1), threading.Event()
+        with self.assertRaises(StageTimeout):
+            stage.call(self.wait_until_cancelled, seen)
+        self.assertTrue(seen.wait(1))
+        self.assertEqual(stage.call(lambda: "ok"), "ok")
+
+    def test_timed_out_attempt_events_are_not_kept(self):
+        import threading
+
+        stage, seen = Stage("llm", timeout=0.1, workers=1), threading.Event()
+
+        def half_streamed():
+            self.store.record("A1", "llm", {"content": '{"item_code": "A1", "classif'})
+            self.wait_until_cancelled(seen)
+
+        with self.store.row("items", 1), self.assertRaises(StageTimeout):
+            stage.call(half_streamed)
+        self.assertTrue(seen.wait(1))
+        self.assertNotIn(("items", "1"), self.store.pending)
+
+    def test_hedge_wins_cancels_the_loser_and_keeps_only_its_events(self):
+        import threading
+
+        stage, seen, calls = Stage("llm", timeout=5, hedge=True, workers=4), threading.Event(), []
+        self.warm(stage)
+
+        def complete():
+            calls.append(1)
+            if len(calls) == 1:
+                self.store.record("A1", "llm", {"content": "slow"})
+                self.wait_until_cancelled(seen)
+            self.store.record("A1", "llm", {"content": "fast"})
+            return "hedge"
+
+        with patch("hedging.HEDGE_HOLDOUT", 0.0), self.store.row("items", 1):
+            self.assertEqual(stage.call(complete), "hedge")
+        self.assertTrue(seen.wait(1))
+        self.assertEqual([e["content"] for e in self.store.pending[("items", "1")]], ["fast"])
+        self.assertEqual((stage.counts["hedged"], stage.counts["hedge_wins"]), (1, 1))
+
+    def test_holdout_calls_are_not_hedged(self):
+        import time
+
+        stage = Stage("llm", timeout=5, hedge=True, workers=4)
+        self.warm(stage)
+        with patch("hedging.HEDGE_HOLDOUT", 1.0):
+            stage.call(lambda: time.sleep(0.05))
+        self.assertEqual(stage.counts["hedged"], 0)
+        self.assertEqual(len(stage.eligible_latencies["holdout"]), 1)
+
+    def test_p99_improvement_compares_against_the_holdout(self):
+        stage = Stage("llm", timeout=5, hedge=True)
+        stage.eligible_latencies["hedged"].extend([1.0] * 20)
+        self.assertNotIn("p99_improvement_seconds", stage.report())
+        stage.eligible_latencies["holdout"].extend([1.0] * 19 + [4.0])
+        self.assertEqual(stage.report()["p99_improvement_seconds"], 3.0)
+
+
+class FakeAssistantsClient:
+    """Just enough of the OpenAI client's beta.threads API for HeadlessAssistantManager."""
+
+    def __init__(self, runs):
+        from types import SimpleNamespace as NS
+
+        self.runs = list(runs)  # the run objects returned by successive polls
+        self.calls, self.created, self.deleted, self.messages = [], 0, [], {}
+        self.beta = NS(threads=NS(
+            create=self.create_thread, delete=self.deleted.append,
+            messages=NS(create=self.create_message, list=self.list_messages, delete=self.delete_message),
+            runs=NS(create_and_poll=self.poll, submit_tool_outputs_and_poll=self.poll),
+        ))
+
+    def create_thread(self):
+        from types import SimpleNamespace as NS
+
+        self.created += 1
+        return NS(id=f"thread-{self.created}")
+
+    def create_message(self, thread_id, role, content):
+        from types import SimpleNamespace as NS
+
+        self.messages.setdefault(thread_id, []).append(NS(id=f"msg-{content}", content=[]))
+
+    def list_messages(self, thread_id, **kwargs):
+        return list(self.messages.get(thread_id, []))
+
+    def delete_message(self, message_id, thread_id):
+        self.messages[thread_id] = [m for m in self.messages[thread_id] if m.id != message_id]
+
+    def poll(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.runs.pop(0)
+
+
+def assistant_run(status, tool_arguments=None, tokens=100, error_code=None):
+    from types import SimpleNamespace as NS
+
+    tool_calls = [NS(id="call-1", function=NS(name="get_vendor_classification", arguments=tool_arguments))]
+    return NS(
+        id=f"run-{status}", status=status, usage=NS(total_tokens=tokens),
+        required_action=NS(submit_tool_outputs=NS(tool_calls=tool_calls)) if tool_arguments else None,
+        last_error=NS(code=error_code, message="boom") if error_code else None,
+    )
+
+
+class TestAssistantRuns(unittest.TestCase):
+
+    def setUp(self):
+        from guards import ASSISTANT_SLOW_CALL_SECONDS, breakers
+
+        patcher = patch.dict(breakers, {
+            "openai": CircuitBreaker("openai", min_calls=1, window=1),
+            "assistants": CircuitBreaker("assistants", slow_call_seconds=ASSISTANT_SLOW_CALL_SECONDS,
+                                         min_calls=1, window=1),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tool_outputs_are_submitted_until_the_run_completes(self):
+        client = FakeAssistantsClient([assistant_run("requires_action", '{"code": "40101700"}'),
+                                       assistant_run("completed", tokens=250)])
+        result = HeadlessAssistantManager(client, "asst-1").process_supplier("RHEEM")
+        self.assertEqual(result["status"], "completed")
+        self.assertEqual(result["tool_calls"], [{"name": "get_vendor_classification", "arguments": {"code": "40101700"}}])
+        self.assertEqual(client.calls[1]["tool_outputs"], [{"tool_call_id": "call-1", "output": '{"received": true}'}])
+        self.assertEqual((result["tokens"], client.deleted), (250, ["thread-1"]))
+
+    def test_threads_are_wiped_and_reused(self):
+        client = FakeAssistantsClient([assistant_run("completed"), assistant_run("completed")])
+        manager = HeadlessAssistantManager(client, "asst-1", reuse_threads=True)
+        manager.process_supplier("RHEEM")
+        manager.process_supplier("Ferguson")
+        self.assertEqual((client.created, client.deleted), (1, []))
+        self.assertEqual([m.id for m in client.messages["thread-1"]], [])
+
+    def test_slow_runs_do_not_trip_the_openai_breaker(self):
+        from guards import breakers
+
+        clock = [0.0]
+        client = FakeAssistantsClient([assistant_run("completed")])
+        client.poll = lambda **kwargs: clock.__setitem__(0, clock[0] + 120.0) or client.runs.pop(0)
+        client.beta.threads.runs.create_and_poll = client.poll
+        with patch("time.monotonic", lambda: clock[0]):
+            result = HeadlessAssistantManager(client, "asst-1").process_supplier("RHEEM")
+        self.assertEqual(result["seconds"], 120.0)  # over the 60s slow-call threshold of chat completions
+        self.assertEqual(breakers["assistants"].report()["state"], "closed")
+        self.assertEqual(len(breakers["openai"].calls), 0)
+
+    def test_server_errors_trip_the_assistants_breaker_but_bad_requests_do_not(self):
+        from guards import breakers
+
+        client = FakeAssistantsClient([assistant_run("failed", error_code="invalid_prompt"),
+                                       assistant_run("failed", error_code="server_error")])
+        results = HeadlessAssistantManager(client, "asst-1", max_concurrency=1).process_suppliers(["A", "B"])
+        self.assertEqual([r["status"] for r in results], ["failed", "failed"])
+        self.assertEqual(breakers["assistants"].report()["state"], "open")
+        self.assertEqual(client.deleted, ["thread-1", "thread-2"])
+
+
+class TestEventHandler(unittest.TestCase):
+
+    def handler(self, **kwargs):
+        from utils import EventHandler
+
+        handler = EventHandler(**kwargs)
+        handler.render_response = MagicMock()
+        handler.container = MagicMock()
+        handler.cancel_run = MagicMock()
+        return handler
+
+    def stream(self, handler, chunks, clock, step=0.0):
+        from types import SimpleNamespace as NS
+
+        handler.on_text_created(NS(value=""))
+        for chunk in chunks:
+            clock[0] += step
+            handler.on_text_delta(NS(value=chunk), None)
+
+    def test_deltas_are_rendered_at_most_max_fps(self):
+        clock, handler = [0.0], self.handler(max_fps=10)
+        with patch("time.monotonic", lambda: clock[0]):
+            self.stream(handler, ["Looking", " up", " Rheem."] * 10, clock, step=0.01)  # 30 deltas in 0.3s
+            handler.on_end()
+        # The forced render on creation, one per 0.1s frame, and the final render
+        self.assertLessEqual(handler.render_response.call_count, 6)
+        self.assertEqual(handler.responses, [{"text": "Looking up Rheem." * 10}])
+
+    def test_buffered_text_is_not_appended_to_a_parsed_text_field(self):
+        clock, handler = [0.0], self.handler(max_fps=10)
+        with patch("time.monotonic", lambda: clock[0]):
+            self.stream(handler, ['{"text": "Rheem', '", "code": "40101700"}', " Anything else?"], clock)
+            self.stream(handler, ["Not JSON: ", "{oops"], clock)
+            self.stream(handler, [" and more"], clock)
+            handler.on_end()
+        self.assertEqual(handler.responses[0], {"text": "Rheem", "code": "40101700"})
+        self.assertEqual(handler.responses[1:], [{"text": "Not JSON: {oops"}, {"text": " and more"}])
+
+    def test_runs_are_cancelled_on_json_only_when_asked_and_no_tool_call_is_pending(self):
+        from types import SimpleNamespace as NS
+
+        answer = ['{"supplier_name": "Rheem"', "}"]
+        clock, handler = [0.0], self.handler()
+        self.stream(handler, answer, clock)
+        handler.cancel_run.assert_not_called()  # stop_on_json is opt-in
+
+        handler = self.handler(stop_on_json=True)
+        self.stream(handler, answer, clock)
+        handler.cancel_run.assert_called_once()
+
+        from utils import EventHandler
+
+        handler = self.handler(stop_on_json=True)
+        handler.cancel_run = EventHandler.cancel_run.__get__(handler)
+        run = NS(id="run-1", thread_id="thread-1", status="in_progress")
+        with patch("utils.get_client") as get_client, patch.object(EventHandler, "current_run", run):
+            handler.on_tool_call_created(NS(id="call-1"))
+            self.stream(handler, answer, clock)
+            get_client().beta.threads.runs.cancel.assert_not_called()
+            handler.pending_tool_calls.clear()  # outputs submitted
+            handler.cancel_run()
+            get_client().beta.threads.runs.cancel.assert_called_once_with(thread_id="thread-1", run_id="run-1")
+
+
+class TestSupplierInference(unittest.TestCase):
+
+    def make_db(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification "
+                     "(id REAL, item_code TEXT, valid TEXT, classification_code TEXT, classification_name TEXT)")
+        conn.execute("CREATE TABLE ARS_Supplier_Classification_List (id INTEGER, supplier_name TEXT, valid TEXT, "
+                     "classification_code TEXT, classification_name TEXT, comments TEXT)")
+        conn.execute("CREATE TABLE spend_data_raw (supplier_name TEXT, item_code TEXT, transaction_line_value TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, '1', ?, ?)", [
+            (1, "UP18AZ48AJVCA", "40101701", "Air conditioners"), (2, "FILTER-1", "40161505", "Air filters"),
+            (3, "PAPER-9", "14111507", "Printer paper"),
+        ])
+        conn.executemany("INSERT INTO ARS_Supplier_Classification_List VALUES (?, ?, NULL, NULL, NULL, NULL)",
+                         [(1, "Rheem Sales Co."), (2, "Mixed Supply")])
+        conn.executemany("INSERT INTO spend_data_raw VALUES (?, ?, ?)", [
+            ("RHEEM SALES COMPANY INC   ", " up18az48ajvca", "900"), ("RHEEM SALES COMPANY INC", "FILTER-1", "100"),
+            ("Mixed Supply", "UP18AZ48AJVCA", "50"), ("Mixed Supply", "PAPER-9", "50"),
+        ])
+        return conn
+
+    def test_keys_match_the_scrubber(self):
+        import pandas as pd
+
+        names = pd.DataFrame({"supplier_name": ["Rheem Sales Co.", "A & B Supply, LLC", "The Co"],
+                              "item_code": ["UP18AZ48AJVCA  (W1", "ab\tc", "x"]})
+        scrubbed = scrub_chunk(names)
+        self.assertEqual(list(scrubbed["supplier_key"]), [supplier_key(name) for name in names["supplier_name"]])
+        self.assertEqual(list(scrubbed["item_key"]), [item_key(code) for code in names["item_code"]])
+
+    def test_infers_through_canonical_keys_in_one_update(self):
+        conn = self.make_db()
+        inferred = infer_supplier_classifications(conn)
+        self.assertEqual(list(inferred["supplier_key"]), ["rheem sales"])
+        row = conn.execute("SELECT classification_code, classification_source, unspsc_class "
+                           "FROM ARS_Supplier_Classification_List WHERE id = 1").fetchone()
+        self.assertEqual(row, ("40101700", "item_inference", 40101700))
+        self.assertIsNone(conn.execute("SELECT classification_code FROM ARS_Supplier_Classification_List "
+                                       "WHERE id = 2").fetchone()[0])
+
+    def test_classified_sliver_of_spend_is_not_dominant(self):
+        conn = self.make_db()
+        conn.execute("INSERT INTO AP_Items_For_Classification VALUES (4, 'MYSTERY-1', NULL, NULL, NULL)")
+        conn.execute("INSERT INTO ARS_Supplier_Classification_List VALUES (3, 'Sliver HVAC', NULL, NULL, NULL, NULL)")
+        conn.executemany("INSERT INTO spend_data_raw VALUES (?, ?, ?)", [
+            ("Sliver HVAC", "UP18AZ48AJVCA", "200"),  # 2% of its spend, all in one code
+            ("Sliver HVAC", "MYSTERY-1", "9800"),
+        ])
+        inferred = infer_supplier_classifications(conn)
+        self.assertNotIn("sliver hvac", list(inferred["supplier_key"]))
+        self.assertIsNone(conn.execute("SELECT valid FROM ARS_Supplier_Classification_List "
+                                       "WHERE id = 3").fetchone()[0])
+        # Rheem's unclassified share is nil, so its score is still against its whole spend
+        self.assertAlmostEqual(inferred.set_index("supplier_key").loc["rheem sales", "dominance_score"], 0.9)
+
+    def test_spend_join_uses_the_key_indexes(self):
+        conn = self.make_db()
+        for table in ("spend_data_raw", "AP_Items_For_Classification"):
+            ensure_key_columns(conn, table)
+        plan = " ".join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM spend_data_raw r "
+            "JOIN AP_Items_For_Classification i ON i.item_key = r.item_key"))
+        self.assertIn("USING INDEX", plan)
+
+    def test_keys_follow_their_source_columns(self):
+        conn = self.make_db()
+        ensure_key_columns(conn, "ARS_Supplier_Classification_List")
+        conn.execute("UPDATE ARS_Supplier_Classification_List SET supplier_name = 'Watsco, Inc.' WHERE id = 2")
+        self.assertIsNone(conn.execute("SELECT supplier_key FROM ARS_Supplier_Classification_List "
+                                       "WHERE id = 2").fetchone()[0])
+        ensure_key_columns(conn, "ARS_Supplier_Classification_List")
+        self.assertEqual(conn.execute("SELECT supplier_key FROM ARS_Supplier_Classification_List "
+                                      "WHERE id = 2").fetchone()[0], "watsco")
+
+        # Keys that went stale before the trigger existed are recomputed when it is created
+        conn.execute("ALTER TABLE spend_data_raw ADD COLUMN item_key TEXT")
+        conn.execute("UPDATE spend_data_raw SET item_key = 'old code'")
+        ensure_key_columns(conn, "spend_data_raw")
+        keys = {row[0] for row in conn.execute("SELECT item_key FROM spend_data_raw")}
+        self.assertEqual(keys, {"up18az48ajvca", "filter-1", "paper-9"})
+
+    def test_without_spend_data_nothing_is_inferred(self):
+        conn = sqlite3.connect(":memory:")
+        self.assertTrue(infer_supplier_classifications(conn).empty)
+
+
+class TestPriority(unittest.TestCase):
+
+    def make_db(self, spend=True):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?)", [
+            (1, "A1", None), (2, "B2 ", ""), (3, "B2", "1"), (4, "C3", None),
+        ])
+        if spend:
+            conn.execute("CREATE TABLE spend_data_raw (item_code TEXT, transaction_line_value TEXT, gl_date TEXT)")
+            conn.executemany("INSERT INTO spend_data_raw VALUES (?, ?, ?)", [
+                ("A1", "10", "2024-01-01"), ("B2", "60", "2024-01-01"), ("C3 ", "30", "2024-01-02"),
+            ])
+        return conn
+
+    def test_without_spend_data_processes_in_id_order(self):
+        from agent_item import get_items_to_process
+
+        conn = self.make_db(spend=False)
+        self.assertIsNone(prepare_priority(conn, "items"))
+        # valid = '' is neither classified nor skipped
+        self.assertEqual([row[0] for row in get_items_to_process(conn.cursor(), 10)], [1, 2, 4])
+
+    def test_spend_order_and_coverage_count_each_key_once(self):
+        from agent_item import get_items_to_process
+
+        conn = self.make_db()
+        coverage = prepare_priority(conn, "items")
+        self.assertEqual([row[0] for row in get_items_to_process(conn.cursor(), 10, by_spend=True)], [2, 4, 1])
+        # B2 has two work rows, one classified: its 60 of 100 counts once
+        self.assertEqual(coverage.report()["covered_spend"], 60.0)
+        coverage.record("b2 ")
+        coverage.record("C3")
+        self.assertEqual(coverage.report()["percent_spend_classified"], 90.0)
+
+    def test_refresh_skips_unchanged_spend(self):
+        conn = self.make_db()
+        self.assertEqual(refresh_priority(conn, "items"), 3)
+        conn.execute("UPDATE item_spend_priority SET spend = -1")
+        refresh_priority(conn, "items")
+        self.assertEqual(conn.execute("SELECT MIN(spend) FROM item_spend_priority").fetchone()[0], -1)
+        conn.execute("INSERT INTO spend_data_raw (item_code, transaction_line_value, gl_date) "
+                     "VALUES ('D4', '5', '2024-01-03')")
+        self.assertEqual(refresh_priority(conn, "items"), 4)
+        self.assertEqual(conn.execute("SELECT MIN(spend) FROM item_spend_priority").fetchone()[0], 5)
+
+    def test_recency_decay_halves_spend_per_half_life(self):
+        import datetime
+
+        conn = self.make_db()
+        old = (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+        conn.execute("UPDATE spend_data_raw SET gl_date = ?", (old,))
+        refresh_priority(conn, "items", half_life_days=30)
+        weighted = dict(conn.execute("SELECT key, weighted_spend FROM item_spend_priority"))
+        self.assertAlmostEqual(weighted["b2"], 30.0, places=0)
+
+
+class TestCondense(unittest.TestCase):
+
+    def test_condense_results_dedupes_and_drops_boilerplate(self):
+        results = {
+            "organic": [
+                {"title": "Rheem", "snippet": "Rheem UP18AZ48AJVCA 4 ton heat pump condenser", "link": "a"},
+                {"title": "Mirror", "snippet": "Rheem UP18AZ48AJVCA 4 ton heat pump condenser", "link": "b"},
+                {"title": "Shop", "snippet": "Free shipping on all orders. Sign in to your account", "link": "c"},
+            ]
+        }
+
+        condensed = condense_results(results, terms_for("UP18AZ48AJVCA (W1823"), token_budget=100)
+
+        self.assertEqual(condensed.count("UP18AZ48AJVCA"), 1)  # the mirrored snippet is dropped
+        self.assertNotIn("Free shipping", condensed)
+
+    def test_condense_results_respects_token_budget(self):
+        results = {"organic": [{"title": str(i), "snippet": "word " * 50, "link": str(i)} for i in range(10)]}
+
+        condensed = condense_results(results, set(), token_budget=5)
+
+        self.assertEqual(condensed, "No good Google Search Result was found")
+
+
+class TestTranscripts(unittest.TestCase):
+
+    def test_reparse_uses_latest_model_output(self):
+        store = TranscriptStore(":memory:")
+        with store.row("items", 7):
+            store.record("UP18AZ48AJVCA", "search", {"query": "UP18AZ48AJVCA", "results": {"organic": []}})
+            store.record("UP18AZ48AJVCA", "llm", {"content": '{"item_code": "UP18AZ48AJVCA", "validation": true}'})
+        store.save("items", 7, "UP18AZ48AJVCA (W1823", "v1")
+
+        written = []
+        counts = reparse(store, "items", GetItemData, None, lambda row_id, data: written.append((row_id, data)))
+
+        self.assertEqual(counts["written"], 1)
+        self.assertEqual(written[0][0], "7")
+        self.assertTrue(written[0][1].validation)
+
+    def test_events_are_kept_per_row_and_dropped_outside_rows(self):
+        store = TranscriptStore(":memory:")
+        store.record("ACME", "search", {"query": "ACME contact"})  # e.g. a service lookup: no row saves it
+        for row_id in (1, 2):
+            with store.row("items", row_id):
+                store.record("A1", "llm", {"content": str(row_id)})
+        self.assertEqual(set(store.pending), {("items", "1"), ("items", "2")})
+        store.discard("items", 2)
+        store.save("items", 1, "A1", "v1")
+        self.assertEqual(store.pending, {})
+
+    def test_coalesced_duplicates_each_get_the_transcript(self):
+        import concurrent.futures
+        import threading
+
+        store, release = TranscriptStore(":memory:"), threading.Event()
+
+        @coalesce("test-transcripts")
+        def lookup(item_code):
+            store.record(item_code, "llm", {"content": "answer"})
+            release.wait(5)
+            return "answer"
+
+        def row(row_id):
+            with store.row("items", row_id):
+                return lookup("A1")
+
+        with patch("singleflight.store", store), concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(row, row_id) for row_id in (1, 2)]
+            while lookup.flight.report()["calls"] < 2:
+                pass
+            release.set()
+            self.assertEqual([future.result() for future in futures], ["answer", "answer"])
+        self.assertEqual(lookup.flight.report()["executions"], 1)
+        self.assertEqual({row: len(events) for row, events in store.pending.items()},
+                         {("items", "1"): 1, ("items", "2"): 1})
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_find_changed_detects_input_and_version_changes(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT)")
+        conn.executemany(
+            "INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?)",
+            [(1.0, "UP18AZ48AJVCA", "1"), (2.0, "JOB/FIELD TICKET", "1"), (3.0, "Sales tax", None)],
+        )
+        ensure_hash_columns(conn, "items")
+        stamp(conn, "items", 1.0, "v1")
+        stamp(conn, "items", 2.0, "v1")
+
+        self.assertEqual(find_changed(conn, "items", "v1"), [])
+
+        conn.execute("UPDATE AP_Items_For_Classification SET item_code = 'JOB/FIELD TICKET PURCHASE' WHERE id = 2.0")
+        self.assertEqual(find_changed(conn, "items", "v1"), [(2.0, "input")])
+        self.assertEqual(len(find_changed(conn, "items", "v2")), 2)
+
+    def test_description_and_supplier_are_inputs_when_present(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification "
+                     "(id REAL, item_code TEXT, item_description TEXT, supplier_name TEXT, valid TEXT)")
+        conn.execute("INSERT INTO AP_Items_For_Classification VALUES (1.0, 'A1', 'Condenser', 'RHEEM', '1')")
+        ensure_hash_columns(conn, "items")
+        stamp(conn, "items", 1.0, "v1")
+        conn.execute("UPDATE AP_Items_For_Classification SET item_description = ' Condenser ' WHERE id = 1.0")
+        self.assertEqual(find_changed(conn, "items", "v1"), [])  # whitespace only
+        conn.execute("UPDATE AP_Items_For_Classification SET supplier_name = 'RHEEM SALES' WHERE id = 1.0")
+        self.assertEqual(find_changed(conn, "items", "v1"), [(1.0, "input")])
+
+    def test_changes_are_found_on_the_stored_hash_index(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT)")
+        ensure_hash_columns(conn, "items")
+        plan = " ".join(row[3] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM AP_Items_For_Classification t "
+            "WHERE t.classifier_version < 'v1' OR t.classifier_version > 'v1' "
+            "OR (t.classifier_version = 'v1' AND t.input_hash IS NOT t.current_hash)"))
+        self.assertIn("idx_ap_items_for_classification_input_hash", plan)
+        self.assertNotIn("SCAN", plan)
+
+    def test_reclassify_processes_only_the_requeued_rows(self):
+        import os
+        import tempfile
+
+        from agent_item import get_items_to_process
+
+        path = os.path.join(tempfile.mkdtemp(), "spend.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?)",
+                         [(1.0, "A1", "1"), (2.0, "B2", "1"), (3.0, "C3", None)])
+        ensure_hash_columns(conn, "items")
+        for row_id in (1.0, 2.0):
+            stamp(conn, "items", row_id, "v1")
+        conn.execute("UPDATE AP_Items_For_Classification SET item_code = 'B2X' WHERE id = 2.0")
+        conn.commit()
+
+        counts, ids = reclassify(conn, "items", "v1")
+        self.assertEqual((counts["requeued"], ids), (1, [2.0]))
+        select_rows(conn, ids)
+        # Row 3 is also pending, but only the re-queued row is selected
+        self.assertEqual(get_items_to_process(conn.cursor(), 10, selected=True), [(2.0, "B2X")])
+        conn.close()
+
+        settings = load_profile(None, "items", {"db_path": path, "dry_run": True})
+        with patch("agent_item.CLASSIFIER_VERSION", "v2"):
+            self.assertEqual(reclassify_rows("items", settings)["version"], 1)
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def test_parse_importtime_keeps_top_level_modules(self):
+        stderr = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |     langchain_core.pydantic_v1\n"
+            "import time:       310 |        900 |   dotenv\n"
+            "import time:      2100 |      48000 | agent_item\n"
         )
+        self.assertEqual(parse_importtime(stderr), {"agent_item": 48000})
+
+    def test_agent_modules_import_without_api_keys_or_langchain_clients(self):
+        import os
+        import subprocess
+        import sys
+
+        env = {key: value for key, value in os.environ.items() if key not in ("OPENAI_API_KEY", "SERPER_API_KEY")}
+        code = "import sys, agent_item, agent_company; print('langchain_openai' in sys.modules)"
+        process = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env)
+        self.assertEqual(process.returncode, 0, process.stderr)
+        self.assertEqual(process.stdout.strip(), "False")
+
+
+class TestCli(unittest.TestCase):
+
+    def test_pipeline_table_overrides_run_table_and_flags_override_both(self):
+        import os
+        import tempfile
+
+        with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+            f.write('[run]\nconcurrency = 4\nlimit = 50\n\n[suppliers]\nlimit = 10\n')
+        self.addCleanup(os.remove, f.name)
+
+        self.assertEqual(load_profile(f.name, "items")["limit"], 50)
+        self.assertEqual(load_profile(f.name, "suppliers")["limit"], 10)
+        self.assertEqual(load_profile(f.name, "suppliers", {"concurrency": 32, "limit": None})["concurrency"], 32)
+
+    def test_unknown_profile_setting_is_rejected(self):
+        import os
+        import tempfile
+
+        with tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False) as f:
+            f.write("[run]\nworkers = 4\n")
+        self.addCleanup(os.remove, f.name)
+
+        with self.assertRaises(ValueError):
+            load_profile(f.name, "items")
+
+    def test_dry_run_lists_pending_items_without_processing(self):
+        import os
+        import tempfile
+
+        path = os.path.join(tempfile.mkdtemp(), "spend.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id REAL, item_code TEXT, valid TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?)",
+                         [(1.0, "UP18AZ48AJVCA", None), (2.0, "JOB/FIELD TICKET", "1"), (3.0, "Sales tax", None)])
+        conn.commit()
+        conn.close()
+
+        settings = load_profile(None, "items", {"db_path": path, "dry_run": True, "limit": 10})
+        self.assertEqual(run("items", settings), {"planned": 2})
+
+    def test_dry_run_previews_the_run_without_writing(self):
+        import hashlib
+        import os
+        import tempfile
+
+        from cli import pending_rows
+
+        path = os.path.join(tempfile.mkdtemp(), "spend.db")
+        source = TestSupplierInference().make_db()
+        source.commit()
+        conn = sqlite3.connect(path)
+        source.backup(conn)
+        conn.execute("UPDATE AP_Items_For_Classification SET valid = NULL WHERE id IN (1, 3)")
+        conn.execute("INSERT INTO spend_data_raw VALUES ('Rheem Sales Co', 'paper-9', '5000')")
+        ensure_spend_keys(conn)
+        conn.close()
+
+        def digest():
+            with open(path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        before = digest()
+        settings = load_profile(None, "items", {"db_path": path, "dry_run": True, "by_spend": True})
+        self.assertEqual([row[0] for row in pending_rows("items", settings)], [3.0, 1.0])
+        self.assertEqual(digest(), before)
+
+        self.assertFalse(sqlite3.connect(path).execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'item_spend_priority'").fetchone())
+
+        # Rheem is classified by inference before any agent call, so only Mixed Supply is left
+        settings = load_profile(None, "suppliers", {"db_path": path, "dry_run": True, "by_spend": True})
+        self.assertEqual(pending_rows("suppliers", settings), [(2, "Mixed Supply")])
+        self.assertEqual(digest(), before)
+
+    def test_progress_reports_rate_and_eta(self):
+        import io
+
+        progress = Progress("items", total=10, interval=0, stream=io.StringIO())
+        for success in (True, True, False):
+            progress.update(success)
+
+        stats = progress.snapshot()
+        self.assertEqual((stats["done"], stats["failed"]), (3, 1))
+        self.assertIsNotNone(stats["eta"])
+        self.assertIn("3/10 (1 failed)", progress.stream.getvalue())
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_identical_lookups_run_once(self):
+        import concurrent.futures
+        import threading
+
+        release = threading.Event()
+        calls = []
+
+        @coalesce("test-lookups")
+        def lookup(item_code):
+            calls.append(item_code)
+            release.wait(5)
+            return f"classified {item_code}"
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(lookup, code) for code in ("UP18AZ48AJVCA", " up18az48ajvca", "UP18AZ48AJVCA ")]
+            while lookup.flight.report()["calls"] < 3:
+                pass
+            release.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(set(results), {f"classified {calls[0]}"})
+        self.assertEqual(lookup.flight.report()["coalesced"], 2)
+
+    def test_followers_receive_the_leaders_exception(self):
+        flight = SingleFlight("test")
+        future, leader = flight.begin("rheem")
+        follower, follower_leads = flight.begin("rheem")
+        self.assertTrue(leader)
+        self.assertFalse(follower_leads)
+
+        future.set_exception(ConnectionError("Serper down"))
+        flight.forget("rheem", future)
+
+        with self.assertRaises(ConnectionError):
+            follower.result()
+        self.assertTrue(flight.begin("rheem")[1])
+
+
+class TestServer(unittest.TestCase):
+
+    def test_concurrent_requests_share_batches_and_cache(self):
+        import concurrent.futures
+
+        batches = []
+
+        def backend(keys):
+            batches.append(keys)
+            return [{"item_code": key} for key in keys]
+
+        service = ClassificationService({"item": backend}, workers=1, window_ms=20)
+        self.addCleanup(service.close)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda code: service.classify("item", code), ["A1", "B2", "C3", "D4"]))
+
+        self.assertEqual([result["result"]["item_code"] for result in results], ["A1", "B2", "C3", "D4"])
+        self.assertLess(len(batches), 4)
+        self.assertTrue(service.classify("item", " a1 ")["cached"])
+
+    def test_duplicate_keys_in_one_request_each_get_a_line(self):
+        service = ClassificationService({"item": lambda keys: [{"item_code": key} for key in keys]}, window_ms=20)
+        self.addCleanup(service.close)
+
+        lines = list(service.classify_many("item", ["A1", "a1 ", "B2", "A1"]))
+
+        self.assertEqual(sorted(line["key"] for line in lines), ["A1", "A1", "B2", "a1 "])
+        self.assertTrue(all("result" in line for line in lines))
+
+    def test_structured_backend_falls_back_to_agent_for_unanswered_keys(self):
+        def search(key):
+            if key == "offline":
+                raise ConnectionError("Serper down")
+            return f"results for {key}"
+
+        def batch(keys, contexts):
+            return [GetItemData(item_code=keys[0], validation=True)] + [None] * (len(keys) - 1)
+
+        backend = structured_backend(search, batch, lambda key: GetItemData(item_code=key, validation=False))
+
+        results = backend(["UP18AZ48AJVCA", "Sales tax", "offline"])
+
+        self.assertEqual([result["validation"] for result in results], [True, False, False])
+
+    def test_http_endpoint_and_stream(self):
+        import json
+        import threading
+        import urllib.request
+
+        service = ClassificationService({"supplier": lambda keys: [{"supplier_name": key} for key in keys]})
+        server = make_server("127.0.0.1", 0, service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base = f"http://127.0.0.1:{server.server_port}"
+
+        def post(path, body):
+            request = urllib.request.Request(base + path, data=json.dumps(body).encode("utf-8"))
+            with urllib.request.urlopen(request) as response:
+                return response.read().decode("utf-8")
+
+        self.assertEqual(json.loads(post("/classify/supplier", {"supplier_name": "Rheem"}))["result"],
+                         {"supplier_name": "Rheem"})
+        lines = [json.loads(line) for line in post("/classify/supplier/stream", {"keys": ["Rheem", "Trane"]}).splitlines()]
+        self.assertEqual(sorted(line["key"] for line in lines), ["Rheem", "Trane"])
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_request_mix_and_schedule(self):
+        keys = load_keys("data/sample_cleaned.csv", "item")
+        self.assertIn("UP18AZ48AJVCA (W18231586", keys)
+
+        mix = RequestMix(keys, repeat_ratio=0.5, seed=1)
+        drawn = [mix.next_key() for _ in range(1000)]
+        self.assertAlmostEqual(sum(key in keys for key in drawn) / 1000, 0.5, delta=0.06)
+
+        schedule = arrivals(rate=100, duration=10, burst_size=5, seed=1)
+        self.assertAlmostEqual(len(schedule), 1000, delta=150)
+        self.assertEqual(len(schedule) % 5, 0)
+
+    def test_ramp_against_fake_backends_reports_batching_and_cache(self):
+        import threading
+
+        server = make_server("127.0.0.1", 0, ClassificationService(fake_backends(time_scale=0.02)))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        mix = RequestMix(load_keys("data/sample_cleaned.csv", "supplier"), repeat_ratio=0.9)
+        generator = LoadGenerator(f"http://127.0.0.1:{server.server_port}", "supplier", mix, workers=32)
+        report = ramp(generator, [200], duration=1)[0]
+
+        self.assertEqual(report["errors"], 0)
+        self.assertGreater(report["avg_batch_size"], 1)
+        self.assertGreater(report["cache_hit_rate"], 0)
+
+
+class TestExplorerLoader(unittest.TestCase):
+
+    def test_frame_is_projected_optimized_and_reloaded_when_the_data_changes(self):
+        import os
+        import tempfile
+
+        db_path = os.path.join(tempfile.mkdtemp(), "spend.db")
+        conn = sqlite3.connect(db_path)
+        self.addCleanup(conn.close)
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id INTEGER, item_code TEXT, valid TEXT, "
+                     "classification_code TEXT, classification_name TEXT, input_hash TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, '1', '31160000', ?, 'x')",
+                         [(i, f"ITEM-{i}", f"Hardware {i % 3}") for i in range(300)])
+        conn.commit()
+
+        version = data_version(db_path)
+        frame = load_clean_data(db_path, "AP_Items_For_Classification", version)
+        self.assertNotIn("input_hash", frame.columns)
+        self.assertEqual(frame["classification_name"].dtype, "category")
+        self.assertEqual(frame["item_code"].dtype, object)
+        self.assertEqual(frame["id"].dtype, "int16")
+        self.assertLess(frame.attrs["memory"]["after_mb"], frame.attrs["memory"]["before_mb"])
+        self.assertEqual(data_version(db_path), version)
+
+        conn.execute("UPDATE AP_Items_For_Classification SET classification_name = 'Tools' WHERE id = 0")
+        conn.commit()
+        self.assertNotEqual(data_version(db_path), version)
+        reloaded = load_clean_data(db_path, "AP_Items_For_Classification", data_version(db_path))
+        self.assertEqual(reloaded["classification_name"].iloc[0], "Tools")
+
+
+class TestUnspscLevels(unittest.TestCase):
+
+    def test_levels_stop_at_the_codes_own_level(self):
+        self.assertEqual(levels("43211503"), (43000000, 43210000, 43211500, 43211503))
+        self.assertEqual(levels(" 4321-15 "), (43000000, 43210000, 43211500, None))
+        self.assertEqual(levels("43"), (43000000, None, None, None))
+        self.assertEqual(levels(None), (None, None, None, None))
+        self.assertEqual(levels("N/A"), (None, None, None, None))
+
+    def test_backfill_writer_and_indexed_rollup(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification (id INTEGER PRIMARY KEY, item_code TEXT, "
+                     "classification_code TEXT, classification_name TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?, ?)", [
+            (1, "A", "43211503", "Notebook computers"),
+            (2, "B", "43211507", "Desktop computers"),
+            (3, "C", "43210000", "Computer Equipment and Accessories"),
+            (4, "D", None, None),
+        ])
+        self.assertTrue(ensure_level_columns(conn, "items"))
+        self.assertFalse(ensure_level_columns(conn, "items"))
+
+        self.assertEqual([row[:2] for row in rollup(conn, "items", "class")], [(43211500, None)])
+
+        conn.execute("UPDATE AP_Items_For_Classification SET classification_code = '31160000' WHERE id = 4")
+        write_levels(conn, "items", 4, "31160000", "Hardware")
+        self.assertEqual(backfill(conn, "items"), 4)
+
+        self.assertEqual(rollup(conn, "items", "family"),
+                         [(43210000, "Computer Equipment and Accessories", 3), (31160000, "Hardware", 1)])
+        plan = " ".join(row[-1] for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT unspsc_family, COUNT(*) FROM AP_Items_For_Classification "
+            "WHERE unspsc_family IS NOT NULL GROUP BY unspsc_family"))
+        self.assertIn("idx_ap_items_for_classification_unspsc_family", plan)
+
+
+class TestExplorerViews(unittest.TestCase):
+
+    def test_stratified_sample_fits_the_budget_and_keeps_rare_codes(self):
+        import pandas as pd
+
+        codes = ["43211500"] * 9000 + ["31160000"] * 990 + [f"2510{i:04d}" for i in range(10)]
+        frame = pd.DataFrame({"id": range(len(codes)), "classification_code": codes})
+        sample = stratified_sample(frame, budget=1000, min_per_stratum=5)
+
+        self.assertAlmostEqual(len(sample), 1000, delta=20)
+        self.assertEqual(set(sample["classification_code"]), set(codes))
+        self.assertAlmostEqual(sample["sample_weight"].sum(), len(frame), delta=len(frame) * 0.01)
+        self.assertEqual(sample.attrs["sampling"]["population"], len(frame))
+        self.assertEqual(choose_view(len(frame), 500, budget=1000), "cube")
+        self.assertEqual(choose_view(len(frame), 5000, budget=1000), "sample")
+
+    def test_cube_totals_match_the_drill_down_query(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE AP_Items_For_Classification (item_code TEXT, classification_code TEXT, "
+                     "classification_name TEXT)")
+        conn.executemany("INSERT INTO AP_Items_For_Classification VALUES (?, ?, ?)",
+                         [("A1", "40101701", "Air conditioners"), ("B2", "40101505", "Air vents"), ("C3", None, None)])
+        conn.execute("CREATE TABLE spend_data_raw (item_code TEXT, supplier_name TEXT, company_region TEXT, "
+                     "gl_date TEXT, transaction_line_value TEXT)")
+        conn.executemany("INSERT INTO spend_data_raw VALUES (?, ?, ?, ?, ?)", [
+            ("A1 ", "RHEEM  ", "East", "2024-04-15", "3421.00"),
+            ("A1", "RHEEM", "East", "2024-04-20", "1526.00"),
+            ("B2", "WATSCO", "West", "2024-05-01", "100.50"),
+            ("C3", "WATSCO", "West", "2024-05-01", "999"),
+        ])
+
+        ensure_level_columns(conn, "items")
+        # The explorer only reads: it asks for the keys instead of adding them
+        with self.assertRaises(ValueError):
+            build_cube(conn)
+        ensure_spend_keys(conn)
+        changes = conn.total_changes, conn.execute("PRAGMA schema_version").fetchone()
+        cube = build_cube(conn)
+        self.assertEqual(len(cube), 2)
+        self.assertEqual(set(cube["class_code"]), {40101700, 40101500})
+        self.assertEqual(set(cube["family_code"]), {40100000})
+        self.assertEqual(set(cube["classification_code"]), {40101701, 40101505})
+        self.assertEqual(set(cube["classification_name"]), {"Air conditioners", "Air vents"})
+        self.assertAlmostEqual(cube["spend"].sum(), 5047.5)
+
+        # A value picked from the cube frame (a numpy scalar) drills down on the integer code
+        code = cube.loc[cube["class_code"] == 40101500, "classification_code"].iloc[0]
+        self.assertEqual(drill_down(conn, {"classification_code": code})[1]["spend"], 100.5)
+
+        rows, totals = drill_down(conn, {"class_code": 40101700, "month": "2024-04"})
+        self.assertEqual(len(rows), 2)
+        self.assertEqual((totals["spend"], totals["lines"], totals["items"]), (4947.0, 2, 1))
+        with self.assertRaises(ValueError):
+            drill_down(conn, {"supplier_name; DROP TABLE spend_data_raw": "x"})
+        self.assertEqual((conn.total_changes, conn.execute("PRAGMA schema_version").fetchone()), changes)
+
+        # The filter narrows the join through the level index, and spend is reached through item_key
+        query, params = spend_lines({"class_code": 40101700})
+        plan = " ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params))
+        self.assertIn("USING INDEX idx_ap_items_for_classification_unspsc_class", plan)
+        self.assertIn("USING INDEX idx_spend_data_raw_item_key", plan)
+
+    def test_saved_charts_are_mapped_onto_the_cube(self):
+        import json
+
+        with open("gw_config.json") as f:
+            spec, missing = cube_spec(json.load(f))
+        self.assertEqual([chart["name"] for chart in spec["config"]],
+                         ["Top 15 Categories", "All Categories", "All Spend"])
+        self.assertIn("item_code", missing)
+        self.assertIn("valid", missing)
+        encodings = spec["config"][0]["encodings"]
+        self.assertEqual([field["fid"] for field in encodings["rows"]], ["classification_name"])
+        self.assertEqual([field["fid"] for field in encodings["details"]], ["lines"])
+        self.assertEqual([field["fid"] for field in encodings["filters"]], ["classification_name"])
+        self.assertNotIn("workflow_list", spec)
+
+
+class TestScrubber(unittest.TestCase):
+
+    def test_chunk_is_trimmed_repaired_coerced_and_keyed(self):
+        import pandas as pd
+
+        raw = pd.DataFrame({
+            '\u00ef\u00bb\u00bf"source_system': ['"ARS_JDE', '"ARS_JDE'],
+            "supplier_name": ["RHEEM SALES COMPANY INC        ", "Rheem Sales Co.  "],
+            "company_code": ["09202", "  "],
+            "transaction_line_value": ["-1287.44", ".00"],
+            "gl_date": ["2024-04-15", "not a date"],
+            'eof",,': ['X",,', 'X",,'],
+        })
+        clean = scrub_chunk(raw)
+
+        self.assertEqual(list(clean.columns), ["source_system", "supplier_name", "company_code",
+                                               "transaction_line_value", "gl_date", "supplier_key"])
+        self.assertEqual(clean["source_system"].tolist(), ["ARS_JDE", "ARS_JDE"])
+        self.assertEqual(clean["source_system"].dtype, "category")
+        self.assertEqual(clean["supplier_key"].tolist(), ["rheem sales", "rheem sales"])
+        self.assertEqual(clean["company_code"].iloc[0], "09202")
+        self.assertTrue(pd.isna(clean["company_code"].iloc[1]))
+        self.assertEqual(clean["transaction_line_value"].tolist(), [-1287.44, 0.0])
+        self.assertTrue(pd.isna(clean["gl_date"].iloc[1]))
+
+    def test_sample_extract_loads_in_chunks(self):
+        import os
+        import tempfile
+
+        db_path = os.path.join(tempfile.mkdtemp(), "spend.db")
+        report = scrub_csv("data/sample_cleaned.csv", db_path, chunk_rows=20)
+        self.assertEqual((report["rows"], report["chunks"]), (47, 3))
+
+        conn = sqlite3.connect(db_path)
+        self.addCleanup(conn.close)
+        padded = conn.execute("SELECT COUNT(*) FROM spend_data_raw WHERE supplier_name != TRIM(supplier_name)")
+        self.assertEqual(padded.fetchone()[0], 0)
+        self.assertEqual(conn.execute("SELECT DISTINCT typeof(transaction_line_value) FROM spend_data_raw").fetchall(),
+                         [("real",)])
+        self.assertEqual(conn.execute("SELECT DISTINCT source_system FROM spend_data_raw").fetchall(), [("ARS_JDE",)])
+
+
+class TestJSONStream(unittest.TestCase):
+
+    ITEM = '{"item_code": "A1", "validation": true, "classification_code": "40141700", "classification_name": null, ' \
+           '"website": null, "comments": "Filter {rev 2}", "confidence": 0.9}'
+
+    def test_completes_at_closing_brace_and_keeps_trailing_text(self):
+        stream = JSONStream(GetItemData)
+        text = self.ITEM + ' Let me know if you need anything else {"x": 1}'
+        chunks = [text[i:i + 7] for i in range(0, len(text), 7)]
+        fed = 0
+        for chunk in chunks:
+            fed += 1
+            if stream.feed(chunk):
+                break
+        self.assertLess(fed, len(chunks))
+        self.assertEqual(stream.parse().comments, "Filter {rev 2}")
+
+    def test_invalid_field_fails_before_the_object_closes(self):
+        stream = JSONStream(GetItemData)
+        with self.assertRaises(StreamParseError):
+            for char in '{"item_code": "A1", "validation": "perhaps", "classification_code": "4014':
+                stream.feed(char)
+        self.assertEqual(list(stream.fields), ["item_code"])
+        self.assertFalse(stream.complete)
+
+    def test_prefix_and_mismatched_brackets(self):
+        with self.assertRaises(StreamParseError):
+            JSONStream().feed("Sure! {}")
+        stream = JSONStream(skip_prefix=True)
+        self.assertTrue(stream.feed('Sure! {"a": [1, {"b": "]"}]}'))
+        self.assertEqual(stream.value(), {"a": [1, {"b": "]"}]})
+        with self.assertRaises(StreamParseError):
+            JSONStream().feed('{"a": [1}')
+
+    def test_invoke_structured_streams_and_stops(self):
+        from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from langchain_core.prompts import ChatPromptTemplate
+
+        from fast_path import invoke_structured
+
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content=self.ITEM + " Hope this helps!")]))
+        prompt = ChatPromptTemplate.from_messages([("human", "Classify {item_code}")])
+        item = invoke_structured(llm, prompt, GetItemData, {"item_code": "A1"})
+        self.assertEqual(item.classification_code, "40141700")
+
+
+class TestContactExtraction(unittest.TestCase):
+
+    RESULTS = {
+        "knowledgeGraph": {
+            "title": "Rheem Manufacturing Company",
+            "website": "https://www.rheem.com/",
+            "attributes": {"Customer service": "1 (800) 621-5622",
+                           "Headquarters": "1100 Abernathy Rd, Suite 1700, Atlanta, GA 30328"},
+        },
+        "organic": [
+            {"title": "Contact Us | Rheem", "link": "https://www.rheem.com/contact/",
+             "snippet": "Email sales@rheem.com or john.smith@rheem.com. Call 770-351-3000 ext. 12."},
+            {"title": "Rheem - ZoomInfo", "link": "https://www.zoominfo.com/c/rheem/123",
+             "snippet": "Contact j.doe@rheem.com or (404) 555-0100."},
+            {"title": "Water heater forum", "link": "https://forum.example.org/t/1",
+             "snippet": "My installer is bob@gmail.com, phone 312-555-0199."},
+        ],
+    }
+
+    def test_extracts_vendor_contacts_and_skips_directories(self):
+        contacts = extract_contacts(self.RESULTS, "Rheem Manufacturing")
+        self.assertEqual(contacts["emails"], [{"email": "sales@rheem.com", "type": "company"},
+                                              {"email": "john.smith@rheem.com", "type": "individual"}])
+        self.assertEqual(contacts["phone_numbers"], ["(800) 621-5622", "(770) 351-3000 x12"])
+        self.assertEqual(contacts["address"], "1100 Abernathy Rd, Suite 1700, Atlanta, GA 30328")
+        self.assertEqual(contacts["company"], "Rheem Manufacturing Company")
+
+    def test_nothing_credible_returns_none(self):
+        results = {"organic": [{"title": "Forum", "link": "https://forum.example.org/t/1",
+                                "snippet": "Try bob@gmail.com or 312-555-0199."}]}
+        self.assertIsNone(extract_contacts(results, "Rheem Manufacturing"))
+
+    def test_competitors_sharing_a_generic_word_are_not_the_vendor(self):
+        results = {"organic": [
+            {"title": "Joe's Plumbing | Houston", "link": "https://www.joesplumbing.com/",
+             "snippet": "Plumbing repairs. Email joe@joesplumbing.com or call (713) 555-1234."},
+            {"title": "Top plumbing supply houses", "link": "https://www.citysupply.com/blog",
+             "snippet": "ABC Plumbing and City Supply: orders@citysupply.com, 832-555-0147."},
+            {"title": "ABC Plumbing Inc - Contact", "link": "https://abc-plumbing.com/contact",
+             "snippet": "Reach sales@abc-plumbing.com or 281-555-0199."},
+        ]}
+        contacts = extract_contacts(results, "ABC Plumbing Inc")
+        self.assertEqual(contacts["emails"], [{"email": "sales@abc-plumbing.com", "type": "company"}])
+        self.assertEqual(contacts["phone_numbers"], ["(281) 555-0199"])
+
+        # A generic word alone ties nothing to the vendor, and every distinctive word must be in the label
+        self.assertIsNone(extract_contacts(results, "ABC Supply Co"))
+        self.assertIsNone(extract_contacts({"organic": results["organic"][:2]}, "ABC Plumbing Inc"))
+
+    def test_inbox_type(self):
+        self.assertEqual(inbox_type("Accounts.Receivable@acme.com"), "company")
+        self.assertEqual(inbox_type("jane.doe@acme.com"), "individual")
+
+    def test_parse_takes_first_object_not_greedy_span(self):
+        output = ('Here you go: {"company": "Acme", "emails": [], "phone_numbers": ["(555) 010-0000"]} '
+                  'and the schema was {"type": "object"}')
+        self.assertEqual(clean_and_parse_output(output)["company"], "Acme")
+        nested = clean_and_parse_output('{"contact": {"email": "ar@acme.com", "type": "company"}}')
+        self.assertEqual(nested["emails"], [{"email": "ar@acme.com", "type": "company"}])
+
+
+class TestStructuredLogging(unittest.TestCase):
+
+    def setUp(self):
+        import logging
+
+        root = logging.getLogger()
+        saved = list(root.handlers), root.level
+        self.addCleanup(lambda: (stop_logging(), setattr(root, "handlers", saved[0]), root.setLevel(saved[1])))
+
+    def read_lines(self, sample_rate):
+        import json
+        import logging
+        import os
+        import tempfile
+
+        from hedging import run_stage
+
+        log_file = os.path.join(tempfile.mkdtemp(), "app.log")
+        configure_logging("json", "INFO", log_file, sample_rate)
+        with row_context("items", 7, "ABC-1"):
+            logging.info("Processing item: %s", "ABC-1")
+            run_stage("llm", detail, "Processed item %s: %s", "ABC-1", {"huge": "object"})
+        stop_logging()
+        with open(log_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_json_lines_carry_row_correlation_fields(self):
+        lines = self.read_lines(sample_rate=1.0)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]["msg"], "Processing item: ABC-1")
+        self.assertEqual((lines[0]["row_kind"], lines[0]["row_id"], lines[0]["row_key"]), ("items", "7", "ABC-1"))
+        # The detail call ran in a stage thread but still belongs to the row
+        self.assertEqual(lines[1]["correlation_id"], lines[0]["correlation_id"])
+        self.assertTrue(lines[1]["detail"])
+
+    def test_detail_is_dropped_for_unsampled_rows(self):
+        lines = self.read_lines(sample_rate=0.0)
+        self.assertEqual([line["msg"] for line in lines], ["Processing item: ABC-1"])
+
+
+    def test_reconfiguring_flushes_and_closes_the_previous_handlers(self):
+        import logging
+        import os
+        import tempfile
+
+        import logsetup
+
+        directory = tempfile.mkdtemp()
+        first, second = os.path.join(directory, "first.log"), os.path.join(directory, "second.log")
+        configure_logging("text", "INFO", first)
+        old_handlers = logsetup._listener.handlers
+        for n in range(200):
+            logging.info("before %s", n)
+        configure_logging("text", "INFO", second)
+        logging.info("after")
+        stop_logging()
 
+        with open(first) as f:
+            self.assertEqual(sum("before" in line for line in f), 200)
+        with open(second) as f:
+            self.assertIn("after", f.read())
+        self.assertTrue(all(handler.stream is None for handler in old_handlers
+                            if isinstance(handler, logging.FileHandler)))
 
 if __name__ == "__main__":
     unittest.main()
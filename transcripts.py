@@ -0,0 +1,357 @@
+"""
+transcripts.py
+
+A side store of raw transcripts, so a parser fix or a schema change can be
+applied to rows that were already paid for instead of re-calling the APIs.
+
+Each row's raw Serper responses and final model output (the structured
+completion or the agent's output and intermediate steps) are recorded as the
+row is processed and saved as one zstd-compressed JSON blob in the
+raw_transcripts table of a separate SQLite file, indexed by row id and prompt
+version. ``python transcripts.py reparse items`` rebuilds the result columns
+from the latest transcript of each row, locally and at disk speed.
+"""
+
+import argparse
+import contextlib
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+try:
+    import zstandard
+except ImportError:  # fall back to zlib so a missing wheel never loses transcripts
+    zstandard = None
+
+# Config
+TRANSCRIPT_DB = os.environ.get("TRANSCRIPT_DB", "transcripts.db")
+TRANSCRIPTS_ENABLED = os.environ.get("TRANSCRIPTS_ENABLED", "1") == "1"
+ZSTD_LEVEL = 9
+
+_row: contextvars.ContextVar = contextvars.ContextVar("transcript_row", default=None)
+_buffer: contextvars.ContextVar = contextvars.ContextVar("transcript_buffer", default=None)
+
+
+def prompt_version(*prompts) -> str:
+    """
+    Derive a short, stable version id from the prompt templates that produce a transcript.
+
+    Args:
+        *prompts: ChatPromptTemplate instances (or plain strings).
+
+    Returns:
+        str: The first 12 hex digits of a SHA-256 over the prompt messages.
+    """
+    digest = hashlib.sha256()
+    for prompt in prompts:
+        messages = getattr(prompt, "messages", None)
+        digest.update(repr(messages if messages is not None else prompt).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def compress(data: bytes) -> Tuple[str, bytes]:
+    """Compress ``data`` with zstd if available, otherwise zlib. Returns (codec, blob)."""
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, 9)
+
+
+def decompress(codec: str, blob: bytes) -> bytes:
+    """Reverse ``compress``."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd transcripts")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+class TranscriptStore:
+    """
+    Collects a row's raw API responses while it is processed and persists them on save.
+
+    Events are grouped by row: inside a ``row`` block every event is
+    attributed to that row id, so retries with a modified query still land in
+    the original row's transcript, and duplicate rows with the same item code
+    each keep their own. Events recorded outside any row block (the service,
+    contact lookups) are dropped at once, since nothing would ever save them.
+
+    Args:
+        path (str): The SQLite file holding the raw_transcripts table.
+        enabled (bool): Record and save transcripts at all.
+    """
+
+    def __init__(self, path: str = TRANSCRIPT_DB, enabled: bool = TRANSCRIPTS_ENABLED):
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.pending: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self.conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS raw_transcripts (
+                    id INTEGER PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    row_id TEXT NOT NULL,
+                    row_key TEXT,
+                    prompt_version TEXT NOT NULL,
+                    status TEXT,
+                    codec TEXT NOT NULL,
+                    raw_bytes INTEGER NOT NULL,
+                    payload BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_raw_transcripts_row "
+                "ON raw_transcripts (kind, row_id, prompt_version)"
+            )
+            self.conn.commit()
+        return self.conn
+
+    @contextlib.contextmanager
+    def row(self, kind: str, row_id: Any):
+        """Attribute every event recorded in this block (and the stage calls it makes) to one row."""
+        token = _row.set((kind, str(row_id)))
+        try:
+            yield
+        finally:
+            _row.reset(token)
+
+    def record(self, key: str, event: str, data: Dict[str, Any]):
+        """
+        Add an event to a row's pending transcript.
+
+        Args:
+            key (str): The item code, supplier name or query the event is about.
+            event (str): "search", "llm" or "agent".
+            data (dict): JSON-serialisable payload, e.g. the raw Serper response.
+        """
+        if not self.enabled:
+            return
+        self.commit([{"event": event, "at": time.time(), "key": key, **data}])
+
+    @contextlib.contextmanager
+    def buffered(self, events: List[Dict[str, Any]]):
+        """
+        Collect events recorded in this block in ``events`` instead of the pending transcripts.
+
+        Used for one attempt of a hedged stage call, so only the winning
+        attempt's events are ``commit``-ted, and for a coalesced lookup, so
+        every row sharing its result commits a copy.
+        """
+        token = _buffer.set(events)
+        try:
+            yield
+        finally:
+            _buffer.reset(token)
+
+    def commit(self, events: List[Dict[str, Any]]):
+        """Add events to the current row's pending transcript, or to an enclosing ``buffered`` block."""
+        buffer = _buffer.get()
+        if buffer is not None:
+            buffer.extend(events)
+            return
+        row = _row.get()
+        if row is None or not events:
+            return
+        with self.lock:
+            self.pending.setdefault(row, []).extend(events)
+
+    def discard(self, kind: str, row_id: Any):
+        """Drop a row's pending events without saving them."""
+        with self.lock:
+            self.pending.pop((kind, str(row_id)), None)
+
+    def save(self, kind: str, row_id: Any, key: str, version: str, status: str = "ok"):
+        """
+        Compress and append a row's pending events to the store.
+
+        Rows are saved whether or not they parsed, so a later parser fix can recover failures.
+
+        Args:
+            kind (str): "items" or "suppliers".
+            row_id: The row's id in its work table.
+            key (str): The item code or supplier name.
+            version (str): The prompt version that produced the transcript.
+            status (str): "ok" or "failed".
+        """
+        with self.lock:
+            events = self.pending.pop((kind, str(row_id)), None)
+        if not self.enabled or not events:
+            return
+        raw = json.dumps({"key": key, "events": events}, default=str).encode("utf-8")
+        codec, blob = compress(raw)
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                """
+                INSERT INTO raw_transcripts
+                    (kind, row_id, row_key, prompt_version, status, codec, raw_bytes, payload, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (kind, str(row_id), key, version, status, codec, len(raw), blob, time.time()),
+            )
+            conn.commit()
+
+    def latest(self, kind: str, version: str | None = None) -> Iterator[Tuple[str, str, List[Dict[str, Any]]]]:
+        """
+        Yield the newest transcript of each row as ``(row_id, prompt_version, events)``.
+
+        Args:
+            kind (str): "items" or "suppliers".
+            version (str | None): Only consider transcripts from this prompt version.
+        """
+        with self.lock:
+            rows = self._connect().execute(
+                """
+                SELECT t.row_id, t.prompt_version, t.codec, t.payload
+                FROM raw_transcripts t
+                JOIN (
+                    SELECT MAX(id) AS id FROM raw_transcripts
+                    WHERE kind = ? AND (? IS NULL OR prompt_version = ?)
+                    GROUP BY row_id
+                ) newest ON newest.id = t.id
+                ORDER BY t.id
+                """,
+                (kind, version, version),
+            ).fetchall()
+        for row_id, row_version, codec, payload in rows:
+            yield row_id, row_version, json.loads(decompress(codec, payload))["events"]
+
+    def report(self) -> Dict[str, Any]:
+        """Summarise stored transcripts per kind and prompt version, with the compression ratio."""
+        with self.lock:
+            rows = self._connect().execute(
+                """
+                SELECT kind, prompt_version, COUNT(*), SUM(raw_bytes), SUM(LENGTH(payload))
+                FROM raw_transcripts GROUP BY kind, prompt_version
+                """
+            ).fetchall()
+        return {
+            f"{kind}/{version}": {
+                "transcripts": count,
+                "raw_bytes": raw,
+                "stored_bytes": stored,
+                "ratio": round(raw / stored, 1) if stored else 0.0,
+            }
+            for kind, version, count, raw, stored in rows
+        }
+
+
+def agent_transcript(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Extract the final output and intermediate steps of an AgentExecutor result.
+
+    Args:
+        result (dict): The result of ``AgentExecutor.invoke`` with ``return_intermediate_steps=True``.
+
+    Returns:
+        dict: The "agent" event payload.
+    """
+    return {
+        "output": result["output"],
+        "steps": [
+            {"tool": action.tool, "input": action.tool_input, "observation": observation}
+            for action, observation in result.get("intermediate_steps", [])
+        ],
+    }
+
+
+def parse_final(events: List[Dict[str, Any]], model, parser=None):
+    """
+    Parse the final model output of a transcript with the current schema.
+
+    Args:
+        events (list): The transcript's events, oldest first.
+        model: The Pydantic model for structured completions.
+        parser: The PydanticOutputParser for agent output.
+
+    Returns:
+        An instance of ``model``.
+
+    Raises:
+        ValueError: If the transcript has no model output.
+    """
+    for event in reversed(events):
+        if event["event"] == "llm":
+            return model.parse_obj(json.loads(event["content"]))
+        if event["event"] == "agent" and parser is not None:
+            return parser.parse(event["output"])
+    raise ValueError("Transcript has no model output")
+
+
+def reparse(store: "TranscriptStore", kind: str, model, parser, write_fn: Callable[[str, Any], None],
+            version: str | None = None, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Rebuild result columns from stored transcripts without calling any API.
+
+    Args:
+        store (TranscriptStore): The transcript store.
+        kind (str): "items" or "suppliers".
+        model: The Pydantic model to parse into.
+        parser: The PydanticOutputParser for agent output.
+        write_fn: Called as ``write_fn(row_id, parsed)`` to update the work table.
+        version (str | None): Only reparse transcripts from this prompt version.
+        dry_run (bool): Parse without writing.
+
+    Returns:
+        dict: Counts of transcripts read, parsed, written and failed.
+    """
+    started = time.monotonic()
+    counts = {"read": 0, "parsed": 0, "written": 0, "failed": 0}
+    for row_id, _, events in store.latest(kind, version):
+        counts["read"] += 1
+        try:
+            parsed = parse_final(events, model, parser)
+        except Exception as e:
+            logging.warning(f"Could not reparse {kind} row {row_id}: {e}")
+            counts["failed"] += 1
+            continue
+        counts["parsed"] += 1
+        if not dry_run:
+            write_fn(row_id, parsed)
+            counts["written"] += 1
+    elapsed = time.monotonic() - started
+    logging.info(f"Reparsed {kind} transcripts in {elapsed:.1f}s{' (dry run)' if dry_run else ''}: {counts}")
+    return counts
+
+
+store = TranscriptStore()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    arg_parser = argparse.ArgumentParser(description="Inspect and reparse stored raw transcripts.")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    reparse_command = commands.add_parser("reparse", help="Rebuild result columns from stored transcripts")
+    reparse_command.add_argument("kind", choices=["items", "suppliers"])
+    reparse_command.add_argument("--prompt-version", help="Only reparse transcripts from this prompt version")
+    reparse_command.add_argument("--dry-run", action="store_true", help="Parse without writing")
+    reparse_command.add_argument("--db-path", help="The work database (defaults to the pipeline's DB_PATH)")
+    commands.add_parser("stats", help="Show stored transcript counts and compression")
+    args = arg_parser.parse_args()
+
+    if args.command == "stats":
+        print(json.dumps(store.report(), indent=2))
+    elif args.kind == "items":
+        from agent_item import reparse_items
+
+        print(reparse_items(args.prompt_version, args.dry_run, **({"db_path": args.db_path} if args.db_path else {})))
+    else:
+        from agent_company import reparse_suppliers
+
+        print(reparse_suppliers(args.prompt_version, args.dry_run,
+                                **({"db_path": args.db_path} if args.db_path else {})))
@@ -0,0 +1,238 @@
+"""
+unspsc.py
+
+Integer UNSPSC rollup columns. A classification code such as ``43211503``
+names a commodity inside a class (``43211500``), a family (``43210000``) and a
+segment (``43000000``). Each classified row stores those four codes as
+indexed integers, so category rollups group on an index rather than slicing
+``classification_code`` strings at query time. The ``unspsc_levels`` table
+maps codes at any level to the names the classifier gave them.
+
+The result writers fill the columns as rows are classified, and ``backfill``
+fills existing rows in one statement per table:
+``python unspsc.py backfill all``.
+"""
+
+import argparse
+import logging
+import re
+import sqlite3
+from typing import Any, Dict, List, Tuple
+
+from priority import TARGETS as PRIORITY_TARGETS
+
+# Level name, the number of significant digits, and its column
+LEVELS = [("segment", 2), ("family", 4), ("class", 6), ("commodity", 8)]
+LEVEL_COLUMNS = {f"unspsc_{level}": "INTEGER" for level, _ in LEVELS}
+NAMES_TABLE = "unspsc_levels"
+
+
+def levels(code: Any) -> Tuple[int | None, int | None, int | None, int | None]:
+    """
+    Split a classification code into its segment, family, class and commodity codes.
+
+    Non-digits are ignored and short codes are zero-padded, as in supplier
+    inference. Levels below the code's own are None: ``43211500`` is a class,
+    so its commodity is None.
+
+    Args:
+        code: The classification code, e.g. ``"43211503"``.
+
+    Returns:
+        tuple: Four 8-digit integers or None, e.g. ``(43000000, 43210000, 43211500, 43211503)``.
+    """
+    digits = re.sub(r"\D", "", str(code or ""))[:8].ljust(8, "0")
+    if not re.match(r"^[1-9]\d{7}$", digits):
+        return None, None, None, None
+    return tuple(
+        int(digits[:width].ljust(8, "0")) if width == 2 or digits[width - 2:width] != "00" else None
+        for _, width in LEVELS
+    )
+
+
+def level_of(code: int) -> str:
+    """The most specific level an 8-digit code names, e.g. "class" for 43211500."""
+    for level, width in reversed(LEVELS):
+        if str(code)[width - 2:width] != "00":
+            return level
+    return "segment"
+
+
+def _unspsc_level(code: Any, index: int) -> int | None:
+    return levels(code)[index]
+
+
+def _table(kind: str) -> str:
+    return PRIORITY_TARGETS[kind]["table"]
+
+
+def ensure_level_columns(conn: sqlite3.Connection, kind: str) -> bool:
+    """
+    Add the level columns, their indexes and the names table if missing, and
+    register the unspsc_level SQL function on the connection. Rows classified
+    before the columns existed are backfilled when they are added.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+
+    Returns:
+        bool: True if the columns were added and backfilled.
+    """
+    table = _table(kind)
+    conn.create_function("unspsc_level", 2, _unspsc_level, deterministic=True)
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA main.table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    added = [column for column in LEVEL_COLUMNS if column not in existing]
+    for column in added:
+        cursor.execute(f"ALTER TABLE main.{table} ADD COLUMN {column} {LEVEL_COLUMNS[column]}")
+    for column in LEVEL_COLUMNS:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS main.idx_{table.lower()}_{column} ON {table} ({column})")
+    cursor.execute(
+        f"CREATE TABLE IF NOT EXISTS main.{NAMES_TABLE} (code INTEGER PRIMARY KEY, level TEXT NOT NULL, name TEXT)"
+    )
+    conn.commit()
+    if added:
+        backfill(conn, kind)
+    return bool(added)
+
+
+def level_values(code: Any) -> Dict[str, int | None]:
+    """The level columns for ``code``, for a writer's UPDATE."""
+    return dict(zip(LEVEL_COLUMNS, levels(code)))
+
+
+def write_levels(conn: sqlite3.Connection, kind: str, row_id: Any, code: Any, name: str | None = None):
+    """
+    Set a classified row's level columns and record its code's name. Requires ensure_level_columns.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        row_id: The row's id.
+        code: The classification code just written.
+        name (str | None): The classification name just written.
+    """
+    values = level_values(code)
+    conn.execute(
+        f"UPDATE main.{_table(kind)} SET {', '.join(f'{column} = ?' for column in values)} WHERE id = ?",
+        (*values.values(), row_id),
+    )
+    specific = next((value for value in reversed(values.values()) if value is not None), None)
+    if specific is not None and name:
+        conn.execute(
+            f"INSERT OR IGNORE INTO main.{NAMES_TABLE} (code, level, name) VALUES (?, ?, ?)",
+            (specific, level_of(specific), name),
+        )
+    conn.commit()
+
+
+def backfill(conn: sqlite3.Connection, kind: str) -> int:
+    """
+    Recompute the level columns of every row in one UPDATE, and refresh the names table.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+
+    Returns:
+        int: The number of rows with a valid classification code.
+    """
+    table = _table(kind)
+    conn.create_function("unspsc_level", 2, _unspsc_level, deterministic=True)
+    assignments = ", ".join(f"{column} = unspsc_level(classification_code, {index})"
+                            for index, column in enumerate(LEVEL_COLUMNS))
+    cursor = conn.cursor()
+    cursor.execute(f"UPDATE main.{table} SET {assignments}")
+    conn.commit()
+    refresh_level_names(conn, kind)
+    cursor.execute(f"SELECT COUNT(*) FROM main.{table} WHERE unspsc_segment IS NOT NULL")
+    count = cursor.fetchone()[0]
+    logging.info(f"Backfilled UNSPSC levels on {table}: {count} rows with a valid code")
+    return count
+
+
+def refresh_level_names(conn: sqlite3.Connection, kind: str):
+    """
+    Add the names of codes classified in ``kind``'s table that the names table lacks.
+
+    Each code's most common name wins. Requires the level columns.
+    """
+    table = _table(kind)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        SELECT COALESCE(unspsc_commodity, unspsc_class, unspsc_family, unspsc_segment) AS code,
+               classification_name, COUNT(*) AS uses
+        FROM main.{table}
+        WHERE unspsc_segment IS NOT NULL AND classification_name IS NOT NULL AND classification_name != ''
+        GROUP BY code, classification_name
+        ORDER BY code, uses DESC
+        """
+    )
+    names: Dict[int, str] = {}
+    for code, name, _ in cursor.fetchall():
+        names.setdefault(code, name)
+    cursor.executemany(
+        f"INSERT OR IGNORE INTO main.{NAMES_TABLE} (code, level, name) VALUES (?, ?, ?)",
+        [(code, level_of(code), name) for code, name in names.items()],
+    )
+    conn.commit()
+
+
+def rollup(conn: sqlite3.Connection, kind: str, level: str = "family") -> List[Tuple[int, str | None, int]]:
+    """
+    Count classified rows per code at one UNSPSC level, largest first, using the level's index.
+
+    Args:
+        conn: The database connection.
+        kind (str): "items" or "suppliers".
+        level (str): "segment", "family", "class" or "commodity".
+
+    Returns:
+        list: ``(code, name, rows)`` tuples; name is None where no row was classified at that code.
+    """
+    column = f"unspsc_{level}"
+    if column not in LEVEL_COLUMNS:
+        raise ValueError(f"Unknown UNSPSC level: {level}")
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""
+        SELECT t.{column}, n.name, COUNT(*) AS n
+        FROM main.{_table(kind)} t
+        LEFT JOIN main.{NAMES_TABLE} n ON n.code = t.{column}
+        WHERE t.{column} IS NOT NULL
+        GROUP BY t.{column}
+        ORDER BY n DESC
+        """
+    )
+    return cursor.fetchall()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    arg_parser = argparse.ArgumentParser(description="Maintain the integer UNSPSC level columns.")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+    backfill_command = commands.add_parser("backfill", help="Add and fill the level columns")
+    backfill_command.add_argument("kind", choices=["items", "suppliers", "all"])
+    rollup_command = commands.add_parser("rollup", help="Print classified rows per code at one level")
+    rollup_command.add_argument("kind", choices=["items", "suppliers"])
+    rollup_command.add_argument("--level", choices=[level for level, _ in LEVELS], default="family")
+    for command in (backfill_command, rollup_command):
+        command.add_argument("--db", default="spend_intake2.db")
+    args = arg_parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.command == "backfill":
+            for kind in (["items", "suppliers"] if args.kind == "all" else [args.kind]):
+                if not ensure_level_columns(conn, kind):
+                    backfill(conn, kind)
+        else:
+            ensure_level_columns(conn, args.kind)
+            for code, name, rows in rollup(conn, args.kind, args.level):
+                print(f"{code:>8}  {rows:>7}  {name or ''}")
+    finally:
+        conn.close()
@@ -2,24 +2,42 @@
 utils.py
 """
 
+import functools
 import json
 import os
-from typing import override
+import time
+try:
+    from typing import override
+except ImportError:  # Python < 3.12
+    from typing_extensions import override
 
 import streamlit as st
-from openai import OpenAI
 from openai.lib.streaming import AssistantEventHandler
 from openai.types.beta.threads.runs import tool_call
-from st_aggrid import AgGrid
+
+from assistant_runs import INVESTIGATE_MESSAGE
+from clients import registry
+from json_stream import JSONStream, StreamParseError
 
 # Get secrets
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
 # Config
 LAST_UPDATE_DATE = "2024-04-08"
+RENDER_MAX_FPS = 10  # streamed responses are re-rendered at most this often
+
+
+@functools.cache
+def get_client():
+    """The OpenAI client on the shared connection pool, created on first use."""
+    return registry.openai()
 
-# Initialise the OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
+
+def __getattr__(name: str):
+    # utils.client was a module global; build it on first access instead of at import
+    if name == "client":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def render_custom_css() -> None:
@@ -159,6 +177,8 @@ def summon_grid(df):
         "enableLiveAutocompletion": True,
     }
 
+    from st_aggrid import AgGrid
+
     return AgGrid(
         data=df, gridOptions=grid_options, customButtons=custom_buttons, options=options
     )
@@ -216,6 +236,11 @@ def openai_setup_instructions(st):
 
 
 class OpenAIManager:
+    """
+    Streams one assistant run at a time into the current Streamlit page.
+    For bulk runs outside Streamlit use assistant_runs.HeadlessAssistantManager.
+    """
+
     def __init__(self, client, assistant_id):
         self.client = client
         self.assistant_id = assistant_id
@@ -234,7 +259,7 @@ class OpenAIManager:
         return self.client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
-            content=f"Please investigate: {supplier_name}. Please respond with JSON"
+            content=INVESTIGATE_MESSAGE.format(supplier_name=supplier_name)
         )
 
     def stream_response(self, thread_id):
@@ -252,17 +277,71 @@ class OpenAIManager:
 
 
 class EventHandler(AssistantEventHandler):
-    def __init__(self):
+    """
+    Streams assistant responses into a Streamlit container.
+
+    Text deltas are buffered and flushed at most ``max_fps`` times a second,
+    and only the response being streamed is re-rendered; every response gets
+    one final render in ``on_end``.
+
+    Each text is also fed to a JSONStream. Once it holds a complete JSON
+    object, the object replaces the raw text and later deltas are dropped.
+    With ``stop_on_json`` (opt-in) the run is also cancelled so no more tokens
+    are generated, unless it has a tool call pending: an assistant may answer
+    in JSON and still call get_vendor_classification.
+    A parse error is shown as soon as it happens and the text streams on as plain text.
+    """
+
+    def __init__(self, max_fps: float = RENDER_MAX_FPS, stop_on_json: bool = False):
         super().__init__()
+        self.stop_on_json = stop_on_json
+        self.json_stream = None  # parser for the text being streamed
         self.responses = []
         self.container = st.container()
+        self.slots = []  # one st.empty() placeholder per response
+        self.pending = []  # text deltas not yet rendered
+        self.current = None  # index in responses of the text being streamed
+        self.current_text = ""  # its raw text so far, kept apart from the parsed response
+        self.pending_tool_calls = set()  # ids of tool calls whose outputs are not submitted yet
+        self.render_interval = 1.0 / max_fps if max_fps else 0.0
+        self.last_render = 0.0
+
+    def render_response(self, index):
+        while len(self.slots) <= index:
+            self.slots.append(self.container.empty())
+        with self.slots[index].container():
+            with st.expander(f"Response {index + 1}", expanded=True):
+                st.json(self.responses[index])
+
+    def flush_pending(self):
+        """Move buffered deltas into the raw text of the current response and show it as text."""
+        if not self.pending:
+            return
+        if self.current is None:
+            self.start_response()
+        self.current_text += "".join(self.pending)
+        self.pending = []
+        self.responses[self.current] = {"text": self.current_text}
+
+    def start_response(self):
+        self.responses.append({"text": ""})
+        self.current = len(self.responses) - 1
+        self.current_text = ""
+
+    def update_container(self, force=False):
+        """Render the latest response, throttled to the frame rate unless ``force`` is set."""
+        now = time.monotonic()
+        if not force and now - self.last_render < self.render_interval:
+            return
+        self.flush_pending()
+        if self.responses:
+            self.render_response(len(self.responses) - 1)
+        self.last_render = now
 
-    def update_container(self):
-        with self.container:
-            st.empty()  # Clear previous content
-            for response in self.responses:
-                with st.expander(f"Response {len(self.responses)}", expanded=True):
-                    st.json(response)
+    def render_all(self):
+        self.flush_pending()
+        for index in range(len(self.responses)):
+            self.render_response(index)
 
     @override
     def on_event(self, event):
@@ -295,6 +374,7 @@ class EventHandler(AssistantEventHandler):
 
         # print(f"Tool outputs: {tool_outputs}")
         self.submit_tool_outputs(tool_outputs, run_id)
+        self.pending_tool_calls.clear()
 
     def submit_tool_outputs(self, tool_outputs, run_id):
         print(f"Tool outputs: {tool_outputs}")
@@ -302,7 +382,7 @@ class EventHandler(AssistantEventHandler):
         print(f"Current run thread ID: {self.current_run.thread_id}")
         print(f"Current run ID: {self.current_run.id}")
         # Use the submit_tool_outputs_stream helper
-        with client.beta.threads.runs.submit_tool_outputs_stream(
+        with get_client().beta.threads.runs.submit_tool_outputs_stream(
                 thread_id=self.current_run.thread_id,
                 run_id=self.current_run.id,
                 tool_outputs=tool_outputs,
@@ -313,24 +393,49 @@ class EventHandler(AssistantEventHandler):
             print(f"Stream ended")
 
     def on_text_created(self, text):
-        try:
-            json_response = json.loads(text)
-            self.responses.append(json_response)
-        except json.JSONDecodeError:
-            self.responses.append({"text": text})
-        self.update_container()
+        self.flush_pending()
+        text = getattr(text, "value", text) or ""  # the SDK passes a Text object
+        self.json_stream = JSONStream(skip_prefix=True)
+        self.start_response()
+        self.feed_text(text)
+        self.update_container(force=True)
 
     def on_text_delta(self, delta, snapshot):
-        if self.responses:
-            if isinstance(self.responses[-1], dict) and "text" in self.responses[-1]:
-                self.responses[-1]["text"] += delta.value
-            else:
-                self.responses.append({"text": delta.value})
-        else:
-            self.responses.append({"text": delta.value})
+        self.feed_text(delta.value or "")
         self.update_container()
 
+    def feed_text(self, text):
+        """Buffer a piece of the current text and parse it; a completed object replaces the text."""
+        if self.json_stream is not None and self.json_stream.complete:
+            return  # trailing chatter after the object
+        self.pending.append(text)
+        if self.json_stream is None:
+            return
+        try:
+            complete = self.json_stream.feed(text)
+        except StreamParseError as e:
+            self.json_stream = None
+            self.container.warning(f"Response is not valid JSON: {e}")
+            return
+        if complete:
+            self.pending = []
+            self.responses[self.current] = self.json_stream.value()
+            self.update_container(force=True)
+            if self.stop_on_json:
+                self.cancel_run()
+
+    def cancel_run(self):
+        """Cancel the run once its JSON answer is complete, so it stops generating tokens."""
+        run = self.current_run
+        if run is None or run.status not in ("queued", "in_progress") or self.pending_tool_calls:
+            return
+        try:
+            get_client().beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+        except Exception as e:  # the run may have finished in the meantime
+            print(f"Could not cancel run {run.id}: {e}")
+
     def on_tool_call_created(self, tool_call):
+        self.pending_tool_calls.add(tool_call.id)
         self.update_container()
 
     def on_tool_call_done(self, tool_call):
@@ -342,8 +447,8 @@ class EventHandler(AssistantEventHandler):
         self.update_container()
 
     def on_run_completed(self, run):
-        self.update_container()
+        self.update_container(force=True)
 
     def on_end(self):
-        self.update_container()
+        self.render_all()
         return self.responses